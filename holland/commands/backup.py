@@ -2,15 +2,25 @@
 Define backup command
 """
 
+import argparse
 import logging
+import os
 from string import Template
 from subprocess import PIPE, Popen
 
 # Commvault command entry point
 from holland.core.backup import BackupError, BackupRunner
+from holland.core.backup.planner import plan_disk_space
+from holland.core.backup.scheduler import (
+    BackupJob,
+    BackupScheduler,
+    ResourceLimits,
+    previous_duration,
+    resource_keys,
+)
 from holland.core.command import Command
 from holland.core.config import HOLLANDCFG, ConfigError
-from holland.core.spool import SPOOL
+from holland.core.spool import SPOOL, wait_for_purges
 from holland.core.util.fmt import format_bytes
 from holland.core.util.lock import Lock, LockError
 from holland.core.util.path import disk_capacity, disk_free, getmount
@@ -18,6 +28,19 @@ from holland.core.util.path import disk_capacity, disk_free, getmount
 LOG = logging.getLogger(__name__)
 
 
+def positive_int(value):
+    """
+    Parse a command line option that must be a whole number of at least 1
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a whole number of at least 1, not %r" % value)
+    return number
+
+
 class Backup(Command):
     """${cmd_usage}
 
@@ -32,15 +55,25 @@ class Backup(Command):
 
     aliases = ["bk"]
 
-    args = [["--abort-immediately"], ["--dry-run", "-n"], ["--no-lock", "-f"]]
+    args = [["--abort-immediately"], ["--dry-run", "-n"], ["--no-lock", "-f"], ["--jobs", "-j"]]
     kargs = [
-        {"action": "store_true", "help": "Abort on the first backupset that fails."},
+        {
+            "action": "store_true",
+            "help": "Stop starting new backupsets after the first backupset that fails.",
+        },
         {"action": "store_true", "help": "Print backup commands without executing them."},
         {
             "action": "store_true",
             "default": False,
             "help": "Run even if another copy of Holland is running.",
         },
+        {
+            "type": positive_int,
+            "metavar": "N",
+            "default": None,
+            "help": "Run up to N backupsets concurrently "
+            "(default: [holland] max-concurrent-backups).",
+        },
     ]
     description = "Run backups for active backupsets"
 
@@ -77,8 +110,11 @@ class Backup(Command):
             runner.register_cb("after-backup", call_hooks)
             runner.register_cb("failed-backup", call_hooks)
 
-        error = 1
-        LOG.info("--- Starting %s run ---", opts.dry_run and "dry" or "backup")
+        max_workers = opts.jobs
+        if max_workers is None:
+            max_workers = HOLLANDCFG.lookup("holland.max-concurrent-backups") or 1
+
+        jobs = []
         for name in backupsets:
             try:
                 config = HOLLANDCFG.backupset(name)
@@ -86,39 +122,83 @@ class Backup(Command):
                 config.setdefault("holland:backup", {})
             except (SyntaxError, IOError) as exc:
                 LOG.error("Could not load backupset '%s': %s", name, exc)
-                break
-
-            if not opts.no_lock:
-                lock = Lock(config.filename)
-                try:
-                    lock.acquire()
-                    LOG.debug("Set advisory lock on %s", lock.path)
-                except LockError:
-                    LOG.debug("Unable to acquire advisory lock on %s", lock.path)
-                    LOG.error(
-                        "Another holland backup process is already "
-                        "running backupset '%s'. Aborting.",
+                jobs.append(BackupJob(name, error=exc))
+                continue
+            if max_workers > 1:
+                jobs.append(
+                    BackupJob(
                         name,
+                        config,
+                        resources=resource_keys(config, os.path.join(SPOOL.path, name)),
+                        weight=previous_duration(SPOOL, name),
                     )
-                    break
+                )
+            else:
+                jobs.append(BackupJob(name, config))
+        # a serial run has always stopped at the first failed backupset
+        scheduler = BackupScheduler(
+            lambda job: backup_job(runner, job, opts),
+            max_workers=max_workers,
+            abort_on_failure=opts.abort_immediately or max_workers == 1,
+            limits=ResourceLimits(HOLLANDCFG.get("resource-limits")),
+        )
 
-            try:
-                try:
-                    runner.backup(name, config, opts.dry_run)
-                except BackupError as exc:
-                    LOG.error("Backup failed: %s", exc.args[0])
-                    break
-                except ConfigError:
-                    break
-            finally:
-                if not opts.no_lock:
-                    if lock.is_locked():
-                        lock.release()
-                    LOG.info("Released lock %s", lock.path)
-        else:
-            error = 0
+        LOG.info("--- Starting %s run ---", opts.dry_run and "dry" or "backup")
+        if max_workers > 1:
+            LOG.info("Running up to %d backupsets concurrently", max_workers)
+        if len(jobs) > 1 and HOLLANDCFG.lookup("holland.plan-disk-space"):
+            LOG.info("Planning disk space for %d backupsets", len(jobs))
+            plan_disk_space(
+                runner,
+                jobs,
+                purge=not opts.no_lock,
+                serial=max_workers == 1,
+                dry_run=opts.dry_run,
+            )
+        jobs = scheduler.run(jobs)
+        if len(jobs) > 1:
+            for job in jobs:
+                LOG.info("Backupset '%s': %s", job.name, job.status)
         LOG.info("--- Ending %s run ---", opts.dry_run and "dry" or "backup")
-        return error
+        return int(any(job.failed for job in jobs))
+
+
+def backup_job(runner, job, opts):
+    """
+    Lock and back up a single backupset
+
+    Returns True if the backup succeeded
+    """
+    name = job.name
+    if not opts.no_lock:
+        lock = Lock(job.config.filename)
+        try:
+            lock.acquire()
+            LOG.debug("Set advisory lock on %s", lock.path)
+        except LockError:
+            LOG.debug("Unable to acquire advisory lock on %s", lock.path)
+            LOG.error(
+                "Another holland backup process is already running backupset '%s'. Aborting.",
+                name,
+            )
+            return False
+
+    try:
+        try:
+            runner.backup(name, job.config, opts.dry_run, estimate=job.estimate)
+        except BackupError as exc:
+            LOG.error("Backup failed: %s", exc.args[0])
+            job.error = exc
+            return False
+        except ConfigError as exc:
+            job.error = exc
+            return False
+    finally:
+        if not opts.no_lock:
+            if lock.is_locked():
+                lock.release()
+            LOG.info("Released lock %s", lock.path)
+    return True
 
 
 def purge_backup(event, entry):
@@ -198,6 +278,9 @@ class PurgeManager(object):
         if event == "before-backup":
             retention_count += 1
         self.purge_backupset(backupset, retention_count)
+        if event == "before-backup":
+            # the backup about to run needs the space
+            wait_for_purges()
         config = entry.config["holland:backup"]
         backupset.update_symlinks(
             enable=config["create-symlinks"], relative=config["relative-symlinks"]
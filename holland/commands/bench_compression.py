@@ -0,0 +1,422 @@
+"""
+Command to compare compression methods on real backup data
+"""
+
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from holland.core.backup import BackupError
+from holland.core.backup.ledger import CHECKSUMS_FILE, STREAMS_FILE
+from holland.core.command import Command
+from holland.core.spool import SPOOL
+from holland.core.util.fmt import format_bytes
+from holland.lib.common.compression import (
+    COMPRESSION_METHODS,
+    THREAD_OPTIONS,
+    compression_threads,
+    lookup_compression,
+    open_stream,
+)
+from holland.lib.common.split import MANIFEST_SUFFIX
+from holland.lib.common.util import parse_size
+
+LOG = logging.getLogger(__name__)
+
+#: Files in a backup directory that are not backup data
+METADATA_FILES = ("backup.conf", CHECKSUMS_FILE, STREAMS_FILE)
+
+#: Bytes handed to open_stream() per write, as a dump would
+WRITE_SIZE = 1024 * 1024
+
+
+def _comma_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _int_list(value):
+    return [int(item) for item in _comma_list(value)]
+
+
+class BenchCompression(Command):
+    """${cmd_usage}
+
+    Compress a sample of a backup, or of any file, with each available
+    compression method, level and thread count and report how each did
+
+    ${cmd_option_list}
+
+    """
+
+    name = "bench-compression"
+
+    aliases = ["bc"]
+
+    args = [
+        ["--methods", "-m"],
+        ["--levels", "-l"],
+        ["--threads", "-t"],
+        ["--engines", "-e"],
+        ["--sample-size", "-s"],
+        ["--tmpdir"],
+        ["--json"],
+    ]
+
+    kargs = [
+        {
+            "type": _comma_list,
+            "default": None,
+            "help": "Comma separated compression methods to compare "
+            "(default: every installed method except gpg)",
+        },
+        {
+            "type": _int_list,
+            "default": [1, 6],
+            "help": "Comma separated compression levels (default: 1,6)",
+        },
+        {
+            "type": _int_list,
+            "default": [1],
+            "help": "Comma separated thread counts, 0 for one per cpu (default: 1)",
+        },
+        {
+            "type": _comma_list,
+            "default": ["external"],
+            "help": "Comma separated compression engines: external, internal "
+            "or auto (default: external)",
+        },
+        {
+            "default": "64M",
+            "help": "Bytes of data to compress with each setting (default: 64M)",
+        },
+        {
+            "default": None,
+            "help": "Directory to write the compressed samples to",
+        },
+        {
+            "metavar": "PATH",
+            "default": None,
+            "help": "Also write the results as JSON to PATH, or only to stdout with '-'",
+        },
+    ]
+
+    description = "Compare compression methods on backup data"
+
+    def run(self, opts, *sources):
+        if not sources:
+            print(
+                "The bench-compression command requires a backupset, backup or file",
+                file=sys.stderr,
+            )
+            return 1
+
+        try:
+            sample_size = parse_size(opts.sample_size)
+        except ValueError as exc:
+            LOG.error("Invalid sample size: %s", exc)
+            return 1
+
+        sample = bytearray()
+        for source in sources:
+            try:
+                read_sample(source, sample, sample_size)
+            except (IOError, OSError, BackupError) as exc:
+                LOG.error("Failed to read a sample from '%s': %s", source, exc)
+                return 1
+        if not sample:
+            LOG.error("No data to sample in %s", ", ".join(sources))
+            return 1
+        LOG.info("Compressing a %s sample with each setting", format_bytes(len(sample)))
+
+        methods = opts.methods or [method for method in COMPRESSION_METHODS if method != "gpg"]
+        directory = tempfile.mkdtemp(prefix="holland-bench-", dir=opts.tmpdir)
+        try:
+            results = bench_compression(
+                bytes(sample), directory, methods, opts.levels, opts.threads, opts.engines
+            )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        if opts.json != "-":
+            print_table(results)
+        if opts.json == "-":
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        elif opts.json:
+            with open(opts.json, "w") as fileobj:
+                json.dump(results, fileobj, indent=2)
+            LOG.info("Wrote results to %s", opts.json)
+        return int(any("error" in result for result in results))
+
+
+def _sample_files(source):
+    """
+    Return the data files to sample for a backupset, backup or file,
+    largest first
+    """
+    if os.path.isfile(source):
+        return [source]
+    if "/" in source:
+        backup = SPOOL.find_backup(source)
+    else:
+        backupset = SPOOL.find_backupset(source)
+        backups = backupset.list_backups(reverse=True) if backupset else None
+        backup = backups[0] if backups else None
+    if not backup:
+        raise IOError("No backupset, backup or file named '%s'" % source)
+    LOG.info("Sampling backup %s", backup.name)
+    files = []
+    for root, _, names in os.walk(backup.path):
+        for name in names:
+            if name in METADATA_FILES or name.endswith(MANIFEST_SUFFIX):
+                continue
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(path)
+    return sorted(files, key=os.path.getsize, reverse=True)
+
+
+def _open_sample(path):
+    """
+    Open a data file for reading, decompressing it if it was compressed
+    """
+    for method, (_, ext) in COMPRESSION_METHODS.items():
+        if method != "gpg" and path.endswith(ext):
+            LOG.info("Decompressing %s with %s", path, method)
+            return open_stream(path, "r", method)
+    return open(path, "rb")
+
+
+def read_sample(source, sample, sample_size):
+    """
+    Append data from a backupset, backup or file to sample until it holds
+    sample_size bytes
+    """
+    for path in _sample_files(source):
+        if len(sample) >= sample_size:
+            return
+        fileobj = _open_sample(path)
+        try:
+            while len(sample) < sample_size:
+                data = fileobj.read(min(WRITE_SIZE, sample_size - len(sample)))
+                if not data:
+                    break
+                sample += data
+        finally:
+            fileobj.close()
+
+
+def _peak_rss(pid="self"):
+    """
+    Return the peak resident memory of a process in bytes, or 0 if it is
+    not known
+    """
+    try:
+        with open("/proc/%s/status" % pid, "r") as fileobj:
+            for line in fileobj:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    if pid == "self":
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def _child_pids():
+    """
+    Return the pids of the child processes of this process
+    """
+    pids = set()
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open("/proc/self/task/%s/children" % task, "r") as fileobj:
+                pids.update(fileobj.read().split())
+    except (IOError, OSError):
+        pass
+    return pids
+
+
+def _watch_children(peaks, done):
+    """
+    Record the peak resident memory of each child process until done is set
+
+    Once a compression program exits its memory use is no longer visible,
+    and the ru_maxrss of an exited child includes the memory of this
+    process at the time it was started.
+    """
+    while not done.wait(0.05):
+        for pid in _child_pids():
+            peaks[pid] = max(peaks.get(pid, 0), _peak_rss(pid))
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident memory of this process to its current size,
+    where the kernel supports it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fileobj:
+            fileobj.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def compress_sample(sample, path, method, level, engine, threads):
+    """
+    Compress a sample through open_stream() as a backup would
+
+    This is run in a child process of its own, so the cpu time and peak
+    memory of the compression program are those of this run alone.
+
+    :returns: dict of bytes-out, seconds, cpu-seconds and peak-rss
+    """
+    _reset_peak_rss()
+    rss_before = _peak_rss()
+    children_rss = {}
+    done = threading.Event()
+    watcher = threading.Thread(target=_watch_children, args=(children_rss, done))
+    watcher.daemon = True
+    watcher.start()
+    times_before = os.times()
+    started = time.time()
+    stream = open_stream(path, "w", method, level, engine=engine, threads=threads)
+    view = memoryview(sample)
+    for offset in range(0, len(sample), WRITE_SIZE):
+        stream.write(view[offset : offset + WRITE_SIZE])
+    stream.close()
+    seconds = time.time() - started
+    times_after = os.times()
+    done.set()
+    watcher.join()
+    os.remove(stream.name)
+    # in-process compression shows up as this process' memory growth
+    return {
+        "bytes-out": stream.bytes_out,
+        "seconds": seconds,
+        "cpu-seconds": sum(times_after[:4]) - sum(times_before[:4]),
+        "peak-rss": max([_peak_rss() - rss_before] + list(children_rss.values())),
+    }
+
+
+def _run_isolated(func, *args):
+    """
+    Run func(*args) in a forked child process and return its result
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = {"result": func(*args)}
+        except Exception as exc:  # pylint: disable=broad-except
+            result = {"error": str(exc)}
+        with os.fdopen(write_fd, "w") as fileobj:
+            json.dump(result, fileobj)
+        os._exit(0)  # pylint: disable=protected-access
+    os.close(write_fd)
+    with os.fdopen(read_fd, "r") as fileobj:
+        data = fileobj.read()
+    os.waitpid(pid, 0)
+    try:
+        result = json.loads(data)
+    except ValueError:
+        raise IOError("Benchmark process exited without a result")
+    if "error" in result:
+        raise IOError(result["error"])
+    return result["result"]
+
+
+def bench_compression(sample, directory, methods, levels, threads_list, engines):
+    """
+    Compress sample with every combination of method, level, thread count
+    and engine
+
+    Combinations that cannot be run are skipped, as are thread counts other
+    than 1 for compression programs that are single threaded and engines
+    that resolve to a combination that was already run.
+
+    :returns: list of result dicts, in the order they were run
+    """
+    results = []
+    seen = set()
+    for method in methods:
+        for engine in engines:
+            for threads in sorted(set(compression_threads(count) for count in threads_list)):
+                try:
+                    argv, _ = lookup_compression(method, engine, threads)
+                except (OSError, BackupError) as exc:
+                    LOG.info("Skipping %s (%s engine): %s", method, engine, exc)
+                    break
+                if argv is not None and threads > 1 and method not in THREAD_OPTIONS:
+                    continue
+                # e.g. the internal engine falling back to the program
+                setting = (method, argv is None, threads)
+                if setting in seen:
+                    continue
+                seen.add(setting)
+                for level in levels:
+                    result = {
+                        "method": method,
+                        "level": level,
+                        "engine": "external" if argv else "internal",
+                        "threads": threads,
+                        "bytes-in": len(sample),
+                    }
+                    LOG.info("Compressing with %s level %d, %d thread(s)", method, level, threads)
+                    path = os.path.join(directory, "sample")
+                    try:
+                        result.update(
+                            _run_isolated(
+                                compress_sample, sample, path, method, level, engine, threads
+                            )
+                        )
+                    except (IOError, OSError) as exc:
+                        LOG.error("Compressing with %s level %d failed: %s", method, level, exc)
+                        result["error"] = str(exc)
+                    else:
+                        result["ratio"] = float(result["bytes-out"]) / max(len(sample), 1)
+                        result["throughput"] = len(sample) / max(result["seconds"], 1e-6)
+                    results.append(result)
+    return results
+
+
+def print_table(results):
+    """
+    Format and print benchmark results
+    """
+    fmt = "%-16s %-9s %5s %7s %9s %7s %9s %10s"
+    print(fmt % ("Method", "Engine", "Level", "Threads", "MB/s", "Ratio", "CPU-secs", "Peak-RSS"))
+    print("-" * 80)
+    for result in results:
+        if "error" in result:
+            print(
+                "%-16s %-9s %5d %7d  failed: %s"
+                % (
+                    result["method"],
+                    result["engine"],
+                    result["level"],
+                    result["threads"],
+                    result["error"],
+                )
+            )
+            continue
+        print(
+            fmt
+            % (
+                result["method"],
+                result["engine"],
+                result["level"],
+                result["threads"],
+                "%.1f" % (result["throughput"] / 1024.0**2),
+                "%.3f" % result["ratio"],
+                "%.2f" % result["cpu-seconds"],
+                format_bytes(result["peak-rss"], 1),
+            )
+        )
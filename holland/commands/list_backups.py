@@ -21,8 +21,14 @@ class ListBackups(Command):
     name = "list-backups"
     aliases = ["lb"]
     description = "List available backups"
-    args = [["-v", "--verbose"]]
-    kargs = [{"action": "store_true", "help": "Verbose output"}]
+    args = [["-v", "--verbose"], ["--rebuild-catalog"]]
+    kargs = [
+        {"action": "store_true", "help": "Verbose output"},
+        {
+            "action": "store_true",
+            "help": "Rebuild the spool's backup catalog from each backup.conf",
+        },
+    ]
 
     def run(self, opts, *args):
         """
@@ -30,32 +36,36 @@ class ListBackups(Command):
         """
         if args:
             print("The list-backup command takes no arguments", file=sys.stderr)
-        backup_list = list(SPOOL.list_backups())
-        if not backup_list:
-            print("No backups")
-            return 0
+        if opts.rebuild_catalog:
+            count = SPOOL.catalog.rebuild(SPOOL)
+            print("Rebuilt backup catalog %s with %d backups" % (SPOOL.catalog.path, count))
 
-        backupsets_seen = []
-        for backup in backup_list:
-            if backup.backupset not in backupsets_seen:
-                backupsets_seen.append(backup.backupset)
-                print("Backupset[%s]:" % (backup.backupset))
-            # Read the backup.conf
-            backup.load_config()
-            plugin_name = backup.config.get("holland:backup", {})["plugin"]
-            if not plugin_name:
-                print("Skipping broken backup: %s" % backup.name)
+        found = False
+        for backupset in SPOOL.list_backupsets():
+            # The catalog saves reading every backup.conf
+            records = SPOOL.catalog.records(backupset, readonly=True)
+            if not records:
                 continue
-            print("\t%s" % backup.name)
-            if opts.verbose:
-                print("\t", backup.info())
-                plugin = load_backup_plugin(plugin_name)
-                plugin = plugin(backup.backupset, backup.config, backup.path)
-                if hasattr(plugin, "info"):
-                    plugin_info = plugin.info()
-                    rec = re.compile(r"^", re.M)
-                    print(rec.sub("\t\t", plugin_info))
+            found = True
+            print("Backupset[%s]:" % (backupset.name))
+            for record in records:
+                if not record.plugin:
+                    print("Skipping broken backup: %s" % record.name)
+                    continue
+                print("\t%s" % record.name)
+                if opts.verbose:
+                    backup = SPOOL.find_backup(record.name)
+                    backup.load_config()
+                    print("\t", backup.info())
+                    plugin = load_backup_plugin(record.plugin)
+                    plugin = plugin(backup.backupset, backup.config, backup.path)
+                    if hasattr(plugin, "info"):
+                        plugin_info = plugin.info()
+                        rec = re.compile(r"^", re.M)
+                        print(rec.sub("\t\t", plugin_info))
 
+        if not found:
+            print("No backups")
         return 0
 
     @staticmethod
@@ -126,10 +126,13 @@ def purge_backupset(backupset, force=False, all_backups=False):
             backups = []
             size = 0
             backup_list = backupset.list_backups(reverse=True)
+            sizes = dict(
+                (record.name, record.on_disk_size)
+                for record in SPOOL.catalog.records(backupset, readonly=True)
+            )
             for backup in itertools.islice(backup_list, retention_count, None):
                 backups.append(backup)
-                config = backup.config["holland:backup"]
-                size += int(config["on-disk-size"])
+                size += int(sizes.get(backup.name) or 0)
 
             LOG.info("    %d total backups", len(backup_list))
             for backup in backup_list:
@@ -153,7 +156,9 @@ def purge_backupset(backupset, force=False, all_backups=False):
                     LOG.info("Purged %d backup%s", count, "s"[0 : bool(count)])
             else:
                 LOG.info("Skipping purge in dry-run mode.")
-            config = backup.config["holland:backup"]
+            # backups are loaded lazily, so use the backupset's settings rather
+            # than those of a backup that may just have been purged
+            config = config["holland:backup"]
             backupset.update_symlinks(
                 enable=config["create-symlinks"], relative=config["relative-symlinks"]
             )
@@ -3,19 +3,30 @@ Define how backup plugins will be called
 """
 
 import errno
+import json
 import logging
 import os
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+from holland.core.backup.history import SizeModel
+from holland.core.backup.ledger import backup_disk_usage, close_ledger, open_ledger
 from holland.core.plugin import PluginLoadError, load_backup_plugin
-from holland.core.spool import Backup
+from holland.core.spool import Backup, wait_for_purges
 from holland.core.util.fmt import format_bytes, format_interval
 from holland.core.util.path import directory_size, disk_free
 
 MAX_SPOOL_RETRIES = 5
 
+#: Number of backups measured at once when a backup has no recorded size
+MAX_SIZE_WORKERS = 4
+
+#: Machine-readable phase timings written next to backup.conf
+TIMINGS_FILE = "timings.json"
+
 LOG = logging.getLogger(__name__)
 
 
@@ -23,6 +34,26 @@ class BackupError(Exception):
     """Error during a backup"""
 
 
+class PhaseTimer(object):
+    """
+    Accumulate the wall time spent in each phase of a backup
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as phase ``name``.  Repeated phases add up.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - start
+
+
 class BackupPlugin:
     """
     Define a backup plugin
@@ -158,49 +189,59 @@ class BackupRunner(object):
             except:
                 raise BackupError(str(sys.exc_info()[1]))
 
-    def backup(self, name, config, dry_run=False):
+    def backup(self, name, config, dry_run=False, estimate=None):
         """Run a backup for the named backupset using the provided
         configuration
 
         :param name: name of the backupset
         :param config: dict-like object providing the backupset configuration
+        :param estimate: size the backupset was already estimated at, if any
 
         :raises: BackupError if a backup fails
         """
-        for i in range(MAX_SPOOL_RETRIES):
-            try:
-                spool_entry = self.spool.add_backup(name)
-                break
-            except OSError as exc:
-                if exc.errno != errno.EEXIST:
-                    raise BackupError("Failed to create spool: %s" % exc)
-                LOG.debug("Failed to create spool.  Retrying in %d seconds.", i + 1)
-                time.sleep(i + 1)
-        else:
-            raise BackupError("Failed to create a new backup directory for %s" % name)
-
-        spool_entry.config.merge(config)
-        spool_entry.validate_config()
+        timer = PhaseTimer()
+        with timer.phase("spool"):
+            for i in range(MAX_SPOOL_RETRIES):
+                try:
+                    spool_entry = self.spool.add_backup(name)
+                    break
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise BackupError("Failed to create spool: %s" % exc)
+                    LOG.debug("Failed to create spool.  Retrying in %d seconds.", i + 1)
+                    time.sleep(i + 1)
+            else:
+                raise BackupError("Failed to create a new backup directory for %s" % name)
 
-        if dry_run:
-            # always purge the spool
-            self.register_cb("post-backup", lambda *args, **kwargs: spool_entry.purge())
+            spool_entry.config.merge(config)
+            spool_entry.validate_config()
 
-        plugin = load_plugin(name, spool_entry.config, spool_entry.path, dry_run)
+        with timer.phase("plugin-load"):
+            plugin = load_plugin(name, spool_entry.config, spool_entry.path, dry_run)
 
         spool_entry.config["holland:backup"]["start-time"] = time.time()
-        spool_entry.flush()
-        self.apply_cb("before-backup", spool_entry)
+        with timer.phase("flush"):
+            spool_entry.flush()
+        with timer.phase("before-backup"):
+            self.apply_cb("before-backup", spool_entry)
         spool_entry.config["holland:backup"]["failed"] = False
 
+        ledger = None
         try:
-            estimated_size = self.check_available_space(plugin, spool_entry, dry_run)
+            estimated_size = self.check_available_space(
+                plugin, spool_entry, dry_run, timer, estimate
+            )
             LOG.info(
                 "Starting backup[%s] via plugin %s",
                 spool_entry.name,
                 spool_entry.config["holland:backup"]["plugin"],
             )
-            plugin.backup()
+            ledger = open_ledger(spool_entry.path)
+            try:
+                with timer.phase("backup"):
+                    plugin.backup()
+            finally:
+                close_ledger(ledger)
         except KeyboardInterrupt:
             LOG.warning("Backup aborted by interrupt")
             spool_entry.config["holland:backup"]["failed"] = True
@@ -211,8 +252,28 @@ class BackupRunner(object):
 
         spool_entry.config["holland:backup"]["stop-time"] = time.time()
         if not dry_run and not spool_entry.config["holland:backup"]["failed"]:
-            final_size = float(directory_size(spool_entry.path))
+            with timer.phase("size-accounting"):
+                if ledger is None:
+                    final_size = float(directory_size(spool_entry.path))
+                else:
+                    final_size = float(ledger.disk_usage())
             LOG.info("Final on-disk backup size %s", format_bytes(final_size))
+            if ledger is not None and ledger.files:
+                LOG.info("%d streams wrote %s", len(ledger.files), format_bytes(ledger.bytes_out))
+                if ledger.bytes_in:
+                    LOG.info(
+                        "%s were written to streams before compression",
+                        format_bytes(ledger.bytes_in),
+                    )
+                try:
+                    checksums = ledger.write_checksums()
+                    if checksums:
+                        LOG.info(
+                            "Recorded checksums of %d files in %s", len(ledger.digests), checksums
+                        )
+                except (IOError, OSError) as exc:
+                    LOG.warning("Failed to record checksums: %s", exc)
+                self.record_streams(spool_entry, ledger)
             if estimated_size > 0:
                 LOG.info(
                     "%.2f%% of estimated size %s",
@@ -221,7 +282,8 @@ class BackupRunner(object):
                 )
 
             spool_entry.config["holland:backup"]["on-disk-size"] = final_size
-            spool_entry.flush()
+            with timer.phase("flush"):
+                spool_entry.flush()
 
         start_time = spool_entry.config["holland:backup"]["start-time"]
         stop_time = spool_entry.config["holland:backup"]["stop-time"]
@@ -232,20 +294,88 @@ class BackupRunner(object):
             LOG.info("Backup completed in %s", format_interval(stop_time - start_time))
 
         if dry_run:
+            # always purge the spool
             spool_entry.purge()
 
-        if sys.exc_info() != (None, None, None) or spool_entry.config["holland:backup"]["failed"]:
-            LOG.debug("sys.exc_info(): %r", sys.exc_info())
-            self.apply_cb("failed-backup", spool_entry)
-            raise BackupError("Failed backup: %s" % name)
-        self.apply_cb("after-backup", spool_entry)
+        try:
+            if (
+                sys.exc_info() != (None, None, None)
+                or spool_entry.config["holland:backup"]["failed"]
+            ):
+                LOG.debug("sys.exc_info(): %r", sys.exc_info())
+                with timer.phase("failed-backup"):
+                    self.apply_cb("failed-backup", spool_entry)
+                raise BackupError("Failed backup: %s" % name)
+            with timer.phase("after-backup"):
+                self.apply_cb("after-backup", spool_entry)
+        finally:
+            self.record_timings(spool_entry, timer)
+            if spool_entry.exists():
+                self.spool.catalog.update(spool_entry)
+
+    @staticmethod
+    def record_timings(spool_entry, timer):
+        """Save the phase timings of a backup to its backup.conf and to a
+        machine-readable TIMINGS_FILE next to it
+
+        Nothing is written if the backup was purged, e.g. by a dry-run or
+        auto-purge-failures.
+        """
+        for phase, seconds in timer.timings.items():
+            LOG.debug("Phase %s took %s", phase, format_interval(seconds))
+        if not spool_entry.exists():
+            return
+        timings = dict((phase, round(seconds, 6)) for phase, seconds in timer.timings.items())
+        spool_entry.config["holland:timings"] = timings
+        try:
+            spool_entry.flush()
+            with open(os.path.join(spool_entry.path, TIMINGS_FILE), "w") as fileobj:
+                json.dump(
+                    {
+                        "backup": spool_entry.name,
+                        "start-time": spool_entry.config["holland:backup"]["start-time"],
+                        "stop-time": spool_entry.config["holland:backup"]["stop-time"],
+                        "failed": spool_entry.config["holland:backup"]["failed"],
+                        "timings": timings,
+                    },
+                    fileobj,
+                    indent=2,
+                )
+        except (IOError, OSError) as exc:
+            LOG.warning("Failed to record backup timings: %s", exc)
+
+    @staticmethod
+    def record_streams(spool_entry, ledger):
+        """Summarize the telemetry of a backup's streams in its backup.conf and
+        save the numbers of each stream to STREAMS_FILE
+        """
+        if not ledger.streams:
+            return
+        summary = ledger.stream_summary()
+        spool_entry.config["holland:streams"] = summary
+        wall_time = summary["wall-time"]
+        if wall_time:
+            LOG.info(
+                "Streams processed %s/s of input using %.2f cpu seconds per second",
+                format_bytes(summary["bytes-in"] / wall_time),
+                summary["cpu-time"] / wall_time,
+            )
+        try:
+            ledger.write_streams()
+        except (IOError, OSError) as exc:
+            LOG.warning("Failed to record stream telemetry: %s", exc)
 
-    def free_required_space(self, name, required_bytes, dry_run=False):
+    def free_required_space(self, name, required_bytes, dry_run=False, exclude=None):
         """Attempt to free at least ``required_bytes`` of old backups from a backupset
 
+        The oldest backups are purged first, using the on-disk-size recorded
+        for each backup.  Only backups without a recorded size are measured,
+        in parallel, and files their stream telemetry lists are not stat'ed.
+
         :param name: name of the backupset to free space from
         :param required_bytes: integer number of bytes required for the backupset path
         :param dry_run: if true, this will only generate log messages but won't actually free space
+        :param exclude: name of a backup that must not be purged, e.g. the one being run
         :returns: bool; True if freed or False otherwise
         """
         LOG.info(
@@ -254,9 +384,25 @@ class BackupRunner(object):
         )
         LOG.info("purge-on-demand is enabled. Discovering old backups to purge.")
         available_bytes = disk_free(os.path.join(self.spool.path, name))
+        backupset = self.spool.find_backupset(name)
+        backups = []
+        sizes = {}
+        if backupset:
+            backups = [backup for backup in backupset.list_backups() if backup.name != exclude]
+            for record in self.spool.catalog.records(backupset):
+                sizes[record.name] = record.on_disk_size
+
+        unknown = [backup for backup in backups if not sizes.get(backup.name)]
+        if unknown:
+            LOG.info("Measuring %d backups without a recorded size", len(unknown))
+            with ThreadPoolExecutor(max_workers=min(len(unknown), MAX_SIZE_WORKERS)) as executor:
+                measured = executor.map(backup_disk_usage, [backup.path for backup in unknown])
+                for backup, size in zip(unknown, measured):
+                    sizes[backup.name] = size
+
         to_purge = {}
-        for backup in self.spool.list_backups(name):
-            backup_size = directory_size(backup.path)
+        for backup in backups:
+            backup_size = sizes[backup.name]
             LOG.info("Found backup '%s': %s", backup.path, format_bytes(backup_size))
             available_bytes += backup_size
             to_purge[backup] = backup_size
@@ -286,6 +432,8 @@ class BackupRunner(object):
             else:
                 LOG.info("Purging: %s", backup.path)
                 backup.purge()
+        # the space is needed now, not when the background deletion finishes
+        wait_for_purges()
         LOG.info(
             "%s now has %s of available space",
             os.path.join(self.spool.path, name),
@@ -293,23 +441,36 @@ class BackupRunner(object):
         )
         return True
 
-    def historic_required_space(self, plugin, spool_entry, estimated_bytes_required):
+    def historic_required_space(self, plugin, backupset, estimated_bytes_required):
         """
-        Use size reported in 'newest' backup to predict backup size
-        If this fails return a value less than zero and use the estimated-size-factor
+        Use the sizes of previous backups to predict backup size
+
+        With historic-size-samples > 1 and enough successful backups, a
+        SizeModel over those backups is used.  Otherwise the size reported in
+        the 'newest' backup is used.  If this fails return a value less than
+        zero and use the estimated-size-factor
         """
         config = plugin.config["holland:backup"]
         if not config["historic-size"]:
             return -1.0
 
+        samples = int(config["historic-size-samples"])
+        if samples > 1:
+            model = self.size_model(backupset, samples)
+            if len(model) > 1:
+                LOG.info("Using Historic Space Estimate: modelling the last %d backups", len(model))
+                return model.predict(
+                    estimated_bytes_required, config["historic-estimated-size-factor"]
+                )
+
         historic_size_factor = config["historic-size-factor"]
 
-        old_backup_config = os.path.join(self.spool.path, spool_entry.backupset, "newest")
+        old_backup_config = os.path.join(self.spool.path, backupset, "newest")
         if not os.path.exists(old_backup_config):
             LOG.debug("Missing backup.conf from last backup")
             return -1.0
 
-        old_backup = Backup(old_backup_config, spool_entry.backupset, "newest")
+        old_backup = Backup(old_backup_config, backupset, "newest")
         old_backup.load_config()
 
         if (
@@ -348,17 +509,24 @@ class BackupRunner(object):
         )
         return size_required * float(config["historic-estimated-size-factor"])
 
-    def check_available_space(self, plugin, spool_entry, dry_run=False):
+    def size_model(self, backupset, samples):
         """
-        calculate available space before performing backup
+        Build a SizeModel from the newest ``samples`` successful backups of a
+        backupset
         """
-        available_bytes = disk_free(spool_entry.path)
-        estimated_bytes_required = float(plugin.estimate_backup_size())
-        spool_entry.config["holland:backup"]["estimated-size"] = estimated_bytes_required
-        LOG.info("Estimated Backup Size: %s", format_bytes(estimated_bytes_required))
+        existing = self.spool.find_backupset(backupset)
+        if not existing:
+            return SizeModel([])
+        records = self.spool.catalog.records(existing)
+        return SizeModel.from_records(reversed(records), samples)
 
+    def required_space(self, plugin, backupset, estimated_bytes_required):
+        """
+        Adjust a plugin's estimated backup size by the historic size of the
+        backupset or the configured estimated-size-factor
+        """
         adjusted_bytes_required = self.historic_required_space(
-            plugin, spool_entry, estimated_bytes_required
+            plugin, backupset, estimated_bytes_required
         )
 
         config = plugin.config["holland:backup"]
@@ -379,14 +547,45 @@ class BackupRunner(object):
                 adjustment_factor,
                 format_bytes(adjusted_bytes_required),
             )
+        return adjusted_bytes_required
 
+    def check_available_space(
+        self, plugin, spool_entry, dry_run=False, timer=None, estimated_bytes=None
+    ):
+        """
+        calculate available space before performing backup
+
+        The plugin is only asked for an estimate if estimated_bytes was not
+        already provided, e.g. by planning the run.
+        """
+        if timer is None:
+            timer = PhaseTimer()
+        available_bytes = disk_free(spool_entry.path)
+        if estimated_bytes is None:
+            with timer.phase("estimate"):
+                estimated_bytes_required = float(plugin.estimate_backup_size())
+        else:
+            estimated_bytes_required = float(estimated_bytes)
+        spool_entry.config["holland:backup"]["estimated-size"] = estimated_bytes_required
+        LOG.info("Estimated Backup Size: %s", format_bytes(estimated_bytes_required))
+
+        adjusted_bytes_required = self.required_space(
+            plugin, spool_entry.backupset, estimated_bytes_required
+        )
+
+        config = plugin.config["holland:backup"]
         if available_bytes <= adjusted_bytes_required:
-            if not (
-                config["purge-on-demand"]
-                and self.free_required_space(
-                    spool_entry.backupset, adjusted_bytes_required, dry_run
-                )
-            ):
+            if config["purge-on-demand"]:
+                with timer.phase("purge-on-demand"):
+                    freed = self.free_required_space(
+                        spool_entry.backupset,
+                        adjusted_bytes_required,
+                        dry_run,
+                        exclude=spool_entry.name,
+                    )
+            else:
+                freed = False
+            if not freed:
                 msg = ("Insufficient Disk Space. %s required, " "but only %s available on %s") % (
                     format_bytes(adjusted_bytes_required),
                     format_bytes(available_bytes),
@@ -0,0 +1,133 @@
+"""
+Predict the on-disk size of a backup from previous backups of its backupset
+"""
+
+import logging
+import math
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class SizeSample(object):
+    """
+    Estimated and actual size of a previous successful backup
+    """
+
+    def __init__(self, start_time, estimated_size, on_disk_size):
+        self.start_time = start_time
+        self.estimated_size = estimated_size
+        self.on_disk_size = on_disk_size
+
+    @property
+    def ratio(self):
+        """
+        on-disk size relative to the estimate, e.g. the compression ratio
+        """
+        return self.on_disk_size / self.estimated_size
+
+
+class SizeModel(object):
+    """
+    Size model built from the last successful backups of a backupset
+
+    The model predicts a new backup's size two ways: the current estimate
+    times the recent ratio of on-disk to estimated size, and the growth
+    trend of on-disk sizes over time.  The larger prediction is used, with a
+    safety margin of two standard deviations of the ratio.
+    """
+
+    def __init__(self, samples):
+        #: samples, newest first
+        self.samples = list(samples)
+
+    @classmethod
+    def from_records(cls, records, limit):
+        """
+        Build a model from spool catalog records, newest first
+
+        Failed backups and backups without recorded sizes are skipped.
+        """
+        samples = []
+        for record in records:
+            if len(samples) >= limit:
+                break
+            if record.failed or not record.on_disk_size or not record.estimated_size:
+                continue
+            samples.append(
+                SizeSample(
+                    float(record.start_time),
+                    float(record.estimated_size),
+                    float(record.on_disk_size),
+                )
+            )
+        return cls(samples)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _ratio(self):
+        """
+        Weighted mean and standard deviation of the on-disk/estimate ratio.
+        Newer backups weigh more.
+        """
+        weights = list(range(len(self.samples), 0, -1))
+        total = float(sum(weights))
+        mean = sum(w * s.ratio for w, s in zip(weights, self.samples)) / total
+        variance = sum(w * (s.ratio - mean) ** 2 for w, s in zip(weights, self.samples)) / total
+        return mean, math.sqrt(variance)
+
+    def growth(self):
+        """
+        Least-squares growth of the on-disk size in bytes per second
+        """
+        if len(self.samples) < 2:
+            return 0.0
+        mean_t = sum(s.start_time for s in self.samples) / len(self.samples)
+        mean_s = sum(s.on_disk_size for s in self.samples) / len(self.samples)
+        spread = sum((s.start_time - mean_t) ** 2 for s in self.samples)
+        if not spread:
+            return 0.0
+        return (
+            sum((s.start_time - mean_t) * (s.on_disk_size - mean_s) for s in self.samples) / spread
+        )
+
+    def confidence(self):
+        """
+        Confidence in the prediction between 0 and 1
+
+        This drops as the ratio varies between backups and when fewer
+        samples are available.
+        """
+        if not self.samples:
+            return 0.0
+        mean, stdev = self._ratio()
+        consistency = max(0.0, 1.0 - stdev / mean) if mean else 0.0
+        return consistency * (1.0 - 1.0 / (len(self.samples) + 1))
+
+    def predict(self, estimated_size, max_factor, now=None):
+        """
+        Predict the space needed by a new backup
+
+        :param estimated_size: the plugin's estimate for the new backup
+        :param max_factor: upper bound on the safety margin, as a factor
+        :returns: predicted number of bytes, including the safety margin
+        """
+        if now is None:
+            now = time.time()
+        mean, stdev = self._ratio()
+        by_ratio = estimated_size * mean
+        newest = self.samples[0]
+        by_trend = newest.on_disk_size + self.growth() * max(now - newest.start_time, 0)
+        margin = 1.0 + (2.0 * stdev / mean if mean else 0.0)
+        margin = min(margin, float(max_factor))
+        LOG.info(
+            "Historic size model: %d backups, on-disk/estimate ratio %.3f +/- %.3f, "
+            "growth %.2f bytes/day, confidence %.0f%%",
+            len(self.samples),
+            mean,
+            stdev,
+            self.growth() * 86400,
+            self.confidence() * 100,
+        )
+        return max(by_ratio, by_trend) * margin
@@ -0,0 +1,226 @@
+"""
+Account for the bytes backup plugins write into a backup directory
+"""
+
+import json
+import logging
+import os
+import threading
+
+from holland.core.util.path import directory_size, disk_usage
+
+LOG = logging.getLogger(__name__)
+
+_LEDGERS = {}
+_LEDGER_LOCK = threading.Lock()
+
+#: File listing the blake2b digest of each recorded file, in the format of
+#: ``b2sum`` so it can be verified with ``b2sum -c BLAKE2SUMS``
+CHECKSUMS_FILE = "BLAKE2SUMS"
+
+#: File recording the throughput of each stream of a backup
+STREAMS_FILE = "streams.json"
+
+
+class OutputLedger(object):
+    """
+    Sizes of the files written to a backup directory through the holland
+    stream api (see holland.lib.common.compression.open_stream)
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.files = {}
+        self.digests = {}
+        self.streams = {}
+        self.bytes_in = 0
+        self._lock = threading.Lock()
+
+    def record(self, path, bytes_out, bytes_in=0, digest=None):
+        """
+        Record the final on-disk size of a file, the number of bytes that
+        were written to it before compression and the blake2b digest of its
+        contents, if known
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self.files[path] = bytes_out
+            self.bytes_in += bytes_in
+            if digest:
+                self.digests[path] = digest
+
+    def record_stream(
+        self, path, bytes_in, bytes_out, wall_time, cpu_time, compression=None, stages=None
+    ):
+        """
+        Record the throughput of a stream: how long it was open and the cpu
+        seconds spent compressing it, and optionally the compression method
+        that was chosen for it and the counters of each stage of its pipeline
+        """
+        stream = {
+            "bytes-in": bytes_in,
+            "bytes-out": bytes_out,
+            "wall-time": round(wall_time, 6),
+            "cpu-time": round(cpu_time, 6),
+        }
+        if compression:
+            stream["compression"] = compression
+        if stages:
+            stream["stages"] = stages
+        with self._lock:
+            self.streams[os.path.abspath(path)] = stream
+
+    @property
+    def bytes_out(self):
+        """
+        Total on-disk size of the recorded files
+        """
+        return sum(self.files.values())
+
+    def disk_usage(self):
+        """
+        Size of the backup directory
+
+        Only the files that were not recorded in this ledger are stat'ed, so
+        a plugin that writes all its output through streams costs no more
+        than a directory listing.
+        """
+        if not self.files:
+            return directory_size(self.path)
+        return directory_size(self.path, known_sizes=self.files)
+
+    def write_checksums(self):
+        """
+        Write the recorded digests to CHECKSUMS_FILE in the backup directory
+
+        :returns: path of the checksums file, or None if no digests were
+                  recorded
+        """
+        if not self.digests:
+            return None
+        path = os.path.join(self.path, CHECKSUMS_FILE)
+        with open(path, "w") as fileobj:
+            for name, digest in sorted(self.digests.items()):
+                if os.path.exists(name):
+                    fileobj.write("%s  %s\n" % (digest, os.path.relpath(name, self.path)))
+        return path
+
+    def stream_summary(self):
+        """
+        Totals of the recorded stream telemetry, for backup.conf
+        """
+        streams = list(self.streams.values())
+        return {
+            "files": len(streams),
+            "bytes-in": sum(stream["bytes-in"] for stream in streams),
+            "bytes-out": sum(stream["bytes-out"] for stream in streams),
+            "wall-time": round(sum(stream["wall-time"] for stream in streams), 6),
+            "cpu-time": round(sum(stream["cpu-time"] for stream in streams), 6),
+        }
+
+    def write_streams(self):
+        """
+        Write the telemetry of each stream to STREAMS_FILE in the backup
+        directory
+
+        :returns: path of the streams file, or None if nothing was recorded
+        """
+        if not self.streams:
+            return None
+        path = os.path.join(self.path, STREAMS_FILE)
+        streams = dict(
+            (os.path.relpath(name, self.path), stream) for name, stream in self.streams.items()
+        )
+        with open(path, "w") as fileobj:
+            json.dump(streams, fileobj, indent=2, sort_keys=True)
+        return path
+
+
+def recorded_sizes(path):
+    """
+    Read the size of each file a finished backup wrote through streams from
+    its STREAMS_FILE
+
+    :returns: dict of absolute file path to size, empty if nothing was
+              recorded
+    """
+    path = os.path.abspath(path)
+    try:
+        with open(os.path.join(path, STREAMS_FILE), "r") as fileobj:
+            streams = json.load(fileobj)
+        return dict(
+            (os.path.join(path, name), int(stream["bytes-out"])) for name, stream in streams.items()
+        )
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as exc:
+        LOG.debug("No stream sizes recorded for %s: %s", path, exc)
+        return {}
+
+
+def backup_disk_usage(path):
+    """
+    Disk space used by a finished backup directory
+
+    Files whose size the backup recorded in its STREAMS_FILE are not stat'ed.
+    """
+    return disk_usage(path, known_sizes=recorded_sizes(path))
+
+
+def open_ledger(path):
+    """
+    Start accounting for the files written below ``path``
+    """
+    ledger = OutputLedger(path)
+    with _LEDGER_LOCK:
+        _LEDGERS[ledger.path] = ledger
+    return ledger
+
+
+def close_ledger(ledger):
+    """
+    Stop accounting for the files written below a ledger's path
+    """
+    with _LEDGER_LOCK:
+        _LEDGERS.pop(ledger.path, None)
+
+
+def _find_ledger(path):
+    """
+    Return the ledger of the most specific backup directory containing path
+    """
+    with _LEDGER_LOCK:
+        ledgers = [ledger for ledger in _LEDGERS.values() if path.startswith(ledger.path + os.sep)]
+    if not ledgers:
+        return None
+    return max(ledgers, key=lambda ledger: len(ledger.path))
+
+
+def record_output(path, bytes_out, bytes_in=0, digest=None):
+    """
+    Report a finished output file to the ledger of the backup it belongs to
+
+    Files outside of any backup being run are ignored.
+    """
+    ledger = _find_ledger(os.path.abspath(path))
+    if ledger is not None:
+        ledger.record(path, bytes_out, bytes_in, digest)
+
+
+def record_stream(path, bytes_in, bytes_out, wall_time, cpu_time, compression=None, stages=None):
+    """
+    Report the telemetry of a finished stream to the ledger of the backup it
+    belongs to
+
+    :param path: name of the stream's output file
+    :param bytes_in: bytes written to the stream
+    :param bytes_out: bytes written to disk
+    :param wall_time: seconds the stream was open
+    :param cpu_time: cpu seconds used to compress the stream
+    :param compression: compression method and level, e.g. 'gzip:6', when it
+                        was chosen automatically
+    :param stages: list of dicts of the exit status, cpu seconds and bytes
+                   read and written by each program the stream was piped
+                   through
+    """
+    ledger = _find_ledger(os.path.abspath(path))
+    if ledger is not None:
+        ledger.record_stream(path, bytes_in, bytes_out, wall_time, cpu_time, compression, stages)
@@ -0,0 +1,187 @@
+"""
+Plan the disk space needed by all backupsets of a backup run
+"""
+
+import logging
+import os
+
+from holland.core.backup.base import BackupError, load_plugin
+from holland.core.backup.scheduler import BackupJob
+from holland.core.config import BaseConfig
+from holland.core.spool import CONFIGSPEC
+from holland.core.util.fmt import format_bytes
+from holland.core.util.path import disk_free, getmount
+
+LOG = logging.getLogger(__name__)
+
+
+class SpacePlan(object):
+    """
+    Disk space requirements of a single queued backupset
+    """
+
+    def __init__(self, job, mount, required=0.0):
+        self.job = job
+        self.mount = mount
+        self.required = required
+        # bytes freed by the before-backup purge of this backupset
+        self.reclaim_before = 0.0
+        # bytes freed by the after-backup purge of this backupset
+        self.reclaim_after = 0.0
+        # bytes that purge-on-demand could free from this backupset
+        self.reclaim_on_demand = 0.0
+
+
+def _backup_sizes(spool, name):
+    """
+    Return the recorded on-disk-size of each existing backup, newest first
+    """
+    backupset = spool.find_backupset(name)
+    if not backupset:
+        return []
+    return [float(record.on_disk_size) for record in reversed(spool.catalog.records(backupset))]
+
+
+def estimate_job(runner, job, purge=True):
+    """
+    Estimate the space a queued backupset requires and may reclaim
+
+    Backupsets with a before-backup-command are not estimated, as the
+    command may prepare what they back up and only runs with the backup.
+
+    :returns: SpacePlan or None if the backupset could not be estimated
+    """
+    path = os.path.join(runner.spool.path, job.name)
+    config = BaseConfig({}, file_error=False)
+    config.merge(job.config)
+    try:
+        config.validate_config(CONFIGSPEC, suppress_warnings=True)
+        if config["holland:backup"]["before-backup-command"]:
+            LOG.info(
+                "Not planning space for '%s', as it is estimated after its "
+                "before-backup-command runs",
+                job.name,
+            )
+            return None
+        plugin = load_plugin(job.name, config, path, dry_run=True)
+        estimated_bytes = float(plugin.estimate_backup_size())
+    except Exception as exc:  # pylint: disable=broad-except
+        LOG.warning("Not planning space for '%s': %s", job.name, exc)
+        LOG.debug("Failed to estimate '%s'", job.name, exc_info=True)
+        return None
+    LOG.info("Estimated Backup Size for '%s': %s", job.name, format_bytes(estimated_bytes))
+    # the backup reuses this rather than estimating the backupset again
+    job.estimate = estimated_bytes
+
+    plan = SpacePlan(job, getmount(path), runner.required_space(plugin, job.name, estimated_bytes))
+    if not purge:
+        return plan
+
+    backup_config = config["holland:backup"]
+    retention_count = int(backup_config["backups-to-keep"])
+    sizes = _backup_sizes(runner.spool, job.name)
+    if backup_config["purge-policy"] == "before-backup":
+        plan.reclaim_before = sum(sizes[retention_count:])
+    elif backup_config["purge-policy"] == "after-backup":
+        # the new backup counts towards the retention count
+        plan.reclaim_after = sum(sizes[max(retention_count, 1) - 1 :])
+    if backup_config["purge-on-demand"]:
+        plan.reclaim_on_demand = sum(sizes)
+    return plan
+
+
+def _charge(plan, available, serial):
+    """
+    Charge a plan against the free space of its filesystem
+
+    :returns: True if the backupset fits, False otherwise
+    """
+    free_bytes = available[plan.mount] + plan.reclaim_before
+    on_demand = max(plan.reclaim_on_demand - plan.reclaim_before, 0)
+    if plan.required > free_bytes + on_demand:
+        return False
+
+    if plan.required > free_bytes:
+        # purge-on-demand will have to remove older backups
+        free_bytes = 0.0
+    else:
+        free_bytes -= plan.required
+        if serial:
+            free_bytes += plan.reclaim_after
+    available[plan.mount] = free_bytes
+    LOG.info(
+        "Planned %s for backupset '%s' on %s, leaving %s",
+        format_bytes(plan.required),
+        plan.job.name,
+        plan.mount,
+        format_bytes(free_bytes),
+    )
+    return True
+
+
+def plan_disk_space(runner, jobs, purge=True, serial=True, dry_run=False):
+    """
+    Check that every queued backupset can finish before any of them start
+
+    Each backupset's estimate is adjusted as it would be when the backup
+    runs, and charged against the free space of the filesystem it is spooled
+    to, after the purges it will trigger.  Space freed by an after-backup
+    purge is only credited to later backupsets on a serial run.
+
+    Backupsets that do not fit in run order are moved to the end of the run,
+    after every backupset that does fit, and checked again against the space
+    the others leave.  Those that still cannot fit are refused up front
+    rather than failing hours into the run.
+
+    :param runner: BackupRunner used for the run
+    :param jobs: list of BackupJob instances in run order, reordered in place
+    :param purge: whether purge callbacks are active for this run
+    :param serial: whether backupsets run one after another
+    :param dry_run: only log the backupsets that would be refused
+    :returns: list of refused jobs
+    """
+    plans = []
+    for job in jobs:
+        if job.status != BackupJob.PENDING:
+            continue
+        plan = estimate_job(runner, job, purge)
+        if plan is not None:
+            plans.append(plan)
+
+    available = {}
+    for plan in plans:
+        if plan.mount not in available:
+            available[plan.mount] = float(disk_free(plan.mount))
+
+    deferred = []
+    for plan in plans:
+        if not _charge(plan, available, serial):
+            LOG.info(
+                "Backupset '%s' does not fit on %s in run order. Moving it to the end of the run.",
+                plan.job.name,
+                plan.mount,
+            )
+            deferred.append(plan)
+
+    refused = []
+    for plan in deferred:
+        if _charge(plan, available, serial):
+            continue
+        msg = (
+            "Insufficient disk space planned for backupset '%s'. "
+            "%s required, but only %s would be available on %s"
+        ) % (
+            plan.job.name,
+            format_bytes(plan.required),
+            format_bytes(available[plan.mount] + max(plan.reclaim_before, plan.reclaim_on_demand)),
+            plan.mount,
+        )
+        LOG.error(msg)
+        if not dry_run:
+            plan.job.status = BackupJob.REFUSED
+            plan.job.error = BackupError(msg)
+            refused.append(plan.job)
+
+    moved = [plan.job for plan in deferred]
+    jobs[:] = [job for job in jobs if job not in moved] + moved
+    return refused
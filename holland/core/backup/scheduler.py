@@ -0,0 +1,319 @@
+"""
+Schedule backupsets onto a pool of workers
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from holland.core.log import log_backupset
+from holland.core.spool import Backup
+from holland.core.util.path import getmount
+
+LOG = logging.getLogger(__name__)
+
+
+def resource_keys(config, path):
+    """
+    Derive the shared resources a backupset will use
+
+    Keys are of the form ``<kind>:<identity>``:
+
+      * ``mysql:<host>:<port>`` or ``mysql:<socket>`` from [mysql:client]
+      * ``pgsql:<host>:<port>`` from [pgauth]
+      * ``mount:<mountpoint>`` for the filesystem the backupset is spooled to
+
+    :param config: backupset config
+    :param path: spool directory of the backupset
+    :returns: list of resource keys
+    """
+    keys = []
+    client = config.get("mysql:client")
+    if client is not None:
+        host = client.get("host")
+        if host and host != "localhost":
+            keys.append("mysql:%s:%s" % (host, client.get("port") or 3306))
+        elif client.get("socket"):
+            keys.append("mysql:%s" % client.get("socket"))
+        else:
+            keys.append("mysql:localhost")
+    pgauth = config.get("pgauth")
+    if pgauth is not None:
+        keys.append(
+            "pgsql:%s:%s" % (pgauth.get("hostname") or "localhost", pgauth.get("port") or 5432)
+        )
+    keys.append("mount:%s" % getmount(path))
+    return keys
+
+
+def previous_duration(spool, name):
+    """
+    Return how long the newest backup of a backupset took, or 0 if unknown
+    """
+    path = os.path.join(spool.path, name, "newest")
+    if not os.path.exists(path):
+        return 0
+    try:
+        backup = Backup(path, name, "newest")
+        config = backup.config["holland:backup"]
+        return max(config["stop-time"] - config["start-time"], 0)
+    except Exception as exc:  # pylint: disable=broad-except
+        LOG.debug("Unable to read the previous backup of '%s': %s", name, exc)
+        return 0
+
+
+class ResourceLimits(object):
+    """
+    Per-resource concurrency limits
+
+    ``limits`` maps either a resource kind (``mysql``, ``pgsql``, ``mount``)
+    or a full resource key to the maximum number of backupsets that may use
+    it at once.  A limit of 0 means unlimited.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+
+    def limit(self, key):
+        """
+        Return the concurrency limit for a resource key
+        """
+        # config keys have had underscores canonicalized to dashes
+        for name in (key, key.replace("_", "-")):
+            if name in self.limits:
+                return int(self.limits[name])
+        return int(self.limits.get(key.split(":", 1)[0], 0))
+
+
+class BackupJob(object):
+    """
+    A single backupset queued for a backup run
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    # refused up front, e.g. by the disk space planner
+    REFUSED = "refused"
+
+    def __init__(self, name, config=None, error=None, resources=None, weight=0):
+        self.name = name
+        self.config = config
+        self.error = error
+        self.resources = list(resources or [])
+        self.weight = weight
+        # bytes the backupset was estimated at while planning the run
+        self.estimate = None
+        self.status = self.PENDING
+        if error is not None:
+            self.status = self.FAILED
+
+    @property
+    def failed(self):
+        """
+        True if this job did not complete successfully
+        """
+        return self.status in (self.FAILED, self.SKIPPED, self.REFUSED)
+
+    def __repr__(self):
+        return "BackupJob(%r, status=%r)" % (self.name, self.status)
+
+
+class BackupScheduler(object):
+    """
+    Run a list of BackupJobs with at most ``max_workers`` running at once
+
+    ``worker`` is called as ``worker(job)`` and should return True if the
+    backup succeeded and False otherwise.  When ``abort_on_failure`` is set,
+    no new jobs are started after the first failure; jobs already running are
+    always allowed to finish.  Jobs that were refused before the run started
+    are not counted as failures for this.  On an interrupt, the jobs not
+    started yet are skipped and the running ones are waited for, so they
+    release their locks, before the KeyboardInterrupt is raised.
+
+    When more than one worker is available, a job only starts once every
+    resource it uses is below its limit in ``limits``.  Among the jobs that
+    may start, those on the most oversubscribed resources go first, then the
+    ones that took longest last time, so the bottleneck is kept busy.
+    """
+
+    def __init__(self, worker, max_workers=1, abort_on_failure=False, limits=None):
+        if max_workers < 1:
+            raise ValueError("Invalid number of workers %s" % max_workers)
+        self.worker = worker
+        self.max_workers = max_workers
+        self.abort_on_failure = abort_on_failure
+        self.limits = limits or ResourceLimits()
+        self.aborted = False
+        self._in_use = {}
+
+    def _available(self, job):
+        """
+        Check that every resource of a job has spare capacity
+        """
+        for key in job.resources:
+            limit = self.limits.limit(key)
+            if limit and self._in_use.get(key, 0) >= limit:
+                return False
+        return True
+
+    def _acquire(self, job):
+        """
+        Mark the resources of a job as in use
+        """
+        for key in job.resources:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+    def _release(self, job):
+        """
+        Return the resources of a finished job
+        """
+        for key in job.resources:
+            self._in_use[key] -= 1
+
+    def _next_job(self, queue):
+        """
+        Pick the queued job to start next, or None if all are blocked
+        """
+        demand = {}
+        for job in queue:
+            for key in job.resources:
+                demand[key] = demand.get(key, 0) + 1
+
+        def pressure(job):
+            total = 0.0
+            for key in job.resources:
+                limit = self.limits.limit(key)
+                if limit:
+                    total += float(demand[key]) / limit
+            return total
+
+        candidates = [
+            job
+            for job in queue
+            if job.status in (BackupJob.FAILED, BackupJob.REFUSED) or self._available(job)
+        ]
+        if not candidates:
+            return None
+        # max() keeps the first of equal candidates, preserving the given order
+        job = max(candidates, key=lambda job: (pressure(job), job.weight))
+        queue.remove(job)
+        return job
+
+    def _finish(self, job, success):
+        """
+        Record the outcome of a job
+        """
+        if success:
+            job.status = BackupJob.COMPLETED
+        else:
+            job.status = BackupJob.FAILED
+            if self.abort_on_failure and not self.aborted:
+                LOG.error("Backupset '%s' failed. Not starting any new backupsets.", job.name)
+                self.aborted = True
+
+    def _start(self, job):
+        """
+        Check whether a job may be started
+        """
+        if job.status == BackupJob.REFUSED:
+            return False
+        if self.aborted:
+            job.status = BackupJob.SKIPPED
+            return False
+        if job.status == BackupJob.FAILED:
+            # the job could not even be queued (e.g. a broken config)
+            self._finish(job, False)
+            return False
+        job.status = BackupJob.RUNNING
+        return True
+
+    def _interrupt(self, queue):
+        """
+        Skip the jobs that were not started when the run was interrupted
+        """
+        LOG.error("Interrupted. Not starting any new backupsets.")
+        self.aborted = True
+        for job in queue:
+            if job.status == BackupJob.PENDING:
+                job.status = BackupJob.SKIPPED
+
+    def _run_job(self, job):
+        """
+        Run a job on a worker thread named, and logging, for its backupset
+        """
+        thread = threading.current_thread()
+        name = thread.name
+        thread.name = "holland-backup %s" % job.name
+        try:
+            with log_backupset(job.name):
+                return self.worker(job)
+        finally:
+            thread.name = name
+
+    def _collect(self, future, job):
+        """
+        Record the outcome of a finished job and return its resources
+        """
+        self._release(job)
+        try:
+            success = future.result()
+        except Exception as exc:
+            LOG.error("Backupset '%s' raised an error: %s", job.name, exc)
+            success = False
+        self._finish(job, success)
+
+    def run(self, jobs):
+        """
+        Run all jobs and return them with their final status
+        """
+        jobs = list(jobs)
+        if self.max_workers == 1:
+            # run inline so plugins that trap signals keep the main thread
+            for index, job in enumerate(jobs):
+                if self._start(job):
+                    try:
+                        success = self.worker(job)
+                    except KeyboardInterrupt:
+                        job.status = BackupJob.FAILED
+                        self._interrupt(jobs[index + 1 :])
+                        raise
+                    self._finish(job, success)
+            return jobs
+
+        queue = list(jobs)
+        running = {}
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="holland-backup"
+        ) as executor:
+            try:
+                while queue or running:
+                    while queue and len(running) < self.max_workers:
+                        job = self._next_job(queue)
+                        if job is None:
+                            break
+                        if not self._start(job):
+                            continue
+                        LOG.debug("Scheduling backupset '%s' using %s", job.name, job.resources)
+                        self._acquire(job)
+                        running[executor.submit(self._run_job, job)] = job
+                    if not running:
+                        continue
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._collect(future, running.pop(future))
+            except KeyboardInterrupt:
+                self._interrupt(queue)
+                for future, job in list(running.items()):
+                    if future.cancel():
+                        running.pop(future)
+                        self._release(job)
+                        job.status = BackupJob.SKIPPED
+                LOG.error("Waiting for %d running backupsets to stop", len(running))
+                for future in wait(list(running)).done:
+                    self._collect(future, running.pop(future))
+                raise
+        return jobs
@@ -0,0 +1,230 @@
+"""
+Index of the backups in a spool
+
+The catalog is a SQLite database at the root of the spool that records the
+metadata of each backup's backup.conf, so listing and purging backups does
+not need to parse every backup.conf.  The backup directories remain the
+source of truth: finished backups missing from the catalog are read from
+their backup.conf and added, and entries for backups that no longer exist
+are ignored.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+from urllib.parse import quote
+
+LOG = logging.getLogger(__name__)
+
+#: name of the catalog database at the root of a spool
+CATALOG_NAME = ".holland-catalog.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    name            TEXT PRIMARY KEY,
+    backupset       TEXT NOT NULL,
+    plugin          TEXT,
+    start_time      REAL,
+    stop_time       REAL,
+    estimated_size  REAL,
+    on_disk_size    REAL,
+    failed          INTEGER,
+    timings         TEXT
+)
+"""
+
+COLUMNS = (
+    "name",
+    "backupset",
+    "plugin",
+    "start_time",
+    "stop_time",
+    "estimated_size",
+    "on_disk_size",
+    "failed",
+    "timings",
+)
+
+
+class CatalogRecord(object):
+    """
+    Catalog entry for a single backup
+    """
+
+    def __init__(self, **kwargs):
+        for column in COLUMNS:
+            setattr(self, column, kwargs.get(column))
+        self.failed = bool(self.failed)
+        if isinstance(self.timings, str):
+            self.timings = json.loads(self.timings)
+        self.timings = self.timings or {}
+
+    @classmethod
+    def from_backup(cls, backup):
+        """
+        Create a record from a Backup's backup.conf
+        """
+        config = backup.config["holland:backup"]
+        return cls(
+            name=backup.name,
+            backupset=backup.backupset,
+            plugin=config["plugin"],
+            start_time=config["start-time"],
+            stop_time=config["stop-time"],
+            estimated_size=config["estimated-size"],
+            on_disk_size=config["on-disk-size"],
+            failed=config["failed"],
+            timings=dict(backup.config.get("holland:timings", {})),
+        )
+
+    def as_row(self):
+        """
+        Return this record as a tuple of COLUMNS
+        """
+        row = dict((column, getattr(self, column)) for column in COLUMNS)
+        row["failed"] = int(self.failed)
+        row["timings"] = json.dumps(self.timings)
+        return tuple(row[column] for column in COLUMNS)
+
+    def __repr__(self):
+        return "CatalogRecord(%r)" % self.name
+
+
+class SpoolCatalog(object):
+    """
+    SQLite catalog of the backups in a spool directory
+    """
+
+    def __init__(self, spool_path):
+        self.spool_path = spool_path
+        self.path = os.path.join(spool_path, CATALOG_NAME)
+        self._created = False
+
+    @classmethod
+    def for_backup(cls, backup):
+        """
+        Return the catalog of the spool a backup lives in
+        """
+        return cls(os.path.dirname(os.path.dirname(backup.path)))
+
+    def exists(self):
+        """
+        Check if this catalog has been created
+        """
+        return os.path.exists(self.path)
+
+    def _connect(self, readonly=False):
+        if readonly:
+            return sqlite3.connect("file:%s?mode=ro" % quote(self.path), timeout=60, uri=True)
+        # the table only has to be created once per catalog file
+        created = self._created and self.exists()
+        connection = sqlite3.connect(self.path, timeout=60)
+        if not created:
+            connection.execute(SCHEMA)
+            self._created = True
+        return connection
+
+    def update(self, backup):
+        """
+        Add or refresh the catalog entry for a backup from its backup.conf
+        """
+        self.add_records([CatalogRecord.from_backup(backup)])
+
+    def add_records(self, records, replace_all=False):
+        """
+        Add or replace catalog entries in a single transaction
+
+        :param replace_all: remove all other entries in the same transaction
+        """
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    if replace_all:
+                        connection.execute("DELETE FROM backups")
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO backups (%s) VALUES (%s)"
+                        % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                        [record.as_row() for record in records],
+                    )
+            finally:
+                connection.close()
+        except sqlite3.Error as exc:
+            LOG.warning("Failed to update backup catalog %s: %s", self.path, exc)
+            return False
+        return True
+
+    def remove(self, name):
+        """
+        Remove the catalog entry for a backup, if the catalog exists
+        """
+        if not self.exists():
+            return
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("DELETE FROM backups WHERE name = ?", (name,))
+            finally:
+                connection.close()
+        except sqlite3.Error as exc:
+            LOG.warning("Failed to update backup catalog %s: %s", self.path, exc)
+
+    def lookup(self, backupset=None):
+        """
+        Return the catalog entries, optionally only those of one backupset,
+        as a dict of backup name to CatalogRecord.  Returns an empty dict if
+        the catalog cannot be read.
+        """
+        if not self.exists():
+            return {}
+        query = "SELECT %s FROM backups" % ", ".join(COLUMNS)
+        args = ()
+        if backupset:
+            query += " WHERE backupset = ?"
+            args = (backupset,)
+        try:
+            connection = self._connect(readonly=True)
+            try:
+                rows = connection.execute(query, args).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as exc:
+            LOG.warning("Failed to read backup catalog %s: %s", self.path, exc)
+            return {}
+        return dict((row[0], CatalogRecord(**dict(zip(COLUMNS, row)))) for row in rows)
+
+    def records(self, backupset, readonly=False):
+        """
+        Return a CatalogRecord for each backup of a Backupset, oldest first
+
+        Backups missing from the catalog are read from their backup.conf.
+        Those that have finished are added to the catalog, unless readonly
+        is set; backups still running are read again every time.
+        """
+        known = self.lookup(backupset.name)
+        records = []
+        missing = []
+        for backup in backupset.list_backups() or []:
+            record = known.get(backup.name)
+            if record is None:
+                record = CatalogRecord.from_backup(backup)
+                if record.stop_time:
+                    missing.append(record)
+            records.append(record)
+        if missing and not readonly:
+            LOG.debug("Adding %d backups to the catalog %s", len(missing), self.path)
+            self.add_records(missing)
+        return records
+
+    def rebuild(self, spool):
+        """
+        Recreate the catalog by reading the backup.conf of every backup in
+        the spool
+
+        :returns: number of backups in the rebuilt catalog
+        """
+        records = [CatalogRecord.from_backup(backup) for backup in spool.list_backups()]
+        self.add_records(records, replace_all=True)
+        return len(records)
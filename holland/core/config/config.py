@@ -28,6 +28,14 @@ backup-directory    = string(default=/var/spool/holland)
 backupsets          = coerced_list(default=list())
 umask               = octal(default='007')
 path                = string(default=None)
+max-concurrent-backups = integer(min=1, default=1)
+plan-disk-space     = boolean(default=yes)
+
+[resource-limits]
+mysql               = integer(min=0, default=0)
+pgsql               = integer(min=0, default=0)
+mount               = integer(min=0, default=0)
+__many__            = integer(min=0)
 
 [logging]
 level               = logging_level(default='info')
@@ -2,13 +2,23 @@
 """
 
 import logging
+import threading
+from contextlib import contextmanager
 
-__all__ = ["clear_root_handlers", "setup_console_logging", "setup_file_logging"]
+__all__ = [
+    "clear_root_handlers",
+    "setup_console_logging",
+    "setup_file_logging",
+    "log_backupset",
+]
 
 DEFAULT_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S"
 DEFAULT_LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
 DEFAULT_LOG_LEVEL = logging.INFO
 
+# backupset each thread is logging for, set by log_backupset()
+_BACKUPSET = threading.local()
+
 
 class NullHandler(logging.Handler):
     """Send Log messages to Null"""
@@ -43,3 +53,33 @@ def setup_file_logging(filename, level=DEFAULT_LOG_LEVEL, msg_format=DEFAULT_LOG
     formatter = logging.Formatter(msg_format)
     handler.setFormatter(formatter)
     logging.getLogger().addHandler(handler)
+
+
+class BackupsetLogRecord(logging.LogRecord):
+    """Log record that names the backupset it was logged for, if any"""
+
+    def __init__(self, *args, **kwargs):
+        logging.LogRecord.__init__(self, *args, **kwargs)
+        self.backupset = getattr(_BACKUPSET, "name", None)
+
+    def getMessage(self):
+        message = logging.LogRecord.getMessage(self)
+        if self.backupset is None:
+            return message
+        return "[%s] %s" % (self.backupset, message)
+
+
+@contextmanager
+def log_backupset(name):
+    """Prefix the records logged by this thread with a backupset name
+
+    Used when backupsets run concurrently, so their log lines may be told
+    apart.
+    """
+    if logging.getLogRecordFactory() is logging.LogRecord:
+        logging.setLogRecordFactory(BackupsetLogRecord)
+    _BACKUPSET.name = name
+    try:
+        yield
+    finally:
+        _BACKUPSET.name = None
@@ -7,15 +7,24 @@ import itertools
 import logging
 import os
 import shutil
+import threading
 import time
 from string import Template
 from textwrap import dedent
 
+from holland.core.catalog import SpoolCatalog
 from holland.core.config import BaseConfig
-from holland.core.util.fmt import format_bytes, format_datetime
+from holland.core.util.fmt import format_bytes, format_datetime, format_interval
 
 LOG = logging.getLogger(__name__)
 
+#: Directory in each backupset where purged backups wait to be deleted
+TRASH_DIR = ".trash"
+
+#: trashed path -> thread deleting it
+_PURGE_THREADS = {}
+_PURGE_LOCK = threading.Lock()
+
 
 def timestamp_dir(when=None):
     """
@@ -27,6 +36,88 @@ def timestamp_dir(when=None):
     return time.strftime("%Y%m%d_%H%M%S", time.localtime(when))
 
 
+def _remove_tree(path):
+    """
+    Delete a directory tree and return the bytes of disk space it used
+    """
+    reclaimed = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            reclaimed += _remove_tree(entry.path)
+        else:
+            reclaimed += entry.stat(follow_symlinks=False).st_blocks * 512
+            os.unlink(entry.path)
+    os.rmdir(path)
+    return reclaimed
+
+
+def _delete_trash(path):
+    """
+    Delete a trashed backup and log the space reclaimed
+    """
+    start = time.time()
+    try:
+        reclaimed = _remove_tree(path)
+    except OSError as exc:
+        LOG.warning("Failed to delete purged backup %s: %s", path, exc)
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    LOG.info(
+        "Deleted purged backup %s: reclaimed %s in %s",
+        path,
+        format_bytes(reclaimed),
+        format_interval(time.time() - start) or "0 seconds",
+    )
+
+
+def discard(path):
+    """
+    Purge a backup directory without waiting for it to be deleted
+
+    The directory is atomically renamed into the TRASH_DIR of its backupset,
+    so it disappears from the spool at once, and then deleted by a
+    background thread.  Anything left in the trash by an earlier run is
+    deleted as well.  If the directory cannot be renamed it is deleted
+    inline.
+
+    Use wait_for_purges() when the space must be free before continuing.
+    """
+    trash = os.path.join(os.path.dirname(path), TRASH_DIR)
+    target = os.path.join(trash, "%s.%d.%d" % (os.path.basename(path), os.getpid(), time.time()))
+    try:
+        os.makedirs(trash, exist_ok=True)
+        os.rename(path, target)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT and not os.path.exists(path):
+            return
+        LOG.debug("Unable to move %s to %s (%s). Deleting inline.", path, trash, exc)
+        shutil.rmtree(path)
+        return
+
+    with _PURGE_LOCK:
+        for name, thread in list(_PURGE_THREADS.items()):
+            if not thread.is_alive():
+                del _PURGE_THREADS[name]
+        for name in os.listdir(trash):
+            trashed = os.path.join(trash, name)
+            if trashed in _PURGE_THREADS:
+                continue
+            # non-daemon, so deletion finishes before holland exits
+            thread = threading.Thread(target=_delete_trash, args=(trashed,))
+            thread.start()
+            _PURGE_THREADS[trashed] = thread
+
+
+def wait_for_purges():
+    """
+    Wait for backups purged in the background to be deleted
+    """
+    with _PURGE_LOCK:
+        threads = list(_PURGE_THREADS.values())
+    for thread in threads:
+        thread.join()
+
+
 class Spool(object):
     """
     A directory spool where backups are saved
@@ -34,6 +125,17 @@ class Spool(object):
 
     def __init__(self, path=None):
         self.path = path or "/var/spool/holland"
+        self._catalog = None
+
+    @property
+    def catalog(self):
+        """
+        The SpoolCatalog indexing the backups in this spool
+        """
+        # the spool path is only known once holland.conf has been read
+        if self._catalog is None or self._catalog.spool_path != self.path:
+            self._catalog = SpoolCatalog(self.path)
+        return self._catalog
 
     def find_backup(self, name):
         """
@@ -271,29 +373,53 @@ failed-backup-command   = string(default=None)
 historic-size           = boolean(default=yes)
 historic-size-factor    = float(default=1.5)
 historic-estimated-size-factor = float(default=1.1)
+historic-size-samples   = integer(min=1, default=5)
 create-symlinks     = boolean(default=yes)
 relative-symlinks     = boolean(default=no)
+
+[holland:timings]
+__many__                = float(min=0, default=0)
+
+[holland:streams]
+files                   = integer(min=0, default=0)
+bytes-in                = float(min=0, default=0)
+bytes-out               = float(min=0, default=0)
+wall-time               = float(min=0, default=0)
+cpu-time                = float(min=0, default=0)
 """.splitlines()
 
 
 class Backup(object):
     """
     Representation of a backup instance.
+
+    A Backup is a lightweight record of a backup directory.  Its backup.conf
+    is only read and validated the first time ``config`` is accessed, so
+    listing backups costs no more than a directory scan.
     """
 
+    __slots__ = ("path", "backupset", "name", "_config")
+
     def __init__(self, path, backupset, name):
         self.path = path
         self.backupset = backupset
         self.name = "/".join((backupset, name))
-        # Initialize an empty config
-        # This will not be loaded until load_config is called
-        config_path = os.path.join(self.path, "backup.conf")
-        self.config = BaseConfig({}, file_error=False)
-        self.config.filename = config_path
-        if os.path.exists(config_path):
-            self.load_config()
-        else:
-            self.validate_config()
+        self._config = None
+
+    @property
+    def config(self):
+        """
+        The backup.conf of this backup, loaded on first access.  If the
+        backup has no backup.conf yet an empty, validated config is used.
+        """
+        if self._config is None:
+            self._config = BaseConfig({}, file_error=False)
+            self._config.filename = os.path.join(self.path, "backup.conf")
+            if os.path.exists(self._config.filename):
+                self.load_config()
+            else:
+                self.validate_config()
+        return self._config
 
     def validate_config(self):
         """
@@ -305,19 +431,23 @@ class Backup(object):
         """
         (Re)Load the config for this backup.
         """
-        self.config.reload()
+        if self._config is None:
+            # the first access to config loads it
+            self.config  # pylint: disable=pointless-statement
+            return
+        self._config.reload()
         self.validate_config()
 
     def purge(self):
         """
         Purge the entire backup directory
+
+        The backup is removed from the spool immediately, but its files are
+        deleted in the background.  See wait_for_purges().
         """
         assert os.path.realpath(self.path) != "/"
-        try:
-            shutil.rmtree(self.path)
-        except OSError as exc:
-            if exc.errno != errno.ENOENT:
-                raise
+        discard(self.path)
+        SpoolCatalog.for_backup(self).remove(self.name)
 
     def exists(self):
         """
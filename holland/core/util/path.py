@@ -147,12 +147,32 @@ def disk_free(target_path):
     return info.f_frsize * info.f_bavail
 
 
-def directory_size(path):
+def disk_usage(path, known_sizes=None):
+    """
+    Find the disk space used by all files in a directory, recursively
+
+    Unlike directory_size() this counts the blocks allocated to each file,
+    which is the space that deleting the directory would free.
+
+    :param known_sizes: optional dict of absolute file path to size; files
+                        found in it are not stat'ed
+
+    Returns the size in input_bytes
+    """
+    return _scan_size(os.path.abspath(path), known_sizes or {}, allocated=True)
+
+
+def directory_size(path, known_sizes=None):
     """
     Find the size of all files in a directory, recursively
 
+    :param known_sizes: optional dict of absolute file path to size; files
+                        found in it are not stat'ed again
+
     Returns the size in input_bytes on success
     """
+    if known_sizes:
+        return _scan_size(os.path.abspath(path), known_sizes)
     result = 0
     for root, dirs, files in os.walk(path):
         for name in files:
@@ -164,3 +184,33 @@ def directory_size(path):
         for name in dirs:
             LOG.debug("Debug: Determining size of directory %s", os.path.join(root, name))
     return result
+
+
+def _scan_size(path, known_sizes, allocated=False):
+    """
+    Sum the size of all files in a directory, recursively, only stat'ing the
+    files missing from known_sizes
+
+    :param allocated: count the blocks allocated to each file, as
+                      disk_usage() does, rather than its size
+    """
+    result = 0
+    pending = [path]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.path in known_sizes:
+                    result += known_sizes[entry.path]
+                elif allocated:
+                    result += entry.stat(follow_symlinks=False).st_blocks * 512
+                elif entry.is_file():
+                    result += entry.stat().st_size
+            except OSError:
+                pass
+    return result
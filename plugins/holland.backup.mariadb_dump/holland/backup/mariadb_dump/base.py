@@ -3,6 +3,7 @@
 import errno
 import json
 import logging
+import os
 
 from holland.backup.mariadb_dump.command import ALL_DATABASES
 from holland.core.backup import BackupError
@@ -20,10 +21,16 @@ def start(
     compression_ext="",
     arg_per_database=None,
 ):
-    """Start a mariadb-dump backup"""
+    """Start a mariadb-dump backup
+
+    MANIFEST.txt is written once the dumps finish, so it names the files
+    as they were written, e.g. with the extension of the compression
+    method chosen for each one.
+    """
     if not schema and file_per_database:
         raise BackupError("file_per_database specified without a valid schema")
 
+    manifest = False
     if not schema:
         target_databases = ALL_DATABASES
     else:
@@ -35,52 +42,60 @@ def start(
             target_databases = ALL_DATABASES
         else:
             target_databases = [db for db in schema.databases if not db.excluded]
-            write_manifest(schema, open_stream, compression_ext)
-
-    if file_per_database:
-        arg_per_database = json.loads(arg_per_database) if arg_per_database else {}
-        flush_logs = "--flush-logs" in mariadb_dump.options
-        if flush_logs:
-            mariadb_dump.options.remove("--flush-logs")
-        for target_db in target_databases:
-            additional_options = [mariadb_dump_lock_option(lock_method, [target_db])]
-            # add --flush-logs only to the last database
-            if flush_logs and target_db == target_databases[-1]:
-                additional_options.append("--flush-logs")
-            db_name = encode(target_db.name)
-            if db_name != target_db.name:
-                LOG.warning(
-                    "Encoding file-name for database %s to %s", target_db.name, db_name
-                )
+            manifest = True
 
-            if db_name in arg_per_database:
-                additional_options.append(arg_per_database[db_name])
+    file_names = {}
+    try:
+        if file_per_database:
+            arg_per_database = json.loads(arg_per_database) if arg_per_database else {}
+            flush_logs = "--flush-logs" in mariadb_dump.options
+            if flush_logs:
+                mariadb_dump.options.remove("--flush-logs")
+            for target_db in target_databases:
+                additional_options = [mariadb_dump_lock_option(lock_method, [target_db])]
+                # add --flush-logs only to the last database
+                if flush_logs and target_db == target_databases[-1]:
+                    additional_options.append("--flush-logs")
+                db_name = encode(target_db.name)
+                if db_name != target_db.name:
+                    LOG.warning(
+                        "Encoding file-name for database %s to %s", target_db.name, db_name
+                    )
+
+                if db_name in arg_per_database:
+                    additional_options.append(arg_per_database[db_name])
+                file_names[target_db.name] = run_mariadb_dump(
+                    mariadb_dump,
+                    open_stream,
+                    f"{db_name}.sql",
+                    compression_ext,
+                    [target_db.name],
+                    additional_options,
+                )
+        else:
+            additional_options = [mariadb_dump_lock_option(lock_method, target_databases)]
+            if target_databases is not ALL_DATABASES:
+                target_databases = [db.name for db in target_databases]
             run_mariadb_dump(
                 mariadb_dump,
                 open_stream,
-                f"{db_name}.sql",
+                "all_databases.sql",
                 compression_ext,
-                [target_db.name],
+                target_databases,
                 additional_options,
             )
-    else:
-        additional_options = [mariadb_dump_lock_option(lock_method, target_databases)]
-        if target_databases is not ALL_DATABASES:
-            target_databases = [db.name for db in target_databases]
-        run_mariadb_dump(
-            mariadb_dump,
-            open_stream,
-            "all_databases.sql",
-            compression_ext,
-            target_databases,
-            additional_options,
-        )
+    finally:
+        if manifest:
+            write_manifest(schema, open_stream, compression_ext, file_names)
 
 
 def run_mariadb_dump(
     mariadb_dump, open_stream, filename, compression_ext, databases, additional_options
 ):
-    """Run a mariadb-dump backup"""
+    """Run a mariadb-dump backup
+
+    :returns: name of the file written, with its compression extension
+    """
     try:
         stream = open_stream(filename, "w")
     except (IOError, OSError) as exc:
@@ -96,10 +111,16 @@ def run_mariadb_dump(
             if exc.errno != errno.EPIPE:
                 LOG.error("%s", str(exc))
                 raise BackupError(str(exc))
+    return os.path.basename(stream.name)
+
 
+def write_manifest(schema, open_stream, ext, file_names=None):
+    """Write real database names => encoded names to MANIFEST.txt
 
-def write_manifest(schema, open_stream, ext):
-    """Write real database names => encoded names to MANIFEST.txt"""
+    file_names maps database names to the files they were dumped to.  Other
+    databases are listed as <encoded name>.sql with ext.
+    """
+    file_names = file_names or {}
     manifest_fileobj = open_stream("MANIFEST.txt", "w", method="none")
 
     try:
@@ -107,8 +128,8 @@ def write_manifest(schema, open_stream, ext):
             if database.excluded:
                 continue
             name = database.name
-            encoded_name = encode(name)
-            line = "%s %s\n" % (name, encoded_name + ".sql" + ext)
+            file_name = file_names.get(name) or encode(name) + ".sql" + ext
+            line = "%s %s\n" % (name, file_name)
             manifest_fileobj.write(line)
     finally:
         manifest_fileobj.close()
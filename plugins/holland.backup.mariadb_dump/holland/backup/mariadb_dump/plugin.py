@@ -12,6 +12,7 @@ from holland.core.backup import BackupError
 from holland.lib.common.compression import (
     COMPRESSION_CONFIG_STRING,
     lookup_compression,
+    lookup_stages,
     open_stream,
 )
 from holland.lib.mysql import (
@@ -246,12 +247,21 @@ class MariaDBDumpPlugin(object):
 
         os.mkdir(os.path.join(self.target_directory, "backup_data"))
 
-        if (
+        if self.config["compression"]["method"] == "auto":
+            LOG.info(
+                "Choosing compression for each file from %s",
+                ", ".join(self.config["compression"]["auto-candidates"]),
+            )
+            # the extension depends on the method chosen for each file
+            ext = ""
+        elif (
             self.config["compression"]["method"] != "none"
             and self.config["compression"]["level"] > 0
         ):
             try:
-                _, ext = lookup_compression(self.config["compression"]["method"])
+                _, ext = lookup_compression(
+                    self.config["compression"]["method"], self.config["compression"]["engine"]
+                )
             except OSError as exc:
                 raise BackupError(
                     "Unable to load compression method '%s': %s"
@@ -267,6 +277,14 @@ class MariaDBDumpPlugin(object):
             LOG.info("Not compressing mariadb-dump output")
             ext = ""
 
+        if self.config["compression"]["stages"]:
+            try:
+                _, stages_ext = lookup_stages(self.config["compression"]["stages"])
+            except (OSError, BackupError) as exc:
+                raise BackupError("Unable to load compression stages: %s" % exc)
+            LOG.info("Piping output through %s", " | ".join(self.config["compression"]["stages"]))
+            ext += stages_ext
+
         try:
             start(
                 mariadb_dump=mariadb_dump,
@@ -288,6 +306,8 @@ class MariaDBDumpPlugin(object):
         config = deepcopy(self.config["compression"])
         if method:
             config["method"] = method
+            # e.g. the MANIFEST.txt, which is left readable
+            config["stages"] = []
         stream = open_stream(path, mode, **config)
         return stream
 
@@ -3,13 +3,21 @@
 import errno
 import json
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from holland.backup.mysqldump.command import ALL_DATABASES
+from holland.backup.mysqldump.command import ALL_DATABASES, MySQLDumpError
 from holland.core.backup import BackupError
+from holland.core.backup.ledger import STREAMS_FILE
+from holland.core.util.fmt import format_bytes
 from holland.lib.common.safefilename import encode
 
 LOG = logging.getLogger(__name__)
 
+#: Locking options of mysqldump runs that may run at the same time
+PARALLEL_LOCK_OPTIONS = ("--single-transaction", "--skip-lock-tables")
+
 
 def start(
     mysqldump,
@@ -19,11 +27,19 @@ def start(
     open_stream=open,
     compression_ext="",
     arg_per_database=None,
+    dump_threads=1,
+    database_sizes=None,
 ):
-    """Run a mysqldump backup"""
+    """Run a mysqldump backup
+
+    MANIFEST.txt is written once the dumps finish, so it names the files
+    as they were written, e.g. with the extension of the compression
+    method chosen for each one.
+    """
     if not schema and file_per_database:
         raise BackupError("file_per_database specified without a valid schema")
 
+    manifest = False
     if not schema:
         target_databases = ALL_DATABASES
     else:
@@ -35,34 +51,37 @@ def start(
             target_databases = ALL_DATABASES
         else:
             target_databases = [db for db in schema.databases if not db.excluded]
-            write_manifest(schema, open_stream, compression_ext)
-
-    if file_per_database:
-        if arg_per_database:
-            arg_per_database = json.loads(arg_per_database)
-        flush_logs = "--flush-logs" in mysqldump.options
-        if flush_logs:
-            mysqldump.options.remove("--flush-logs")
-        last = len(target_databases)
-        for count, target_db in enumerate(target_databases):
-            more_options = [mysqldump_lock_option(lock_method, [target_db])]
-            # add --flush-logs only to the last mysqldump run
-            if flush_logs and count == last:
-                more_options.append("--flush-logs")
-            db_name = encode(target_db.name)
-            if db_name != target_db.name:
-                LOG.warning("Encoding file-name for database %s to %s", target_db.name, db_name)
+            manifest = True
+
+    file_names = {}
+    try:
+        if file_per_database:
+            if arg_per_database:
+                arg_per_database = json.loads(arg_per_database)
+            dump_databases(
+                mysqldump,
+                target_databases,
+                lock_method,
+                open_stream,
+                compression_ext,
+                arg_per_database or {},
+                dump_threads,
+                database_sizes,
+                file_names,
+            )
+        else:
+            more_options = [mysqldump_lock_option(lock_method, target_databases)]
             try:
-                stream = open_stream("%s.sql" % db_name, "w")
+                stream = open_stream("all_databases.sql", "w")
             except (IOError, OSError) as exc:
                 raise BackupError(
                     "Failed to open output stream %s: %s"
-                    % (db_name + ".sql" + compression_ext, str(exc))
+                    % ("all_databases.sql" + compression_ext, exc)
                 )
             try:
-                if db_name in arg_per_database:
-                    more_options.append(arg_per_database[db_name])
-                mysqldump.run([target_db.name], stream, more_options)
+                if target_databases is not ALL_DATABASES:
+                    target_databases = [db.name for db in target_databases]
+                mysqldump.run(target_databases, stream, more_options)
             finally:
                 try:
                     stream.close()
@@ -70,29 +89,212 @@ def start(
                     if exc.errno != errno.EPIPE:
                         LOG.error("%s", str(exc))
                         raise BackupError(str(exc))
-    else:
-        more_options = [mysqldump_lock_option(lock_method, target_databases)]
+    finally:
+        if manifest:
+            write_manifest(schema, open_stream, compression_ext, file_names)
+
+
+def dump_database(mysqldump, target_db, open_stream, compression_ext, more_options):
+    """Dump a single database to <encoded name>.sql
+
+    :returns: name of the file written, with its compression extension
+    """
+    db_name = encode(target_db.name)
+    if db_name != target_db.name:
+        LOG.warning("Encoding file-name for database %s to %s", target_db.name, db_name)
+    try:
+        stream = open_stream("%s.sql" % db_name, "w")
+    except (IOError, OSError) as exc:
+        raise BackupError(
+            "Failed to open output stream %s: %s" % (db_name + ".sql" + compression_ext, str(exc))
+        )
+    try:
+        mysqldump.run([target_db.name], stream, more_options)
+    finally:
         try:
-            stream = open_stream("all_databases.sql", "w")
+            stream.close()
         except (IOError, OSError) as exc:
-            raise BackupError(
-                "Failed to open output stream %s: %s" % ("all_databases.sql" + compression_ext, exc)
+            if exc.errno != errno.EPIPE:
+                LOG.error("%s", str(exc))
+                raise BackupError(str(exc))
+    return os.path.basename(stream.name)
+
+
+def dump_databases(
+    mysqldump,
+    target_databases,
+    lock_method,
+    open_stream,
+    compression_ext="",
+    arg_per_database=None,
+    dump_threads=1,
+    database_sizes=None,
+    file_names=None,
+):
+    """Run one mysqldump per database, up to dump_threads at a time
+
+    Concurrent dumps are only consistent when each one runs in its own
+    transaction or without locks, so with any other lock method the
+    databases are dumped one after another.  With database_sizes, a dict
+    of database name to its size, concurrent dumps start with the largest
+    database so the longest dumps do not end up running last.  --flush-logs
+    is only passed to the dump of the last database, which is started once
+    all the other dumps have finished.  With one thread, the first database
+    that fails to dump stops the backup.  Concurrent dumps carry on, and all
+    failures are reported together at the end.  The name of each file
+    written is added to file_names, a dict keyed by database name.
+    """
+    if file_names is None:
+        file_names = {}
+    arg_per_database = arg_per_database or {}
+    flush_logs = "--flush-logs" in mysqldump.options
+    if flush_logs:
+        mysqldump.options.remove("--flush-logs")
+
+    jobs = []
+    for target_db in target_databases:
+        more_options = [mysqldump_lock_option(lock_method, [target_db])]
+        if encode(target_db.name) in arg_per_database:
+            more_options.append(arg_per_database[encode(target_db.name)])
+        jobs.append((target_db, more_options))
+
+    if dump_threads > 1:
+        locking = set(options[0] for _, options in jobs) - set(PARALLEL_LOCK_OPTIONS)
+        if locking:
+            LOG.warning(
+                "Dumping databases one at a time, as %s cannot be used with dump-threads",
+                ", ".join(sorted(locking)),
             )
+            dump_threads = 1
+
+    if dump_threads > 1 and database_sizes:
+        # longest processing time first
+        jobs.sort(key=lambda job: database_sizes.get(job[0].name) or 0, reverse=True)
+        LOG.info(
+            "Dumping databases largest first: %s",
+            ", ".join(
+                "%s (%s)" % (target_db.name, format_bytes(database_sizes.get(target_db.name) or 0))
+                for target_db, _ in jobs
+            ),
+        )
+
+    final = None
+    if flush_logs and jobs:
+        # add --flush-logs only to the last mysqldump run
+        final = jobs.pop()
+        final[1].append("--flush-logs")
+
+    failures = []
+    started = time.time()
+
+    def run(job):
+        target_db, more_options = job
+        offset = time.time() - started
         try:
-            if target_databases is not ALL_DATABASES:
-                target_databases = [db.name for db in target_databases]
-            mysqldump.run(target_databases, stream, more_options)
-        finally:
-            try:
-                stream.close()
-            except (IOError, OSError) as exc:
-                if exc.errno != errno.EPIPE:
-                    LOG.error("%s", str(exc))
-                    raise BackupError(str(exc))
+            file_names[target_db.name] = dump_database(
+                mysqldump, target_db, open_stream, compression_ext, more_options
+            )
+        except (BackupError, MySQLDumpError) as exc:
+            LOG.error(
+                "Failed to dump database %s from +%.1fs to +%.1fs: %s",
+                target_db.name,
+                offset,
+                time.time() - started,
+                exc,
+            )
+            if dump_threads == 1:
+                raise
+            failures.append((target_db.name, exc))
+            return
+        LOG.info(
+            "Dumped database %s from +%.1fs to +%.1fs",
+            target_db.name,
+            offset,
+            time.time() - started,
+        )
+
+    if dump_threads > 1:
+        LOG.info("Dumping %d databases with %d threads", len(jobs), dump_threads)
+        with ThreadPoolExecutor(max_workers=dump_threads) as pool:
+            list(pool.map(run, jobs))
+    else:
+        for job in jobs:
+            run(job)
+    if final:
+        run(final)
+
+    if failures:
+        raise BackupError(
+            "Failed to dump %d of %d databases: %s"
+            % (
+                len(failures),
+                len(target_databases),
+                "; ".join("%s: %s" % (name, exc) for name, exc in failures),
+            )
+        )
+
+
+def previous_dump_sizes(backup_directory, databases):
+    """Find the size of each database's dump in the newest earlier backup
+
+    The uncompressed size recorded in that backup's streams.json is used
+    where it is available, and otherwise the size of the dump files.
+
+    :param backup_directory: directory of the backup being run
+    :param databases: names of the databases to look up
+    :returns: dict of database name to size, empty if there is no earlier
+              backup with per-database dumps
+    """
+    backupset_directory, current = os.path.split(backup_directory.rstrip(os.sep))
+    try:
+        names = os.listdir(backupset_directory)
+    except OSError:
+        return {}
+    for name in sorted(names, reverse=True):
+        path = os.path.join(backupset_directory, name)
+        data_path = os.path.join(path, "backup_data")
+        # the newest and oldest symlinks sort after the timestamps
+        if name >= current or os.path.islink(path) or not os.path.isdir(data_path):
+            continue
+        streams = {}
+        try:
+            with open(os.path.join(path, STREAMS_FILE), "r") as fileobj:
+                streams = json.load(fileobj)
+        except (IOError, OSError, ValueError):
+            pass
+        files = os.listdir(data_path)
+        sizes = {}
+        for database in databases:
+            dump_name = encode(database) + ".sql"
+            matches = [
+                filename
+                for filename in files
+                if filename == dump_name or filename.startswith(dump_name + ".")
+            ]
+            recorded = [
+                streams[key]["bytes-in"]
+                for key in (os.path.join("backup_data", filename) for filename in matches)
+                if key in streams
+            ]
+            if recorded:
+                sizes[database] = sum(recorded)
+            elif matches:
+                sizes[database] = sum(
+                    os.path.getsize(os.path.join(data_path, filename)) for filename in matches
+                )
+        if sizes:
+            LOG.info("Using the database dump sizes of the previous backup %s", path)
+            return sizes
+    return {}
+
 
+def write_manifest(schema, open_stream, ext, file_names=None):
+    """Write real database names => encoded names to MANIFEST.txt
 
-def write_manifest(schema, open_stream, ext):
-    """Write real database names => encoded names to MANIFEST.txt"""
+    file_names maps database names to the files they were dumped to.  Other
+    databases are listed as <encoded name>.sql with ext.
+    """
+    file_names = file_names or {}
     manifest_fileobj = open_stream("MANIFEST.txt", "w", method="none")
 
     try:
@@ -100,8 +302,8 @@ def write_manifest(schema, open_stream, ext):
             if database.excluded:
                 continue
             name = database.name
-            encoded_name = encode(name)
-            line = "%s %s\n" % (name, encoded_name + ".sql" + ext)
+            file_name = file_names.get(name) or encode(name) + ".sql" + ext
+            line = "%s %s\n" % (name, file_name)
             manifest_fileobj.write(line)
     finally:
         manifest_fileobj.close()
@@ -6,13 +6,14 @@ import os
 import textwrap
 from copy import deepcopy
 
-from holland.backup.mysqldump.base import start
+from holland.backup.mysqldump.base import previous_dump_sizes, start
 from holland.backup.mysqldump.command import MyOptionError, MySQLDump, MySQLDumpError
 from holland.backup.mysqldump.mock import MockEnvironment
 from holland.core.backup import BackupError
 from holland.lib.common.compression import (
     COMPRESSION_CONFIG_STRING,
     lookup_compression,
+    lookup_stages,
     open_stream,
 )
 from holland.lib.mysql import (
@@ -62,6 +63,7 @@ max-allowed-packet  = string(default=128M)
 bin-log-position    = boolean(default=no)
 
 file-per-database   = boolean(default=yes)
+dump-threads        = integer(min=1, default=1)
 #arg-per-database is only used if file-per-database is true
 ## takes a json object {"table1": "--arg", "table2": "--arg"}
 arg-per-database    = string(default={})
@@ -239,14 +241,43 @@ class MySQLDumpPlugin(object):
         options = collect_mysqldump_options(config, mysqldump, self.client)
         validate_mysqldump_options(mysqldump, options)
 
+        if config["dump-threads"] > 1:
+            if not config["file-per-database"]:
+                LOG.warning("dump-threads is only used with file-per-database = yes")
+            elif config["lock-method"] in ("flush-lock", "lock-tables"):
+                raise BackupError(
+                    "dump-threads = %d cannot be used with lock-method = %s. Use "
+                    "single-transaction or none." % (config["dump-threads"], config["lock-method"])
+                )
+
+        database_sizes = None
+        if config["dump-threads"] > 1 and config["file-per-database"]:
+            database_sizes = dict(
+                (database.name, database.size)
+                for database in self.schema.databases
+                if not database.excluded
+            )
+            if not any(database_sizes.values()):
+                # the schema was read without table sizes
+                database_sizes = previous_dump_sizes(self.target_directory, list(database_sizes))
+
         os.mkdir(os.path.join(self.target_directory, "backup_data"))
 
-        if (
+        if self.config["compression"]["method"] == "auto":
+            LOG.info(
+                "Choosing compression for each file from %s",
+                ", ".join(self.config["compression"]["auto-candidates"]),
+            )
+            # the extension depends on the method chosen for each file
+            ext = ""
+        elif (
             self.config["compression"]["method"] != "none"
             and self.config["compression"]["level"] > 0
         ):
             try:
-                _, ext = lookup_compression(self.config["compression"]["method"])
+                _, ext = lookup_compression(
+                    self.config["compression"]["method"], self.config["compression"]["engine"]
+                )
             except OSError as exc:
                 raise BackupError(
                     "Unable to load compression method '%s': %s"
@@ -262,6 +293,14 @@ class MySQLDumpPlugin(object):
             LOG.info("Not compressing mysqldump output")
             ext = ""
 
+        if self.config["compression"]["stages"]:
+            try:
+                _, stages_ext = lookup_stages(self.config["compression"]["stages"])
+            except (OSError, BackupError) as exc:
+                raise BackupError("Unable to load compression stages: %s" % exc)
+            LOG.info("Piping output through %s", " | ".join(self.config["compression"]["stages"]))
+            ext += stages_ext
+
         try:
             start(
                 mysqldump=mysqldump,
@@ -271,6 +310,8 @@ class MySQLDumpPlugin(object):
                 open_stream=self._open_stream,
                 compression_ext=ext,
                 arg_per_database=config["arg-per-database"],
+                dump_threads=config["dump-threads"],
+                database_sizes=database_sizes,
             )
         except MySQLDumpError as exc:
             raise BackupError(str(exc))
@@ -283,6 +324,8 @@ class MySQLDumpPlugin(object):
         config = deepcopy(self.config["compression"])
         if method:
             config["method"] = method
+            # e.g. the MANIFEST.txt, which is left readable
+            config["stages"] = []
         stream = open_stream(path, mode, **config)
         return stream
 
@@ -0,0 +1,5 @@
+"""Setup Module"""
+
+from holland.backup.mysqldump_native.plugin import CONFIGSPEC, MySQLDumpNativePlugin
+
+Provider = MySQLDumpNativePlugin
@@ -0,0 +1,603 @@
+"""
+Dump MySQL tables over several connections that share one snapshot
+
+Every connection starts a transaction WITH CONSISTENT SNAPSHOT while a
+global read lock is held, so all of them read the same point in time and
+tables may be dumped in parallel once the lock is released.
+"""
+
+import logging
+import math
+import queue
+import threading
+import time
+
+import pymysql.cursors
+
+from holland.core.backup import BackupError
+from holland.core.util.fmt import format_bytes
+from holland.lib.common.safefilename import encode
+from holland.lib.mysql import MySQLError
+
+LOG = logging.getLogger(__name__)
+
+#: Integer types a table may be split by.  Other primary keys are dumped whole.
+SPLIT_TYPES = ("tinyint", "smallint", "mediumint", "int", "bigint")
+
+#: Words in INFORMATION_SCHEMA.COLUMNS.EXTRA of columns the server generates
+GENERATED_EXTRA = ("VIRTUAL", "STORED", "PERSISTENT")
+
+#: Statements at the start of every file, so each one may be restored alone
+FILE_HEADER = (
+    "/*!40101 SET NAMES utf8mb4 */;\n"
+    "/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;\n"
+    "/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;\n"
+    "/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;\n"
+    "/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE, TIME_ZONE='+00:00' */;\n"
+)
+
+FILE_FOOTER = (
+    "/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;\n"
+    "/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;\n"
+    "/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;\n"
+    "/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;\n"
+)
+
+
+def quote_name(name):
+    """
+    Quote a database, table or column name
+    """
+    return "`%s`" % name.replace("`", "``")
+
+
+def _sql(text):
+    # binary strings are escaped into str as latin1 surrogates by pymysql
+    return text.encode("utf-8", "surrogateescape")
+
+
+def _column_list(columns):
+    return ", ".join([quote_name(column) for column in columns])
+
+
+class TableChunk(object):
+    """
+    Rows of a table, or of a range of its primary key, dumped to one file
+
+    If columns is given, only those columns are selected and inserted,
+    e.g. to leave out generated columns.
+    """
+
+    def __init__(self, table, path, where=None, size=0, columns=None):
+        self.table = table
+        self.path = path
+        self.where = where
+        #: estimated bytes of data, used to dump the largest chunks first
+        self.size = size
+        self.columns = columns
+        self.rows = 0
+        self.bytes = 0
+
+    def select(self):
+        """
+        SELECT statement that reads the rows of this chunk
+        """
+        sql = "SELECT /*!40001 SQL_NO_CACHE */ %s FROM %s.%s" % (
+            _column_list(self.columns) if self.columns else "*",
+            quote_name(self.table.database),
+            quote_name(self.table.name),
+        )
+        if self.where:
+            sql += " WHERE " + self.where
+        return sql
+
+    def insert(self):
+        """
+        Start of the INSERT statements that restore the rows of this chunk
+        """
+        if self.columns:
+            return "INSERT INTO %s (%s) VALUES " % (
+                quote_name(self.table.name),
+                _column_list(self.columns),
+            )
+        return "INSERT INTO %s VALUES " % quote_name(self.table.name)
+
+    def __str__(self):
+        name = "%s.%s" % (self.table.database, self.table.name)
+        if self.where:
+            name += " (%s)" % self.where
+        return name
+
+
+def open_snapshot(lock_client, connections, bin_log_position=False):
+    """
+    Start a transaction with a consistent snapshot on each connection
+
+    lock_client holds FLUSH TABLES WITH READ LOCK until every snapshot has
+    started, so no write is committed between the first and the last.
+
+    Each connection reads in UTC first, so TIMESTAMP values are dumped in
+    the time zone FILE_HEADER restores them in, as mysqldump --tz-utc does.
+
+    :returns: SHOW MASTER STATUS as of the snapshot, if bin_log_position is set
+    """
+    master_status = None
+    for connection in connections:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("/*!40103 SET TIME_ZONE='+00:00' */")
+        finally:
+            cursor.close()
+    started = time.time()
+    lock_client.flush_tables_with_read_lock()
+    try:
+        for connection in connections:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("START TRANSACTION /*!40108 WITH CONSISTENT SNAPSHOT */")
+            finally:
+                cursor.close()
+        if bin_log_position:
+            master_status = lock_client.show_master_status()
+    finally:
+        lock_client.unlock_tables()
+    LOG.info(
+        "Started %d consistent snapshots under a global read lock held for %.2f seconds",
+        len(connections),
+        time.time() - started,
+    )
+    return master_status
+
+
+def split_ranges(low, high, count):
+    """
+    Split the integer range low..high into at most count (start, end) ranges
+
+    The start of the first range and the end of the last one are None, so
+    values outside of low..high still fall in a range.
+
+    >>> split_ranges(1, 100, 2)
+    [(None, 51), (51, None)]
+    """
+    count = max(1, min(count, high - low + 1))
+    step = (high - low + 1) / float(count)
+    bounds = [None] + [low + int(math.ceil(step * index)) for index in range(1, count)] + [None]
+    return list(zip(bounds, bounds[1:]))
+
+
+def range_condition(column, start, end):
+    """
+    WHERE condition selecting start <= column < end, or None for all rows
+    """
+    conditions = []
+    if start is not None:
+        conditions.append("%s >= %d" % (quote_name(column), start))
+    if end is not None:
+        conditions.append("%s < %d" % (quote_name(column), end))
+    return " AND ".join(conditions) or None
+
+
+def _split_column(connection, table):
+    """
+    Return the name of the primary key of table if it is a single integer
+    column, otherwise None
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT k.COLUMN_NAME, c.DATA_TYPE "
+            "FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE k "
+            "JOIN INFORMATION_SCHEMA.COLUMNS c "
+            "ON c.TABLE_SCHEMA = k.TABLE_SCHEMA AND c.TABLE_NAME = k.TABLE_NAME "
+            "AND c.COLUMN_NAME = k.COLUMN_NAME "
+            "WHERE k.TABLE_SCHEMA = %s AND k.TABLE_NAME = %s "
+            "AND k.CONSTRAINT_NAME = 'PRIMARY'",
+            (table.database, table.name),
+        )
+        columns = cursor.fetchall()
+    finally:
+        cursor.close()
+    if len(columns) != 1 or columns[0][1].lower() not in SPLIT_TYPES:
+        return None
+    return columns[0][0]
+
+
+def _is_generated(extra):
+    extra = (extra or "").upper()
+    return any(word in extra for word in GENERATED_EXTRA)
+
+
+def insert_columns(connection, tables):
+    """
+    Find the columns to dump of the tables that have generated columns
+
+    The server computes the values of generated columns and refuses INSERTs
+    that set them, so the rows of these tables are selected and inserted by
+    naming every other column.  Other tables are dumped with SELECT *.
+
+    :param tables: list of Table being dumped
+    :returns: dict of (database, table name) to list of column names
+    """
+    dumped = set([(table.database, table.name) for table in tables])
+    columns = {}
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT DISTINCT TABLE_SCHEMA, TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+            "WHERE EXTRA LIKE '%VIRTUAL%' OR EXTRA LIKE '%STORED%' "
+            "OR EXTRA LIKE '%PERSISTENT%'"
+        )
+        generated = set([tuple(row) for row in cursor.fetchall()]) & dumped
+        for database, name in sorted(generated):
+            cursor.execute(
+                "SELECT COLUMN_NAME, EXTRA FROM INFORMATION_SCHEMA.COLUMNS "
+                "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION",
+                (database, name),
+            )
+            columns[(database, name)] = [
+                column for column, extra in cursor.fetchall() if not _is_generated(extra)
+            ]
+            LOG.debug("Not dumping the generated columns of %s.%s", database, name)
+    finally:
+        cursor.close()
+    return columns
+
+
+def plan_table(connection, table, path, chunk_size, columns=None):
+    """
+    Split a table into chunks of about chunk_size bytes of data by ranges of
+    its primary key
+
+    Tables without a single integer primary key are dumped in one chunk.
+    The key range is read inside the snapshot, so it matches the dump.
+
+    :param columns: columns to dump, if not every column (see insert_columns)
+    :returns: list of TableChunk
+    """
+    count = int(math.ceil(table.data_size / float(chunk_size))) if chunk_size else 1
+    column = _split_column(connection, table) if count > 1 else None
+    if column is None:
+        return [TableChunk(table, path + ".sql", size=table.data_size, columns=columns)]
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT MIN(%s), MAX(%s) FROM %s.%s"
+            % (
+                quote_name(column),
+                quote_name(column),
+                quote_name(table.database),
+                quote_name(table.name),
+            )
+        )
+        low, high = cursor.fetchone()
+    finally:
+        cursor.close()
+    if low is None:
+        return [TableChunk(table, path + ".sql", columns=columns)]
+    ranges = split_ranges(low, high, count)
+    LOG.info(
+        "Splitting %s.%s (%s) into %d chunks by %s",
+        table.database,
+        table.name,
+        format_bytes(table.data_size),
+        len(ranges),
+        column,
+    )
+    return [
+        TableChunk(
+            table,
+            "%s.%05d.sql" % (path, index),
+            where=range_condition(column, start, end),
+            size=table.data_size // len(ranges),
+            columns=columns,
+        )
+        for index, (start, end) in enumerate(ranges)
+    ]
+
+
+def show_create(client, kind, database, name):
+    """
+    Read the definition of a trigger, procedure, function or event
+
+    :param kind: 'TRIGGER', 'PROCEDURE', 'FUNCTION' or 'EVENT'
+    :returns: tuple of the CREATE statement, its sql_mode and its time_zone
+              (None but for events), or None if the server did not show the
+              statement, e.g. to a user without the privileges to see it
+    """
+    cursor = client.cursor()
+    try:
+        cursor.execute("SHOW CREATE %s %s.%s" % (kind, quote_name(database), quote_name(name)))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if row is None:
+        return None
+    if kind == "EVENT":
+        statement, time_zone = row[3], row[2]
+    else:
+        statement, time_zone = row[2], None
+    if not statement:
+        return None
+    return statement, row[1], time_zone
+
+
+def _select_names(client, sql, database):
+    cursor = client.cursor()
+    try:
+        cursor.execute(sql, (database,))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _write_object(client, stream, kind, database, name):
+    """
+    Write the DROP and CREATE statements of a trigger, routine or event, in
+    the sql_mode (and time_zone) it was created with
+    """
+    definition = show_create(client, kind, database, name)
+    if definition is None:
+        LOG.warning(
+            "Skipping %s %s.%s, as the server did not show its definition. "
+            "The backup user may lack the privileges to read it.",
+            kind.lower(),
+            database,
+            name,
+        )
+        return
+    statement, sql_mode, time_zone = definition
+    lines = ["DROP %s IF EXISTS %s;" % (kind, quote_name(name)), "DELIMITER ;;"]
+    if time_zone:
+        # not @OLD_TIME_ZONE, which FILE_FOOTER restores
+        lines.append("SET @SAVED_TIME_ZONE=@@TIME_ZONE, TIME_ZONE=%s;;" % client.literal(time_zone))
+    lines.append("SET SQL_MODE=%s;;" % client.literal(sql_mode))
+    lines.append("%s ;;" % statement)
+    if time_zone:
+        lines.append("SET TIME_ZONE=@SAVED_TIME_ZONE;;")
+    lines.append("DELIMITER ;")
+    stream.write(_sql("\n".join(lines) + "\n\n"))
+
+
+def write_schema(client, database, tables, stream, routines=True):
+    """
+    Write the CREATE statements of a database's tables, then of its stored
+    procedures and functions if routines is set
+
+    Views, triggers and events are left to write_post_data().
+    """
+    stream.write(_sql(FILE_HEADER))
+    stream.write(
+        _sql(
+            "CREATE DATABASE /*!32312 IF NOT EXISTS*/ %s;\nUSE %s;\n\n"
+            % (quote_name(database), quote_name(database))
+        )
+    )
+    for table in tables:
+        ddl = client.show_create_table(table.database, table.name)
+        stream.write(_sql("DROP TABLE IF EXISTS %s;\n%s;\n\n" % (quote_name(table.name), ddl)))
+    if routines:
+        for kind, name in _select_names(
+            client,
+            "SELECT ROUTINE_TYPE, ROUTINE_NAME FROM INFORMATION_SCHEMA.ROUTINES "
+            "WHERE ROUTINE_SCHEMA = %s ORDER BY ROUTINE_TYPE, ROUTINE_NAME",
+            database,
+        ):
+            if kind not in ("PROCEDURE", "FUNCTION"):
+                LOG.warning("Skipping %s %s.%s, which cannot be dumped", kind, database, name)
+                continue
+            _write_object(client, stream, kind, database, name)
+    stream.write(_sql(FILE_FOOTER))
+
+
+def _view_columns(client, database, names):
+    """
+    Return the column names of the views of a database, as a dict of view
+    name to list
+    """
+    cursor = client.cursor()
+    try:
+        cursor.execute(
+            "SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+            "WHERE TABLE_SCHEMA = %s AND TABLE_NAME IN ("
+            + ", ".join(["%s"] * len(names))
+            + ") ORDER BY TABLE_NAME, ORDINAL_POSITION",
+            [database] + list(names),
+        )
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    columns = {}
+    for name, column in rows:
+        columns.setdefault(name, []).append(column)
+    return columns
+
+
+def write_post_data(client, databases, tables, views, stream, events=True):
+    """
+    Write the statements restored after every table of every database has
+    been created and loaded: views, then the triggers of the dumped tables,
+    then the events of each database if events is set
+
+    Like mysqldump, every view is first created as a stand-in view with the
+    same columns, so a view may be restored before the views it reads from,
+    even in another database.  Triggers are restored after the rows, so
+    loading the rows does not fire them.
+
+    :param databases: names of the databases being dumped
+    :param tables: list of Table being dumped, whose triggers are dumped
+    :param views: list of Table of the views being dumped
+    """
+    by_database = {}
+    for view in views:
+        by_database.setdefault(view.database, []).append(view)
+
+    stream.write(_sql(FILE_HEADER))
+    for database, names in sorted(by_database.items()):
+        columns = _view_columns(client, database, [view.name for view in names])
+        stream.write(_sql("USE %s;\n" % quote_name(database)))
+        for view in names:
+            # the columns of a broken view are not known
+            select = ", ".join(
+                ["1 AS %s" % quote_name(column) for column in columns.get(view.name, ["1"])]
+            )
+            stream.write(
+                _sql(
+                    "DROP TABLE IF EXISTS %s;\nDROP VIEW IF EXISTS %s;\n"
+                    "CREATE VIEW %s AS SELECT %s;\n"
+                    % (quote_name(view.name), quote_name(view.name), quote_name(view.name), select)
+                )
+            )
+        stream.write(b"\n")
+
+    for database, names in sorted(by_database.items()):
+        stream.write(_sql("USE %s;\n" % quote_name(database)))
+        for view in names:
+            ddl = client.show_create_view(view.database, view.name)
+            if ddl is None:
+                raise BackupError(
+                    "Failed to read the definition of view %s.%s" % (view.database, view.name)
+                )
+            stream.write(_sql("DROP VIEW IF EXISTS %s;\n%s;\n\n" % (quote_name(view.name), ddl)))
+
+    dumped = set([(table.database, table.name) for table in tables])
+    for database in databases:
+        triggers = [
+            name
+            for name, table in _select_names(
+                client,
+                "SELECT TRIGGER_NAME, EVENT_OBJECT_TABLE FROM INFORMATION_SCHEMA.TRIGGERS "
+                "WHERE TRIGGER_SCHEMA = %s ORDER BY EVENT_OBJECT_TABLE, ACTION_ORDER",
+                database,
+            )
+            if (database, table) in dumped
+        ]
+        event_names = []
+        if events:
+            event_names = [
+                row[0]
+                for row in _select_names(
+                    client,
+                    "SELECT EVENT_NAME FROM INFORMATION_SCHEMA.EVENTS "
+                    "WHERE EVENT_SCHEMA = %s ORDER BY EVENT_NAME",
+                    database,
+                )
+            ]
+        if not triggers and not event_names:
+            continue
+        stream.write(_sql("USE %s;\n" % quote_name(database)))
+        for name in triggers:
+            _write_object(client, stream, "TRIGGER", database, name)
+        for name in event_names:
+            _write_object(client, stream, "EVENT", database, name)
+    stream.write(_sql(FILE_FOOTER))
+
+
+def dump_chunk(connection, chunk, stream, insert_size, fetch_size):
+    """
+    Stream the rows of a chunk into extended INSERT statements of about
+    insert_size bytes each
+
+    Rows are read with an unbuffered cursor, so only fetch_size rows are
+    held in memory at a time.
+    """
+    literal = connection.literal
+    prefix = chunk.insert()
+    stream.write(_sql(FILE_HEADER + "USE %s;\n" % quote_name(chunk.table.database)))
+    cursor = connection.cursor(pymysql.cursors.SSCursor)
+    try:
+        cursor.execute(chunk.select())
+        values = []
+        pending = 0
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                value = "(" + ",".join([literal(column) for column in row]) + ")"
+                values.append(value)
+                pending += len(value) + 1
+                if pending >= insert_size:
+                    data = _sql(prefix + ",\n".join(values) + ";\n")
+                    stream.write(data)
+                    chunk.bytes += len(data)
+                    values = []
+                    pending = 0
+            chunk.rows += len(rows)
+        if values:
+            data = _sql(prefix + ",\n".join(values) + ";\n")
+            stream.write(data)
+            chunk.bytes += len(data)
+    finally:
+        cursor.close()
+    stream.write(_sql(FILE_FOOTER))
+
+
+def _worker(connection, chunks, open_stream, insert_size, fetch_size, failures):
+    """
+    Dump chunks from the queue on one connection until it is empty
+    """
+    while True:
+        try:
+            chunk = chunks.get_nowait()
+        except queue.Empty:
+            return
+        if failures:
+            # stop early, the backup has already failed
+            return
+        started = time.time()
+        try:
+            stream = open_stream(chunk.path, "wb")
+            try:
+                dump_chunk(connection, chunk, stream, insert_size, fetch_size)
+            finally:
+                stream.close()
+        except (MySQLError, IOError, OSError) as exc:
+            LOG.error("Failed to dump %s: %s", chunk, exc)
+            failures.append((chunk, exc))
+            return
+        LOG.info(
+            "Dumped %s: %d rows, %s in %.2f seconds",
+            chunk,
+            chunk.rows,
+            format_bytes(chunk.bytes),
+            time.time() - started,
+        )
+
+
+def dump_chunks(connections, chunks, open_stream, insert_size, fetch_size):
+    """
+    Dump chunks on every connection at once, largest chunks first
+
+    :param connections: connections that each started a snapshot with
+                        open_snapshot()
+    :param chunks: list of TableChunk
+    :param open_stream: function(path, mode) opening an output file
+    :raises: BackupError, listing every chunk that failed
+    """
+    pending = queue.Queue()
+    for chunk in sorted(chunks, key=lambda chunk: chunk.size, reverse=True):
+        pending.put(chunk)
+    failures = []
+    workers = []
+    for index, connection in enumerate(connections):
+        worker = threading.Thread(
+            target=_worker,
+            args=(connection, pending, open_stream, insert_size, fetch_size, failures),
+            name="holland-dump-%d" % index,
+        )
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    if failures:
+        raise BackupError(
+            "Failed to dump %s" % "; ".join(["%s: %s" % (chunk, exc) for chunk, exc in failures])
+        )
+
+
+def chunk_path(table):
+    """
+    Path of a table's data files in backup_data, without the extension
+    """
+    return "%s/%s" % (encode(table.database), encode(table.name))
@@ -0,0 +1,286 @@
+"""Native multi-connection MySQL dump plugin"""
+
+import logging
+import os
+from copy import deepcopy
+
+from holland.backup.mysqldump_native.dumper import (
+    chunk_path,
+    dump_chunks,
+    insert_columns,
+    open_snapshot,
+    plan_table,
+    write_post_data,
+    write_schema,
+)
+from holland.core.backup import BackupError
+from holland.lib.common.compression import (
+    COMPRESSION_CONFIG_STRING,
+    lookup_compression,
+    lookup_stages,
+    open_stream,
+)
+from holland.lib.common.safefilename import encode
+from holland.lib.mysql import (
+    DatabaseIterator,
+    MetadataTableIterator,
+    MySQLClient,
+    MySQLError,
+    MySQLSchema,
+    connect,
+    exclude_glob,
+    exclude_glob_qualified,
+    include_glob,
+    include_glob_qualified,
+)
+from holland.lib.mysql.client.base import MYSQL_CLIENT_CONFIG_STRING
+from holland.lib.mysql.option import build_mysql_config
+from holland.lib.mysql.util import parse_size
+
+LOG = logging.getLogger(__name__)
+
+# We validate our config against the following spec
+CONFIGSPEC = """
+[mysqldump-native]
+databases           = force_list(default=list('*'))
+exclude-databases   = force_list(default=list())
+
+tables              = force_list(default=list("*"))
+exclude-tables      = force_list(default=list())
+
+engines             = force_list(default=list("*"))
+exclude-engines     = force_list(default=list())
+
+connections         = integer(min=1, default=4)
+chunk-size          = string(default=1G)
+insert-size         = string(default=1M)
+fetch-size          = integer(min=1, default=1000)
+bin-log-position    = boolean(default=no)
+dump-routines       = boolean(default=yes)
+dump-events         = boolean(default=yes)
+
+estimate-method     = string(default='plugin')
+""" + MYSQL_CLIENT_CONFIG_STRING + COMPRESSION_CONFIG_STRING
+
+CONFIGSPEC = CONFIGSPEC.splitlines()
+
+
+class MySQLDumpNativePlugin(object):
+    """
+    Dump MySQL tables in parallel over several connections that all read
+    one consistent snapshot
+    """
+
+    CONFIGSPEC = CONFIGSPEC
+
+    def __init__(self, name, config, target_directory, dry_run=False):
+        self.name = name
+        self.config = config
+        self.target_directory = target_directory
+        self.dry_run = dry_run
+        self.config.validate_config(self.CONFIGSPEC)  # -> ValidationError
+
+        self.schema = MySQLSchema()
+        config = self.config["mysqldump-native"]
+        self.schema.add_database_filter(include_glob(*config["databases"]))
+        self.schema.add_database_filter(exclude_glob(*config["exclude-databases"]))
+        self.schema.add_table_filter(include_glob_qualified(*config["tables"]))
+        self.schema.add_table_filter(exclude_glob_qualified(*config["exclude-tables"]))
+        self.schema.add_engine_filter(include_glob(*config["engines"]))
+        self.schema.add_engine_filter(exclude_glob(*config["exclude-engines"]))
+
+        self.mysql_config = build_mysql_config(self.config["mysql:client"])
+        self.client = connect(self.mysql_config["client"])
+
+    def _refresh_schema(self):
+        """Read the databases and tables to dump, with their sizes"""
+        try:
+            self.client.connect()
+            self.schema.refresh(
+                db_iter=DatabaseIterator(self.client), tbl_iter=MetadataTableIterator(self.client)
+            )
+        except MySQLError as exc:
+            LOG.debug("MySQL error [%d] %s", exc_info=True, *exc.args)
+            raise BackupError("MySQL Error [%d] %s" % exc.args)
+
+    def estimate_backup_size(self):
+        """Estimate the size of the backup this plugin will generate"""
+        LOG.info("Estimating size of native mysqldump backup")
+        estimate_method = self.config["mysqldump-native"]["estimate-method"]
+
+        if estimate_method.startswith("const:"):
+            try:
+                return parse_size(estimate_method[6:])
+            except ValueError as exc:
+                raise BackupError(str(exc))
+
+        if estimate_method != "plugin":
+            raise BackupError("Invalid estimate-method '%s'" % estimate_method)
+
+        try:
+            self._refresh_schema()
+        finally:
+            self.client.disconnect()
+        return float(sum([db.size for db in self.schema.databases if not db.excluded]))
+
+    def _open_stream(self, path, mode):
+        """Open a stream through the holland compression api, relative to
+        this instance's target directory
+        """
+        path = str(os.path.join(self.target_directory, "backup_data", path))
+        return open_stream(path, mode, **deepcopy(self.config["compression"]))
+
+    def _check_compression(self):
+        """Fail early if the compression method or stages cannot be used"""
+        config = self.config["compression"]
+        if config["method"] not in ("none", "auto") and config["level"] > 0:
+            try:
+                lookup_compression(config["method"], config["engine"])
+            except OSError as exc:
+                raise BackupError(
+                    "Unable to load compression method '%s': %s" % (config["method"], exc)
+                )
+        if config["stages"]:
+            try:
+                lookup_stages(config["stages"])
+            except (OSError, BackupError) as exc:
+                raise BackupError("Unable to load compression stages: %s" % exc)
+
+    def _connect_workers(self, count):
+        """Open the connections the tables are dumped over
+
+        These do not reconnect, as a new connection would not see the
+        snapshot.
+        """
+        connections = []
+        try:
+            for _ in range(count):
+                connection = connect(self.mysql_config["client"], client_class=MySQLClient)
+                connection.connect()
+                connections.append(connection)
+                cursor = connection.cursor()
+                cursor.execute("/*!40101 SET NAMES utf8mb4 */")
+                cursor.close()
+        except MySQLError as exc:
+            for connection in connections:
+                connection.disconnect()
+            raise BackupError("Failed to connect to MySQL [%d] %s" % exc.args)
+        return connections
+
+    def backup(self):
+        """Run a native mysqldump backup"""
+        config = self.config["mysqldump-native"]
+        try:
+            chunk_size = parse_size(config["chunk-size"])
+            insert_size = parse_size(config["insert-size"])
+        except ValueError as exc:
+            raise BackupError(str(exc))
+
+        if self.schema.timestamp is None:
+            self._refresh_schema()
+
+        databases = [database for database in self.schema.databases if not database.excluded]
+        tables = [
+            table
+            for database in databases
+            for table in database.tables
+            if not table.excluded and table.engine != "view"
+        ]
+        for table in tables:
+            if not table.is_transactional:
+                LOG.warning(
+                    "%s.%s uses the %s engine, which is not read from the snapshot. "
+                    "Writes to it during the backup may be partly dumped.",
+                    table.database,
+                    table.name,
+                    table.engine,
+                )
+
+        if self.dry_run:
+            LOG.info(
+                "Would dump %d tables from %d databases over %d connections",
+                len(tables),
+                len(databases),
+                config["connections"],
+            )
+            self.client.disconnect()
+            return
+
+        self._check_compression()
+        os.mkdir(os.path.join(self.target_directory, "backup_data"))
+        connections = self._connect_workers(config["connections"])
+        try:
+            try:
+                master_status = open_snapshot(
+                    self.client, connections, bin_log_position=config["bin-log-position"]
+                )
+            except MySQLError as exc:
+                raise BackupError("Failed to start consistent snapshots [%d] %s" % exc.args)
+            finally:
+                self.client.disconnect()
+            if master_status:
+                self.config["mysql:replication"] = {
+                    "master_log_file": master_status["file"],
+                    "master_log_pos": master_status["position"],
+                }
+
+            chunks = []
+            try:
+                for database in databases:
+                    os.mkdir(
+                        os.path.join(self.target_directory, "backup_data", encode(database.name))
+                    )
+                    stream = self._open_stream("%s/schema.sql" % encode(database.name), "wb")
+                    try:
+                        write_schema(
+                            connections[0],
+                            database.name,
+                            [table for table in tables if table.database == database.name],
+                            stream,
+                            routines=config["dump-routines"],
+                        )
+                    finally:
+                        stream.close()
+                # views may read from tables of any database, so they are
+                # written once every table has been
+                stream = self._open_stream("post_data.sql", "wb")
+                try:
+                    write_post_data(
+                        connections[0],
+                        [database.name for database in databases],
+                        tables,
+                        [
+                            table
+                            for database in databases
+                            for table in database.tables
+                            if not table.excluded and table.engine == "view"
+                        ],
+                        stream,
+                        events=config["dump-events"],
+                    )
+                finally:
+                    stream.close()
+                columns = insert_columns(connections[0], tables)
+                for table in tables:
+                    chunks.extend(
+                        plan_table(
+                            connections[0],
+                            table,
+                            chunk_path(table),
+                            chunk_size,
+                            columns.get((table.database, table.name)),
+                        )
+                    )
+            except MySQLError as exc:
+                raise BackupError("MySQL Error [%d] %s" % exc.args)
+
+            LOG.info(
+                "Dumping %d tables in %d chunks over %d connections",
+                len(tables),
+                len(chunks),
+                len(connections),
+            )
+            dump_chunks(connections, chunks, self._open_stream, insert_size, config["fetch-size"])
+        finally:
+            for connection in connections:
+                connection.disconnect()
@@ -0,0 +1,202 @@
+"""Test the native mysqldump plugin's dumper"""
+
+import gzip
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from pymysql.converters import escape_item
+
+from holland.backup.mysqldump_native import dumper
+from holland.lib.common.compression import open_stream
+from holland.lib.mysql.schema.base import Table
+
+
+class MockCursor(object):
+    """Mock unbuffered cursor over a list of rows, or over the rows of the
+    first key of a dict found in each statement"""
+
+    def __init__(self, rows):
+        self.results = rows if isinstance(rows, dict) else None
+        self.rows = [] if self.results is not None else list(rows)
+        self.executed = []
+
+    def execute(self, sql, args=None):
+        """Record the statement"""
+        self.executed.append(sql)
+        if self.results is not None:
+            self.rows = [rows for key, rows in self.results.items() if key in sql][0]
+
+    def fetchmany(self, size):
+        """Return the next size rows"""
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        """Return the remaining rows"""
+        return self.fetchmany(len(self.rows))
+
+    def fetchone(self):
+        """Return the next row"""
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def close(self):
+        """Pass"""
+
+
+class MockConnection(object):
+    """Mock pymysql connection"""
+
+    def __init__(self, rows):
+        self.cursors = []
+        self.rows = rows
+
+    def cursor(self, cursor_class=None):  # pylint: disable=unused-argument
+        """Return a cursor over the rows"""
+        self.cursors.append(MockCursor(self.rows))
+        return self.cursors[-1]
+
+    def literal(self, value):
+        """Escape a value as pymysql does"""
+        return escape_item(value, "utf8")
+
+    def show_create_view(self, database, name):
+        """Return the definition of a view"""
+        return "CREATE ALGORITHM=UNDEFINED VIEW `%s` AS SELECT 1 AS `a`" % name
+
+
+class MockLockClient(object):
+    """Mock MySQLClient holding the global read lock"""
+
+    def __init__(self):
+        self.locked = []
+
+    def flush_tables_with_read_lock(self):
+        """Take the lock"""
+        self.locked.append(True)
+
+    def unlock_tables(self):
+        """Release the lock"""
+        self.locked[-1] = False
+
+
+class TestDumper(unittest.TestCase):
+    """Test dumping rows through open_stream()"""
+
+    tmpdir = None
+
+    def setUp(self):
+        self.__class__.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.__class__.tmpdir)
+
+    def test_split_ranges(self):
+        """Test splitting a primary key range"""
+        self.assertEqual(dumper.split_ranges(1, 100, 2), [(None, 51), (51, None)])
+        self.assertEqual(dumper.split_ranges(0, 9, 3), [(None, 4), (4, 7), (7, None)])
+        self.assertEqual(dumper.split_ranges(5, 6, 10), [(None, 6), (6, None)])
+        self.assertEqual(dumper.split_ranges(5, 5, 4), [(None, None)])
+        self.assertEqual(dumper.range_condition("id", None, None), None)
+        self.assertEqual(dumper.range_condition("i`d", 4, 7), "`i``d` >= 4 AND `i``d` < 7")
+
+    def test_dump_chunk(self):
+        """Test extended inserts are split by insert size"""
+        rows = [(index, "row's %d" % index, None, b"\x00\xff") for index in range(10)]
+        connection = MockConnection(rows)
+        table = Table("db", "t`1", 0, 0, "innodb")
+        chunk = dumper.TableChunk(table, "t.sql", where="`id` < 10")
+        path = os.path.join(self.tmpdir, "t.sql")
+        for method in ("none", "gzip"):
+            stream = open_stream(path, "wb", method)
+            dumper.dump_chunk(connection, chunk, stream, insert_size=80, fetch_size=3)
+            stream.close()
+        self.assertEqual(
+            connection.cursors[-1].executed,
+            ["SELECT /*!40001 SQL_NO_CACHE */ * FROM `db`.`t``1` WHERE `id` < 10"],
+        )
+        with open(path, "rb") as fileobj:
+            data = fileobj.read()
+        with gzip.open(path + ".gz", "rb") as fileobj:
+            self.assertEqual(fileobj.read(), data)
+        self.assertIn(b"USE `db`;\n", data)
+        self.assertIn(b"INSERT INTO `t``1` VALUES (0,'row\\'s 0',NULL,_binary", data)
+        self.assertEqual(data.count(b"INSERT INTO"), 4)
+        self.assertEqual(data.count(b"),\n(") + data.count(b");\n"), 10)
+
+    def test_utc_time_zone(self):
+        """Test snapshots are read in UTC and every file restores in UTC"""
+        connections = [MockConnection([]), MockConnection([])]
+        lock_client = MockLockClient()
+        dumper.open_snapshot(lock_client, connections)
+        for connection in connections:
+            self.assertEqual(connection.cursors[0].executed, ["/*!40103 SET TIME_ZONE='+00:00' */"])
+        self.assertEqual(lock_client.locked, [False])
+
+        path = os.path.join(self.tmpdir, "t.sql")
+        stream = open_stream(path, "wb", "none")
+        chunk = dumper.TableChunk(Table("db", "t", 0, 0, "innodb"), "t.sql")
+        dumper.dump_chunk(MockConnection([]), chunk, stream, insert_size=80, fetch_size=3)
+        stream.close()
+        with open(path, "rb") as fileobj:
+            data = fileobj.read()
+        header, footer = data.split(b"USE `db`;\n")
+        self.assertIn(b"/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE, TIME_ZONE='+00:00' */;\n", header)
+        self.assertIn(b"/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;\n", footer)
+
+    def test_generated_columns(self):
+        """Test generated columns are left out of the SELECT and INSERT"""
+        connection = MockConnection(
+            {
+                "SELECT DISTINCT": [("db", "t"), ("other", "excluded")],
+                "ORDER BY ORDINAL_POSITION": [
+                    ("id", "auto_increment"),
+                    ("total", "STORED GENERATED"),
+                    ("created", "DEFAULT_GENERATED"),
+                ],
+            }
+        )
+        table = Table("db", "t", 0, 0, "innodb")
+        columns = dumper.insert_columns(connection, [table])
+        self.assertEqual(columns, {("db", "t"): ["id", "created"]})
+        chunk = dumper.TableChunk(table, "t.sql", columns=columns[("db", "t")])
+        self.assertEqual(
+            chunk.select(), "SELECT /*!40001 SQL_NO_CACHE */ `id`, `created` FROM `db`.`t`"
+        )
+        self.assertEqual(chunk.insert(), "INSERT INTO `t` (`id`, `created`) VALUES ")
+
+    def test_post_data(self):
+        """Test views are written after stand-ins, then triggers and events"""
+        connection = MockConnection(
+            {
+                "INFORMATION_SCHEMA.COLUMNS": [("v1", "a")],
+                "INFORMATION_SCHEMA.TRIGGERS": [("trg", "t"), ("skipped", "excluded")],
+                "INFORMATION_SCHEMA.EVENTS": [("ev",)],
+                "SHOW CREATE TRIGGER": [("trg", "STRICT_ALL_TABLES", "CREATE TRIGGER trg")],
+                "SHOW CREATE EVENT": [("ev", "", "SYSTEM", "CREATE EVENT ev")],
+            }
+        )
+        views = [Table("db", "v1", 0, 0, "view"), Table("db", "v2", 0, 0, "view")]
+        path = os.path.join(self.tmpdir, "post_data.sql")
+        stream = open_stream(path, "wb", "none")
+        dumper.write_post_data(
+            connection, ["db"], [Table("db", "t", 0, 0, "innodb")], views, stream
+        )
+        stream.close()
+        with open(path, "rb") as fileobj:
+            data = fileobj.read()
+        self.assertIn(b"CREATE VIEW `v1` AS SELECT 1 AS `a`;\n", data)
+        self.assertIn(b"CREATE VIEW `v2` AS SELECT 1 AS `1`;\n", data)
+        self.assertTrue(
+            data.index(b"SELECT 1 AS `1`") < data.index(b"ALGORITHM=UNDEFINED VIEW `v1`")
+        )
+        self.assertIn(b"SET SQL_MODE='STRICT_ALL_TABLES';;\nCREATE TRIGGER trg ;;\n", data)
+        self.assertNotIn(b"skipped", data)
+        self.assertIn(b"TIME_ZONE='SYSTEM';;\nSET SQL_MODE='';;\nCREATE EVENT ev ;;\n", data)
+        self.assertIn(b"CREATE EVENT ev ;;\nSET TIME_ZONE=@SAVED_TIME_ZONE;;\n", data)
+
+
+if __name__ == "__main__":
+    unittest.main()
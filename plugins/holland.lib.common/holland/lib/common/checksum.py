@@ -0,0 +1,108 @@
+"""
+Checksum stream output as it is written
+"""
+
+import hashlib
+import queue
+import threading
+
+#: Digest of the files written through open_stream()
+DIGEST = "blake2b"
+
+#: Blocks that may be queued for the hashing thread before writes block
+QUEUE_DEPTH = 16
+
+
+class StreamDigest(object):
+    """
+    Hash data on a background thread
+
+    hashlib releases the GIL while hashing larger blocks, so the thread
+    writing the data only pays for queueing each block.
+    """
+
+    def __init__(self, name=DIGEST):
+        self.name = name
+        self._digest = hashlib.new(name)
+        self._blocks = queue.Queue(maxsize=QUEUE_DEPTH)
+        self._hexdigest = None
+        self._thread = threading.Thread(target=self._run, name="holland-digest")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        for block in iter(self._blocks.get, None):
+            self._digest.update(block)
+
+    def update(self, data):
+        """
+        Queue data to be hashed
+        """
+        if data:
+            self._blocks.put(bytes(data))
+
+    def hexdigest(self):
+        """
+        Wait for all queued data to be hashed and return the digest
+        """
+        if self._hexdigest is None:
+            self._blocks.put(None)
+            self._thread.join()
+            self._hexdigest = self._digest.hexdigest()
+        return self._hexdigest
+
+
+def file_digest(path, name=DIGEST):
+    """
+    Hash the contents of a file, e.g. one written without a StreamDigest or
+    one being verified
+    """
+    digest = hashlib.new(name)
+    with open(path, "rb") as fileobj:
+        for block in iter(lambda: fileobj.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DigestFile(object):
+    """
+    Binary file opened for writing that hashes what is written to it
+    """
+
+    def __init__(self, path, mode="wb"):
+        self.fileobj = open(path, mode)
+        self.name = path
+        self.digest = StreamDigest()
+
+    @property
+    def closed(self):
+        """
+        Whether the file has been closed
+        """
+        return self.fileobj.closed
+
+    def write(self, data):
+        """
+        Write data to the file and queue it to be hashed
+        """
+        written = self.fileobj.write(data)
+        self.digest.update(data)
+        return written
+
+    def flush(self):
+        """
+        Flush the file
+        """
+        self.fileobj.flush()
+
+    def close(self):
+        """
+        Close the file
+        """
+        self.fileobj.close()
+
+    def hexdigest(self):
+        """
+        Digest of the data written to the file
+        """
+        return self.digest.hexdigest()
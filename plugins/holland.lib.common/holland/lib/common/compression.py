@@ -2,15 +2,30 @@
 Common Compression utils
 """
 
+import atexit
 import errno
+import fcntl
 import io
 import logging
 import os
 import shlex
+import shutil
 import signal
 import subprocess
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryFile
 
+from holland.core.backup import BackupError
+from holland.core.backup.ledger import record_output, record_stream
+from holland.core.util.fmt import format_bytes
+from holland.lib.common import compressors
+from holland.lib.common.checksum import DigestFile, StreamDigest, file_digest
+from holland.lib.common.split import SplitFile, parse_splitsize
+from holland.lib.common.util import parse_size
 from holland.lib.common.which import which
 
 LOG = logging.getLogger(__name__)
@@ -29,144 +44,487 @@ COMPRESSION_METHODS = {
     "zstd": ("zstd", ".zst"),
 }
 
+#: Options that set the number of compression threads of the compression
+#: programs that can use more than one.  The other programs are single
+#: threaded.
+THREAD_OPTIONS = {
+    "pigz": "-p%d",
+    "pbzip2": "-p%d",
+    "lzma": "-T%d",
+    "zstd": "-T%d",
+}
+
+#: Programs that decompress the format of a method faster, with more threads,
+#: and are used instead when installed
+DECOMPRESSION_PROGRAMS = {
+    "gzip": "pigz",
+    "gzip-rsyncable": "pigz",
+    "bzip2": "pbzip2",
+}
+
+#: Methods whose programs decompress a concatenation of compressed files as
+#: a single file
+CONCATENABLE_METHODS = ("gzip", "gzip-rsyncable", "pigz", "bzip2", "pbzip2", "lzma", "zstd")
+
+#: Size of the uncompressed segments compressed in the background when
+#: inline compression is disabled
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# CompressionOutputs and InProcessOutputs that may not have been closed yet
+_OPEN_OUTPUTS = weakref.WeakSet()
+
+# compression methods already warned about ignoring the threads option
+_WARNED_SINGLE_THREADED = set()
+_WARNED_LOCK = threading.Lock()
+
 COMPRESSION_CONFIG_STRING = """
 [compression]
-method = option('none', 'gzip', 'gzip-rsyncable', 'pigz', 'bzip2', 'pbzip2', 'lzma', 'lzop', 'gpg', 'zstd', default='gzip')
+method = option('none', 'auto', 'gzip', 'gzip-rsyncable', 'pigz', 'bzip2', 'pbzip2', 'lzma', 'lzop', 'gpg', 'zstd', default='gzip')
 options = string(default="")
 inline = boolean(default=yes)
 split = boolean(default=no)
-splitsize = integer(min=1, default=1)
+splitsize = string(default="1G")
 level  = integer(min=0, max=9, default=1)
+engine = option('external', 'internal', 'auto', default='external')
+threads = integer(min=0, default=1)
+auto-candidates = force_list(default=list('zstd:3', 'gzip:1', 'gzip:6', 'lzma:1'))
+auto-sample-size = string(default="16M")
+auto-min-throughput = string(default="50M")
+stages = force_list(default=list())
+rate-limit = string(default="0")
 """
 
 
-def lookup_compression(method):
+def compression_threads(threads):
+    """
+    Resolve the threads compression option, where 0 means one per cpu
+    """
+    if not threads:
+        return os.cpu_count() or 1
+    return threads
+
+
+def stream_threads(method, engine="external", threads=1):
+    """
+    Number of threads a stream written with a compression method will use
+
+    Compression programs without a threads option use one, whatever the
+    threads option is.
+    """
+    threads = compression_threads(threads)
+    if threads > 1 and method not in THREAD_OPTIONS:
+        try:
+            argv, _ = lookup_compression(method, engine, threads)
+        except (OSError, BackupError):
+            return 1
+        if argv is not None:
+            return 1
+    return threads
+
+
+def lookup_compression(method, engine="external", threads=1):
     """
     Looks up the passed compression method in supported COMPRESSION_METHODS
     and returns a tuple in the form of ('command_name', 'file_extension').
+    The command is None if the method will be compressed in-process.
 
     Arguments:
 
     method -- A string identifier of the compression method (i.e. 'gzip').
+    engine -- 'external' to run the compression program, 'internal' to
+              compress in-process where possible, or 'auto' to compress
+              in-process only if the compression program is not installed,
+              or cannot use the requested number of threads.
+    threads -- Number of compression threads
     """
     try:
         cmd, ext = COMPRESSION_METHODS[method]
-        argv = shlex.split(cmd)
-        return [which(argv[0])] + argv[1:], ext
     except KeyError:
         raise OSError("Unsupported compression method '%s'" % method)
+    argv = shlex.split(cmd)
+    if engine != "external" and compressors.available(method):
+        if engine == "internal":
+            return None, ext
+        if compression_threads(threads) > 1 and method not in THREAD_OPTIONS:
+            LOG.debug("%s is single threaded. Compressing %s in-process", argv[0], method)
+            return None, ext
+        try:
+            return [which(argv[0])] + argv[1:], ext
+        except BackupError:
+            LOG.debug("%s not found. Compressing %s in-process", argv[0], method)
+            return None, ext
+    if engine == "internal":
+        LOG.debug("No in-process engine for %s. Using %s", method, argv[0])
+    return [which(argv[0])] + argv[1:], ext
 
 
-class CompressionInput(object):
+def decompression_args(method, argv, threads=1):
     """
-    Class to create a compressed file descriptor for reading.  Functions like
-    a standard file descriptor such as from open().
+    Return the command that decompresses a file compressed with ``method``
+
+    The parallel program for the method's format is used if it is installed,
+    and given ``threads`` threads where it accepts a thread count.
+
+    Arguments:
+
+    method  -- Compression method the file was compressed with
+    argv    -- Compression command from lookup_compression()
+    threads -- Number of decompression threads
+    """
+    parallel = DECOMPRESSION_PROGRAMS.get(method)
+    if parallel:
+        try:
+            argv = [which(parallel)] + argv[1:]
+            method = parallel
+        except BackupError:
+            LOG.debug("%s not found. Decompressing with %s", parallel, argv[0])
+    if threads > 1 and method in THREAD_OPTIONS:
+        argv = argv + [THREAD_OPTIONS[method] % threads]
+    return argv
+
+
+def lookup_stages(stages):
+    """
+    Look up the programs the output of a compression program is piped
+    through, in order
+
+    A stage is either a compression method, e.g. 'gpg -r backups', whose
+    command and file extension are used, or any other command line.
+
+    :returns: tuple of the list of commands and the combined file extension
+    """
+    commands = []
+    extension = ""
+    for stage in stages or []:
+        argv = _parse_args(stage)
+        if not argv:
+            continue
+        if argv[0] in COMPRESSION_METHODS:
+            command, ext = lookup_compression(argv[0])
+            commands.append(command + argv[1:])
+            extension += ext
+        else:
+            commands.append([which(argv[0])] + argv[1:])
+    return commands, extension
+
+
+def level_args(argv, level):
+    """
+    Return the arguments that set the compression level of a compression
+    program
+    """
+    if not level:
+        return []
+    if "gpg" in argv[0]:
+        return ["-z%d" % level]
+    return ["-%d" % level]
+
+
+def wait_process(process, counters=None):
+    """
+    Wait for a child process like Popen.wait()
+
+    :param counters: optional dict to update with the I/O counters of the
+                     process from /proc/<pid>/io, e.g. rchar and wchar
+    :returns: tuple of the exit status, the cpu seconds used by the process,
+              and the number of bytes it read, or None where /proc is not
+              available
+    """
+    bytes_read = None
+    try:
+        # wait without reaping, so /proc still describes the process
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        with io.open("/proc/%d/io" % process.pid, "r") as fileobj:
+            for line in fileobj:
+                name, _, value = line.partition(":")
+                if counters is not None:
+                    counters[name] = int(value)
+                if name == "rchar":
+                    bytes_read = int(value)
+    except (AttributeError, OSError, ValueError):
+        pass
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait(), 0.0, bytes_read
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage.ru_utime + rusage.ru_stime, bytes_read
+
+
+def _grow_pipe(fd, size):
+    """
+    Enlarge the kernel buffer of a pipe where supported, so a reader and a
+    writer exchange data in fewer, larger reads and writes
+    """
+    setpipe_sz = getattr(fcntl, "F_SETPIPE_SZ", None)
+    if setpipe_sz is None:
+        return
+    try:
+        fcntl.fcntl(fd, setpipe_sz, size)
+    except OSError:
+        # larger than /proc/sys/fs/pipe-max-size
+        pass
+
+
+class CompressionInput(io.RawIOBase):
+    """
+    Class to create a compressed file descriptor for reading.  A raw,
+    unbuffered reader like the file object from io.open(path, "rb",
+    buffering=0), that reads from the decompression program.
+
+    readinto() reads straight into the caller's buffer, so the fastest way
+    to stream a file is to read into a large memoryview that is reused.
+    readline() and iteration are served from an internal read ahead buffer.
+
+    Reaching the end of the data checks the exit status of the program, so
+    a truncated or corrupt file raises IOError rather than looking like a
+    short file.
     """
 
     def __init__(self, path, mode, argv, bufsize=1024 * 1024):
-        self.fileobj = io.open(path, "r")
-        self.pid = subprocess.Popen(
-            argv + ["--decompress"],
-            stdin=self.fileobj.fileno(),
-            stdout=subprocess.PIPE,
-            bufsize=bufsize,
-        )
-        self.filehandle = self.pid.stdout.fileno()
+        super(CompressionInput, self).__init__()
+        self.argv = argv
         self.name = path
-        self.closed = False
         self.mode = mode
+        self.bufsize = bufsize
+        #: exit status of the decompression program, once it has exited
+        self.returncode = None
+        self.fileobj = None
+        self.pid = None
+        self.stderr = None
+        self._pending = bytearray()
+        self._position = 0
+        self._eof = False
+        self._start()
+
+    def _start(self):
+        self.fileobj = io.open(self.name, "rb")
+        self.stderr = TemporaryFile()
+        LOG.debug("* Executing: %s", subprocess.list2cmdline(self.argv + ["--decompress"]))
+        try:
+            self.pid = subprocess.Popen(
+                self.argv + ["--decompress"],
+                stdin=self.fileobj.fileno(),
+                stdout=subprocess.PIPE,
+                stderr=self.stderr,
+                bufsize=0,
+            )
+        except OSError:
+            self.fileobj.close()
+            self.stderr.close()
+            raise
+        _grow_pipe(self.pid.stdout.fileno(), self.bufsize)
+        self.filehandle = self.pid.stdout.fileno()
+        self.returncode = None
+        self._pending = bytearray()
+        self._position = 0
+        self._eof = False
+
+    def _stop(self):
+        """
+        Stop the decompression program and return its exit status
+        """
+        self.pid.stdout.close()
+        # a program stopped early exits on a broken pipe
+        status = self.pid.wait()
+        self.fileobj.close()
+        return status
+
+    def _finish(self):
+        """
+        Check the exit status of the program once all its output is read
+        """
+        self._eof = True
+        self.returncode = self.pid.wait()
+        if self.returncode == 0:
+            return
+        self.stderr.seek(0)
+        for line in self.stderr:
+            if line.strip():
+                LOG.error("%s: %s", self.argv[0], line.decode("utf-8", "replace").rstrip())
+        raise IOError(
+            errno.EIO,
+            "Decompression program '%s' exited with status %d reading %s"
+            % (self.argv[0], self.returncode, self.name),
+        )
 
     def fileno(self):
         """
-        fileno
+        Return the file descriptor of the decompressed data, e.g. to pass it
+        as the stdin of another program.  Data already read ahead for
+        readline() or peek() is not available from it.
         """
         return self.filehandle
 
-    def read(self, size):
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
         """
-        read
+        Read decompressed data into a writable buffer
+
+        :returns: number of bytes read, which is 0 at the end of the data
         """
-        return os.read(self.filehandle, size)
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        view = memoryview(buffer).cast("B")
+        if self._pending:
+            count = min(len(view), len(self._pending))
+            view[:count] = self._pending[:count]
+            del self._pending[:count]
+        elif self._eof:
+            count = 0
+        else:
+            count = self.pid.stdout.readinto(view)
+            if count == 0 and len(view):
+                self._finish()
+        self._position += count
+        return count
 
-    def __next__(self):
+    def readall(self):
         """
-        next
+        Read until the end of the data
         """
-        return next(self.pid.stdout)
+        chunks = []
+        chunk = self.read(self.bufsize)
+        while chunk:
+            chunks.append(chunk)
+            chunk = self.read(self.bufsize)
+        return bytes().join(chunks)
 
-    def __iter__(self):
+    def peek(self, size=0):
         """
-        iter stdout
+        Return data that is ready to be read without consuming it
         """
-        return self.pid.stdout
+        if not self._pending and not self._eof:
+            data = self.pid.stdout.read(max(size, self.bufsize))
+            if not data:
+                self._finish()
+            self._pending += data
+        return bytes(self._pending)
 
-    def close(self):
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=io.SEEK_SET):
         """
-        close filehandle
+        Rewind to the start of the data by restarting the decompression
+        program.  Only seeking to the start or to the current position is
+        supported.
         """
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek to the start of a compressed stream")
+        if offset == self._position:
+            return offset
+        if offset != 0:
+            raise io.UnsupportedOperation("can only seek to the start of a compressed stream")
+        self._stop()
+        self.stderr.close()
+        self._start()
+        return 0
 
-        os.kill(self.pid.pid, signal.SIGTERM)
-        self.fileobj.close()
-        self.pid.stdout.close()
-        self.pid.wait()
-        self.closed = True
+    def close(self):
+        """
+        Stop the decompression program and close the file
+
+        The exit status of a program closed before all its output was read
+        is not checked.
+        """
+        if self.closed:
+            return
+        if self.pid is None:
+            super(CompressionInput, self).close()
+            return
+        try:
+            status = self._stop()
+            if self.returncode is None:
+                self.returncode = status
+                LOG.debug("%s closed before the end of %s", self.argv[0], self.name)
+        finally:
+            self.stderr.close()
+            super(CompressionInput, self).close()
 
 
 class CompressionOutput(object):
     """
     Class to create a compressed file descriptor for writing.  Functions like
     a standard file descriptor such as from open().
+
+    The compression program may be followed by further stages, e.g. gpg,
+    that its output is piped through.  Each program writes straight into
+    the pipe of the next one, and only the output of the last stage is
+    copied into the file, at no more than ``rate_limit`` bytes per second
+    if one is given.
     """
 
-    def __init__(self, path, mode, argv, level, inline, split=False, splitsize=1):
+    def __init__(self, path, mode, argv, level, split_size=None, stages=None, rate_limit=None):
         self.argv = argv
         self.level = level
-        self.inline = inline
-        if not inline:
-            if split:
-                LOG.warning("The split option only works if inline is enabled")
-            self.fileobj = io.open(os.path.splitext(path)[0], mode)
-            self.filehandle = self.fileobj.fileno()
+        self.split = bool(split_size)
+        self.rate_limit = rate_limit
+        #: bytes written to the stream, known once closed
+        self.bytes_in = 0
+        #: on-disk size of the compressed file, known once closed
+        self.bytes_out = None
+        #: seconds the stream was open, and cpu seconds used to compress it
+        self.wall_time = None
+        self.cpu_time = 0.0
+        #: exit status, cpu seconds and bytes read and written by each
+        #: program, known once closed
+        self.stage_stats = []
+        self._started = time.time()
+        argv += level_args(argv, level)
+        self.commands = [argv] + list(stages or [])
+        if split_size:
+            LOG.debug("* Splitting dump file into %d byte chunks", split_size)
+            self.fileobj = SplitFile(path, split_size)
         else:
-            if level:
-                if "gpg" in argv[0]:
-                    argv += ["-z%d" % level]
-                else:
-                    argv += ["-%d" % level]
-            self.stderr = TemporaryFile()
-            LOG.debug("* Executing: %s", subprocess.list2cmdline(argv))
-            if split:
-                split_args = [
-                    which("split"),
-                    "-a5",
-                    "--bytes=%sG" % splitsize,
-                    "-",
-                    path + ".",
-                ]
-                LOG.debug(
-                    "* Splitting dump file with: %s",
-                    subprocess.list2cmdline(split_args),
-                )
-                self.pid = subprocess.Popen(
-                    argv,
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=self.stderr,
-                )
-                self.split = subprocess.Popen(split_args, stdin=self.pid.stdout, stderr=self.stderr)
-
-            else:
-                self.fileobj = io.open(path, "w")
-                self.stderr = TemporaryFile()
-                self.pid = subprocess.Popen(
-                    argv,
-                    stdin=subprocess.PIPE,
-                    stdout=self.fileobj.fileno(),
-                    stderr=self.stderr,
-                )
-            self.filehandle = self.pid.stdin.fileno()
+            self.fileobj = DigestFile(path)
+        self.processes = []
+        self.stderr = []
+        stdin = subprocess.PIPE
+        for command in self.commands:
+            LOG.debug("* Executing: %s", subprocess.list2cmdline(command))
+            stderr = TemporaryFile()
+            process = subprocess.Popen(
+                command,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
+            if stdin is not subprocess.PIPE:
+                # only the next program holds the pipe from the previous one
+                stdin.close()
+            stdin = process.stdout
+            self.processes.append(process)
+            self.stderr.append(stderr)
+        self.pid = self.processes[0]
+        # the compressed output passes through here to be checksummed
+        self._copier = OutputCopier(
+            self.processes[-1].stdout, self.fileobj, rate_limit, self._started, path
+        )
+        self._copier.start()
+        self.filehandle = self.pid.stdin.fileno()
         self.name = path
         self.closed = False
+        _OPEN_OUTPUTS.add(self)
+
+    @property
+    def stages(self):
+        """
+        Counters of each program of a pipeline of more than one program
+        """
+        if len(self.commands) > 1:
+            return self.stage_stats
+        return None
 
     def fileno(self):
         """
@@ -178,60 +536,682 @@ class CompressionOutput(object):
         """
         writeout to filehandle
         """
-        return os.write(self.filehandle, data)
+        written = os.write(self.filehandle, data)
+        self.bytes_in += written
+        return written
 
     def close(self):
         """
         Close filehandle
         """
+        if self.closed:
+            return
+        _OPEN_OUTPUTS.discard(self)
+        self._close()
+        self.wall_time = time.time() - self._started
+        if self.split:
+            # each chunk is recorded as it is finished
+            self.bytes_out = self.fileobj.size
+        else:
+            self.bytes_out = os.path.getsize(self.name)
+            record_output(self.name, self.bytes_out, self.bytes_in, self.fileobj.hexdigest())
+        self.stage_stats[-1]["bytes-out"] = self.bytes_out
+        record_stream(
+            self.name,
+            self.bytes_in,
+            self.bytes_out,
+            self.wall_time,
+            self.cpu_time,
+            stages=self.stages,
+        )
+
+    def _wait_stages(self):
+        """
+        Wait for every program and count the bytes crossing each pipe
+
+        The bytes passed from one program to the next are the smaller of
+        what the first wrote and the second read, as either may also have
+        read or written other files, like gpg's keyring.
+        """
+        self.stage_stats = []
+        for process, command in zip(self.processes, self.commands):
+            counters = {}
+            status, cpu_time, _ = wait_process(process, counters)
+            self.cpu_time += cpu_time
+            self.stage_stats.append(
+                {
+                    "command": os.path.basename(command[0]),
+                    "status": status,
+                    "cpu-time": round(cpu_time, 6),
+                    "bytes-in": counters.get("rchar"),
+                    "bytes-out": counters.get("wchar"),
+                }
+            )
+        for upstream, downstream in zip(self.stage_stats, self.stage_stats[1:]):
+            if upstream["bytes-out"] is not None and downstream["bytes-in"] is not None:
+                upstream["bytes-out"] = downstream["bytes-in"] = min(
+                    upstream["bytes-out"], downstream["bytes-in"]
+                )
+
+    def _close(self):
+        """
+        Finish compressing and wait for every program of the pipeline
+        """
         self.closed = True
-        if not self.inline:
-            argv = list(self.argv)
-            if self.level:
-                if "gpg" in argv[0]:
-                    argv += ["-z%d" % self.level, "-"]
-                else:
-                    argv += ["-%d" % self.level, "-"]
+        self.pid.stdin.close()
+        self._copier.join()
+        self.processes[-1].stdout.close()
+        error = self._copier.error
+        try:
             self.fileobj.close()
-            self.fileobj = io.open(self.fileobj.name, "r")
-            cmp_f = io.open(self.name, "w")
-            LOG.debug(
-                "Running %r < %r[%d] > %r[%d]",
-                argv,
-                self.fileobj.name,
-                self.fileobj.fileno(),
-                cmp_f.name,
-                cmp_f.fileno(),
-            )
-            pid = subprocess.Popen(argv, stdin=self.fileobj.fileno(), stdout=cmp_f.fileno())
-            status = pid.wait()
-            LOG.debug("Return status: %s", status)
-            os.unlink(self.fileobj.name)
-        else:
-            self.pid.stdin.close()
-            status = self.pid.wait()
-            stderr = self.stderr
+        except (IOError, OSError) as exc:
+            error = error or exc
+        self._wait_stages()
+        bytes_read = self.stage_stats[0]["bytes-in"]
+        if bytes_read and not self.bytes_in:
+            # data written to fileno() is only seen by the compression program
+            self.bytes_in = bytes_read
+        self.stage_stats[0]["bytes-in"] = self.bytes_in
+        failed = None
+        for stats, command, stderr in zip(self.stage_stats, self.commands, self.stderr):
             stderr.flush()
             stderr.seek(0)
             try:
-                if status != 0:
-                    for line in stderr:
-                        if not line.strip():
-                            continue
-                        LOG.error("%s: %s", self.argv[0], line.rstrip())
-                    raise IOError(
-                        errno.EPIPE,
-                        "Compression program '%s' exited with status %d" % (self.argv[0], status),
-                    )
                 for line in stderr:
                     if not line.strip():
                         continue
-                    LOG.info("%s: %s", self.argv[0], line.rstrip())
+                    if stats["status"] != 0:
+                        LOG.error("%s: %s", command[0], line.rstrip())
+                    else:
+                        LOG.info("%s: %s", command[0], line.rstrip())
             finally:
                 stderr.close()
+            if stats["status"] != 0 and (failed is None or failed[1] == -signal.SIGPIPE):
+                # programs before the one that failed die of a broken pipe
+                failed = (command[0], stats["status"])
+        if error is not None:
+            # the programs were stopped by a broken pipe
+            raise error
+        if failed:
+            raise IOError(
+                errno.EPIPE,
+                "Compression program '%s' exited with status %d" % failed,
+            )
+
+    def __del__(self):
+        # a stream that is never closed must still finish its file
+        if not getattr(self, "closed", True):
+            try:
+                self.close()
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.error("Failed to close %s: %s", self.name, exc)
+
+
+class OutputCopier(threading.Thread):
+    """
+    Copy the output of the last program of a CompressionOutput into its
+    output file, at no more than ``rate_limit`` bytes per second
+
+    If the output file cannot be written, the error is saved and the pipe is
+    closed, so the programs and whoever writes to them fail with a broken
+    pipe rather than blocking on a full one.  The copier holds no reference
+    to its CompressionOutput, which can then be closed when it is garbage
+    collected.
+    """
+
+    def __init__(self, source, fileobj, rate_limit, started, path):
+        threading.Thread.__init__(self, name="holland-output %s" % os.path.basename(path))
+        self.daemon = True
+        self.source = source
+        self.fileobj = fileobj
+        self.rate_limit = rate_limit
+        self.started = started
+        #: exception raised while copying, if any
+        self.error = None
+
+    def run(self):
+        copied = 0
+        try:
+            for block in iter(lambda: self.source.read1(1024 * 1024), b""):
+                self.fileobj.write(block)
+                copied += len(block)
+                if self.rate_limit:
+                    # the programs block on their full pipes until we catch up
+                    delay = copied / float(self.rate_limit) - (time.time() - self.started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.debug("Failed to copy output to %s", self.fileobj.name, exc_info=True)
+            self.error = exc
+            self.source.close()
+
+
+def _close_open_outputs():
+    """
+    Finish the outputs still open when the interpreter exits
+    """
+    for output in list(_OPEN_OUTPUTS):
+        try:
+            output.close()
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.error("Failed to close %s: %s", output.name, exc)
+
+
+atexit.register(_close_open_outputs)
+
+
+class SegmentedOutput(object):
+    """
+    File compressed after it is written, when inline compression is disabled
+
+    Data is written uncompressed to rolling segment files next to the final
+    path.  Each full segment is compressed by the compression program on a
+    pool of workers while the following segments are written, and the
+    compressed segments are appended to the final file in order.  Only a few
+    segments are on disk at once.  Methods that cannot be concatenated are
+    written as a single segment and compressed on close.
+    """
+
+    def __init__(self, path, argv, level, workers=1, segment_size=SEGMENT_SIZE, split_size=None):
+        self.name = path
+        self.argv = list(argv) + level_args(argv, level)
+        self.level = level
+        self.workers = workers
+        self.segment_size = segment_size
+        self.closed = False
+        #: uncompressed bytes written to this stream
+        self.bytes_in = 0
+        #: on-disk size of the compressed file, known once closed
+        self.bytes_out = None
+        #: seconds the stream was open, and cpu seconds used to compress it
+        self.wall_time = None
+        self.cpu_time = 0.0
+        self._started = time.time()
+        self.split = bool(split_size)
+        if split_size:
+            self.fileobj = SplitFile(path, split_size)
+        else:
+            self.fileobj = DigestFile(path)
+        self._base = os.path.splitext(path)[0]
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="holland-compress")
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._count = 0
+        self._segment = None
+        self._segment_bytes = 0
+        self._error = None
+        self._pipe = None
+        self._write_fd = None
+        self._pump = None
+
+    def _compress_segment(self, path):
+        """
+        Compress a segment file and return the path of the compressed segment
+        """
+        target = path + ".compressed"
+        with io.open(path, "rb") as src, io.open(target, "wb") as dst, TemporaryFile() as stderr:
+            LOG.debug("Running %r < %r > %r", self.argv, path, target)
+            process = subprocess.Popen(self.argv, stdin=src, stdout=dst, stderr=stderr)
+            status, cpu_time, _ = wait_process(process)
+            # segments are compressed by several workers at once
+            with self._lock:
+                self.cpu_time += cpu_time
+            if status != 0:
+                stderr.seek(0)
+                for line in stderr:
+                    if line.strip():
+                        LOG.error("%s: %s", self.argv[0], line.rstrip())
+                raise IOError(
+                    errno.EPIPE,
+                    "Compression program '%s' exited with status %d" % (self.argv[0], status),
+                )
+        os.unlink(path)
+        return target
+
+    def _collect(self, wait_all=False):
+        """
+        Append compressed segments to the final file in order.  Waits while
+        more segments are queued than there are workers to compress them.
+        """
+        while self._pending:
+            future = self._pending[0]
+            if not (wait_all or future.done() or len(self._pending) > self.workers):
+                break
+            self._pending.popleft()
+            path = future.result()
+            with io.open(path, "rb") as segment:
+                shutil.copyfileobj(segment, self.fileobj, 1024 * 1024)
+            os.unlink(path)
+
+    def _rotate(self):
+        """
+        Queue the current segment for compression
+        """
+        self._segment.close()
+        self._pending.append(self._pool.submit(self._compress_segment, self._segment.name))
+        self._segment = None
+        self._collect()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._segment is None:
+                self._segment = io.open("%s.%05d" % (self._base, self._count), "wb")
+                self._segment_bytes = 0
+                self._count += 1
+            size = len(view)
+            if self.segment_size:
+                size = min(size, self.segment_size - self._segment_bytes)
+            self._segment.write(view[:size])
+            self._segment_bytes += size
+            self.bytes_in += size
+            view = view[size:]
+            if self.segment_size and self._segment_bytes >= self.segment_size:
+                self._rotate()
+
+    def _drain(self):
+        """
+        Copy data written to fileno() into segment files
+        """
+        while True:
+            data = os.read(self._pipe, 1024 * 1024)
+            if not data:
+                break
+            if self._error is None:
+                try:
+                    self._write(data)
+                except Exception as exc:  # pylint: disable=broad-except
+                    self._error = exc
+        os.close(self._pipe)
+
+    def fileno(self):
+        """
+        Return a file descriptor that data to be compressed may be written to
+        """
+        if self._pump is None:
+            self._pipe, self._write_fd = os.pipe()
+            self._pump = threading.Thread(
+                target=self._drain, name="holland-segment %s" % os.path.basename(self.name)
+            )
+            self._pump.daemon = True
+            self._pump.start()
+        return self._write_fd
 
+    def write(self, data):
+        """
+        Write data to be compressed
+        """
+        self._write(data)
+        return len(data)
 
-def stream_info(path, method=None, level=None):
+    def close(self):
+        """
+        Compress the remaining segments and close the final file
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._pump is not None:
+                os.close(self._write_fd)
+                self._pump.join()
+            if self._error is not None:
+                raise self._error
+            if self._segment is None and not self._count:
+                # an empty file still needs a valid header
+                self._segment = io.open("%s.%05d" % (self._base, 0), "wb")
+                self._count += 1
+            if self._segment is not None:
+                self._rotate()
+            self._collect(wait_all=True)
+        finally:
+            self._pool.shutdown()
+            self.fileobj.close()
+            for index in range(self._count):
+                for path in (
+                    "%s.%05d" % (self._base, index),
+                    "%s.%05d.compressed" % (self._base, index),
+                ):
+                    if os.path.exists(path):
+                        os.unlink(path)
+        self.wall_time = time.time() - self._started
+        if self.split:
+            self.bytes_out = self.fileobj.size
+        else:
+            self.bytes_out = os.path.getsize(self.name)
+            record_output(self.name, self.bytes_out, self.bytes_in, self.fileobj.hexdigest())
+        record_stream(self.name, self.bytes_in, self.bytes_out, self.wall_time, self.cpu_time)
+
+
+class CandidateResult(object):
+    """
+    Result of compressing a sample with one compression setting
+    """
+
+    def __init__(self, method, level, bytes_in, bytes_out, cpu_time, threads):
+        self.method = method
+        self.level = level
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.cpu_time = cpu_time
+        self.threads = threads
+
+    @property
+    def ratio(self):
+        """
+        Compressed size relative to the sample size
+        """
+        return float(self.bytes_out) / max(self.bytes_in, 1)
+
+    @property
+    def throughput(self):
+        """
+        Bytes per second the setting may compress, using every thread its
+        stream compresses on
+        """
+        return self.bytes_in * self.threads / max(self.cpu_time, 1e-6)
+
+    def __str__(self):
+        return "%s:%d" % (self.method, self.level)
+
+
+def measure_compression(sample, method, level, threads=1, engine="external"):
+    """
+    Compress a sample with a compression method and level
+
+    The in-process engine is used when available, and otherwise the
+    compression program.  The result counts the threads a stream written
+    with engine would use (see stream_threads).
+
+    :returns: CandidateResult
+    """
+    if compressors.available(method):
+        started = time.thread_time()
+        bytes_out = len(compressors.compress_block(method, level, sample))
+        cpu_time = time.thread_time() - started
+    else:
+        argv, _ = lookup_compression(method)
+        with TemporaryFile() as src, TemporaryFile() as dst:
+            src.write(sample)
+            src.flush()
+            src.seek(0)
+            process = subprocess.Popen(
+                argv + level_args(argv, level), stdin=src, stdout=dst, stderr=subprocess.DEVNULL
+            )
+            status, cpu_time, _ = wait_process(process)
+            if status != 0:
+                raise IOError("%s exited with status %d" % (argv[0], status))
+            bytes_out = dst.tell()
+    return CandidateResult(
+        method, level, len(sample), bytes_out, cpu_time, stream_threads(method, engine, threads)
+    )
+
+
+def choose_compression(sample, candidates, min_throughput, threads=1, engine="external"):
+    """
+    Pick the compression setting with the best ratio that compresses at
+    least ``min_throughput`` bytes per second, or the fastest setting if
+    none is fast enough.
+
+    :param sample: bytes to measure the candidates with
+    :param candidates: list of 'method:level' strings
+    :param min_throughput: throughput floor in bytes per second
+    :returns: CandidateResult of the chosen setting
+    """
+    results = []
+    for candidate in candidates:
+        method, _, level = str(candidate).partition(":")
+        try:
+            results.append(measure_compression(sample, method, int(level or 1), threads, engine))
+        except (IOError, OSError, BackupError, ValueError) as exc:
+            LOG.debug("Not considering compression %s: %s", candidate, exc)
+    if not results:
+        raise IOError("None of the compression candidates %s are available" % candidates)
+    for result in results:
+        LOG.debug(
+            "Compression %s: ratio %.3f at %s/s",
+            result,
+            result.ratio,
+            format_bytes(result.throughput),
+        )
+    eligible = [result for result in results if result.throughput >= min_throughput]
+    if eligible:
+        return min(eligible, key=lambda result: result.ratio)
+    return max(results, key=lambda result: result.throughput)
+
+
+class AutoCompressionOutput(object):
+    """
+    Stream that picks its compression method and level from its own data
+
+    The first ``sample_size`` bytes are buffered and compressed with each of
+    the candidate settings.  The chosen setting is used to open the real
+    stream, which determines the file extension, and is recorded with the
+    stream's telemetry in the backup directory.
+    """
+
+    def __init__(self, path, candidates, sample_size, min_throughput, **options):
+        self.path = path
+        self.name = path
+        self.candidates = candidates
+        self.sample_size = sample_size
+        self.min_throughput = min_throughput
+        self.options = options
+        self.closed = False
+        #: CandidateResult of the chosen setting
+        self.chosen = None
+        self.stream = None
+        self._sample = bytearray()
+        self._error = None
+        self._pipe = None
+        self._write_fd = None
+        self._pump = None
+
+    def __getattr__(self, name):
+        # bytes_in, bytes_out, wall_time, ... of the real stream
+        if name.startswith("_") or self.__dict__.get("stream") is None:
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
+    def _choose(self):
+        sample = bytes(self._sample)
+        self._sample = None
+        threads = compression_threads(self.options.get("threads", 1))
+        engine = self.options.get("engine", "external")
+        if (
+            self.options.get("stages")
+            or parse_size(self.options.get("rate-limit") or "0")
+            or not self.options.get("inline", True)
+        ):
+            # as open_stream() does for these streams
+            engine = "external"
+        if sample:
+            self.chosen = choose_compression(
+                sample[: self.sample_size], self.candidates, self.min_throughput, threads, engine
+            )
+        else:
+            method, _, level = str(self.candidates[0]).partition(":")
+            self.chosen = CandidateResult(
+                method, int(level or 1), 0, 0, 0.0, stream_threads(method, engine, threads)
+            )
+        LOG.info(
+            "Compressing %s with %s (ratio %.3f at %s/s on the first %s)",
+            self.path,
+            self.chosen,
+            self.chosen.ratio,
+            format_bytes(self.chosen.throughput),
+            format_bytes(self.chosen.bytes_in),
+        )
+        self.stream = open_stream(
+            self.path, "w", method=self.chosen.method, level=self.chosen.level, **self.options
+        )
+        self.name = self.stream.name
+        if sample:
+            self.stream.write(sample)
+
+    def write(self, data):
+        """
+        Buffer data until a compression setting is chosen, then compress it
+        """
+        if self.stream is not None:
+            return self.stream.write(data)
+        self._sample += data
+        if len(self._sample) >= self.sample_size:
+            self._choose()
+        return len(data)
+
+    def _drain(self):
+        """
+        Copy data written to fileno() into this stream
+
+        If the data cannot be compressed or written, the error is saved for
+        close() and the pipe is closed, so the writer fails with a broken
+        pipe rather than blocking on a full one.
+        """
+        try:
+            while True:
+                data = os.read(self._pipe, 1024 * 1024)
+                if not data:
+                    break
+                self.write(data)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.debug("Failed to compress %s", self.path, exc_info=True)
+            self._error = exc
+        finally:
+            os.close(self._pipe)
+
+    def fileno(self):
+        """
+        Return a file descriptor that data to be compressed may be written to
+        """
+        if self._pump is None:
+            self._pipe, self._write_fd = os.pipe()
+            self._pump = threading.Thread(
+                target=self._drain, name="holland-auto %s" % os.path.basename(self.path)
+            )
+            self._pump.daemon = True
+            self._pump.start()
+        return self._write_fd
+
+    def close(self):
+        """
+        Close the real stream and record the chosen compression setting
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._pump is not None:
+            os.close(self._write_fd)
+            self._pump.join()
+        if self._error is not None:
+            error = self._error
+            if self.stream is not None:
+                try:
+                    self.stream.close()
+                except Exception as exc:  # pylint: disable=broad-except
+                    # e.g. why the compression program's pipe broke
+                    error = exc
+            raise error
+        if self.stream is None:
+            self._choose()
+        self.stream.close()
+        record_stream(
+            self.stream.name,
+            self.stream.bytes_in,
+            self.stream.bytes_out,
+            self.stream.wall_time,
+            self.stream.cpu_time,
+            compression=str(self.chosen),
+            stages=getattr(self.stream, "stages", None),
+        )
+
+
+def detect_compression(path):
+    """
+    Find the compressed file written for ``path`` by an 'auto' stream
+
+    :returns: tuple of the compression method and the compressed path
+    """
+    for method, (_, ext) in COMPRESSION_METHODS.items():
+        if os.path.exists(path + ext):
+            return method, path + ext
+    raise IOError(errno.ENOENT, "No compressed file found for %s" % path)
+
+
+class FileOutput(object):
+    """
+    Uncompressed file opened for writing through open_stream().  Behaves like
+    the file object from io.open(), and reports its size and checksum once
+    closed.
+
+    A child process given fileno() writes straight into the file, and the
+    checksum of such a file is computed by reading it back when it is closed.
+    """
+
+    def __init__(self, path, mode):
+        self.fileobj = io.open(path, mode)
+        self.name = path
+        #: bytes (or characters, in text mode) passed to write()
+        self.bytes_in = 0
+        #: on-disk size of the file, known once closed
+        self.bytes_out = None
+        #: seconds the stream was open
+        self.wall_time = None
+        self._started = time.time()
+        self.digest = StreamDigest()
+        self._shared_fd = False
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def __iter__(self):
+        return iter(self.fileobj)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        """
+        write to the underlying file
+        """
+        written = self.fileobj.write(data)
+        self.bytes_in += len(data)
+        if isinstance(data, str):
+            data = data.encode(self.fileobj.encoding)
+        self.digest.update(data)
+        return written
+
+    def fileno(self):
+        """
+        Return the file descriptor of the underlying file, e.g. for the
+        stdout of a child process
+        """
+        self.fileobj.flush()
+        self._shared_fd = True
+        return self.fileobj.fileno()
+
+    def close(self):
+        """
+        Close the underlying file and report its size
+        """
+        if self.fileobj.closed:
+            return
+        self.fileobj.close()
+        self.wall_time = time.time() - self._started
+        self.bytes_out = os.path.getsize(self.name)
+        digest = self.digest.hexdigest()
+        if self._shared_fd:
+            # what was written to fileno() was not seen by write()
+            self.bytes_in = self.bytes_out
+            digest = file_digest(self.name)
+        record_output(self.name, self.bytes_out, self.bytes_in, digest)
+        record_stream(self.name, self.bytes_in, self.bytes_out, self.wall_time, 0.0)
+
+
+def stream_info(path, method=None, level=None, engine="external", threads=1):
     """
     Determine compression command, and compressed path based on original path
     and compression method.  If method is not passed, or level is 0 the
@@ -242,14 +1222,13 @@ def stream_info(path, method=None, level=None):
     path    -- Path to file to compress/decompress
     method  -- Compression method (i.e. 'gzip', 'bzip2', 'pbzip2', 'lzop')
     level   -- Compression level (0-9)
+    engine  -- Compression engine (see lookup_compression)
+    threads -- Number of compression threads
     """
     if not method or level == 0:
         return path
 
-    argv, ext = lookup_compression(method)
-
-    if not argv:
-        raise IOError("Unknown compression method '%s'" % argv[0])
+    argv, ext = lookup_compression(method, engine, threads)
 
     if not path.endswith(ext):
         path += ext
@@ -264,6 +1243,27 @@ def _parse_args(value):
     return shlex.split(value)
 
 
+def _warn_single_threaded(method, program, threads):
+    """
+    Warn once per method that a single threaded program ignores the threads
+    option
+    """
+    with _WARNED_LOCK:
+        if method in _WARNED_SINGLE_THREADED:
+            return
+        _WARNED_SINGLE_THREADED.add(method)
+    hint = ""
+    if compressors.available(method):
+        hint = " Set engine = auto or internal to compress in-process with %d threads." % threads
+    LOG.warning(
+        "%s is single threaded. Ignoring threads = %d for compression method '%s'.%s",
+        os.path.basename(program),
+        threads,
+        method,
+        hint,
+    )
+
+
 def open_stream(
     path,
     mode,
@@ -272,7 +1272,10 @@ def open_stream(
     inline=True,
     options=None,
     split=False,
-    splitsize=1,
+    splitsize="1G",
+    engine="external",
+    threads=1,
+    stages=None,
     **kwargs
 ):  # pylint: disable=unused-argument
     """
@@ -282,27 +1285,117 @@ def open_stream(
 
     Arguments:
 
-    mode    -- File access mode (i.e. 'r' or 'w')
+    mode    -- File access mode (i.e. 'r' or 'w', or 'wb' to write bytes even
+               when the file is not compressed)
     method  -- Compression method (i.e. 'gzip', 'bzip2', 'pbzip2', 'lzop')
     level   -- Compression level
     inline  -- Boolean whether to compress inline, or after the file is written.
+    split   -- Boolean whether to split the compressed file into chunks
+    splitsize -- Size of each chunk, in gigabytes or with a K, M, G or T suffix
+    engine  -- 'external', 'internal' or 'auto' (see lookup_compression)
+    threads -- Number of compression threads, or 0 for one per cpu
+    stages  -- Programs the compressed data is piped through, in order, e.g.
+               ['gpg -r backups'] (see lookup_stages)
+
+    The rate-limit option caps the bytes per second written to disk by a
+    compression program or the last of the stages.  Streams with stages or
+    a rate limit are always compressed inline by the compression program.
+
+    Files opened for reading are decompressed with the parallel program for
+    their format where it is installed (see decompression_args), and
+    returned as a CompressionInput.
+
+    With method 'auto', the auto-candidates, auto-sample-size and
+    auto-min-throughput options select the compression method and level
+    (see AutoCompressionOutput).
     """
+    rate_limit = parse_size(kwargs.get("rate-limit") or "0")
+    if (stages or rate_limit) and mode == "r":
+        raise IOError("Streams written through stages or a rate limit cannot be read back")
+    binary = mode == "wb"
+    if binary:
+        # compressed streams are always written with bytes
+        mode = "w"
+
     if not method or method == "none" or level == 0:
+        if mode == "w" and (stages or rate_limit):
+            commands, ext = lookup_stages(stages)
+            argv = commands.pop(0) if commands else [which("cat")]
+            return CompressionOutput(
+                path + ext,
+                mode,
+                argv=argv,
+                level=None,
+                split_size=parse_splitsize(splitsize) if split else None,
+                stages=commands,
+                rate_limit=rate_limit,
+            )
+        if mode == "w":
+            return FileOutput(path, "wb" if binary else mode)
         return io.open(path, mode)
 
-    argv, path = stream_info(path, method)
+    if method == "auto":
+        if mode == "r":
+            method, _ = detect_compression(path)
+            return open_stream(path, mode, method, options=options, engine=engine, threads=threads)
+        if mode == "w":
+            return AutoCompressionOutput(
+                path,
+                candidates=kwargs.get("auto-candidates") or ["gzip:1"],
+                sample_size=parse_size(kwargs.get("auto-sample-size") or "16M"),
+                min_throughput=parse_size(kwargs.get("auto-min-throughput") or "50M"),
+                inline=inline,
+                options=options,
+                split=split,
+                splitsize=splitsize,
+                engine=engine,
+                threads=threads,
+                stages=stages,
+                **{"rate-limit": kwargs.get("rate-limit")}
+            )
+        raise IOError("invalid mode: %s" % mode)
+
+    if stages or rate_limit:
+        # the compression program pipes straight into the first stage
+        engine = "external"
+        inline = True
+    elif not inline:
+        # post-compression is done by external programs
+        engine = "external"
+    split_size = parse_splitsize(splitsize) if split else None
+    threads = compression_threads(threads)
+    argv, path = stream_info(path, method, engine=engine, threads=threads)
+    if argv is None:
+        if mode == "r":
+            return compressors.open_input(path, method)
+        if mode == "w":
+            output = compressors.InProcessOutput(path, method, level, threads, split_size)
+            _OPEN_OUTPUTS.add(output)
+            return output
+        raise IOError("invalid mode: %s" % mode)
     if options:
         argv += _parse_args(options)
     if mode == "r":
-        return CompressionInput(path, mode, argv=argv)
+        return CompressionInput(path, mode, argv=decompression_args(method, argv, threads))
+    if mode == "w" and not inline:
+        # segments are compressed by one single threaded program per thread
+        segment_size = SEGMENT_SIZE if method in CONCATENABLE_METHODS else None
+        return SegmentedOutput(
+            path, argv, level, workers=threads, segment_size=segment_size, split_size=split_size
+        )
     if mode == "w":
+        if threads > 1 and method in THREAD_OPTIONS:
+            argv.append(THREAD_OPTIONS[method] % threads)
+        elif threads > 1:
+            _warn_single_threaded(method, argv[0], threads)
+        commands, ext = lookup_stages(stages)
         return CompressionOutput(
-            path,
+            path + ext,
             mode,
             argv=argv,
             level=level,
-            inline=inline,
-            split=split,
-            splitsize=splitsize,
+            split_size=split_size,
+            stages=commands,
+            rate_limit=rate_limit,
         )
     raise IOError("invalid mode: %s" % mode)
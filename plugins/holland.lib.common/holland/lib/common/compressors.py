@@ -0,0 +1,336 @@
+"""
+In-process compression engines
+
+These compress with the python bindings to the compression libraries rather
+than by running an external compression program, and are used by
+holland.lib.common.compression.open_stream() when the compression engine is
+'internal', or 'auto' and the compression program is not installed.
+"""
+
+import bz2
+import gzip
+import logging
+import lzma
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from holland.core.backup.ledger import record_output, record_stream
+from holland.lib.common.checksum import DigestFile
+from holland.lib.common.split import SplitFile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+#: Uncompressed bytes handed to the compression thread at once.  The
+#: compression libraries release the GIL while compressing a block.
+BLOCK_SIZE = 1024 * 1024
+
+#: Blocks that may be queued for the compression thread before write() blocks
+QUEUE_DEPTH = 4
+
+
+def _gzip_compressor(level):
+    return zlib.compressobj(level or 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _bzip2_compressor(level):
+    return bz2.BZ2Compressor(level or 9)
+
+
+def _lzma_compressor(level):
+    return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=6 if level is None else level)
+
+
+def _zstd_compressor(level):
+    return zstandard.ZstdCompressor(level=level or 3).compressobj()
+
+
+def _zstd_open(path):
+    return zstandard.open(path, "rb")
+
+
+#: method name : (compressor factory, reader factory)
+#: gzip-rsyncable is left to gzip, as zlib has no --rsyncable equivalent
+ENGINES = {
+    "gzip": (_gzip_compressor, gzip.open),
+    "pigz": (_gzip_compressor, gzip.open),
+    "bzip2": (_bzip2_compressor, bz2.open),
+    "pbzip2": (_bzip2_compressor, bz2.open),
+    "lzma": (_lzma_compressor, lzma.open),
+    "zstd": (_zstd_compressor, _zstd_open),
+}
+
+
+def available(method):
+    """
+    Check if a compression method can be used in-process
+    """
+    if method not in ENGINES:
+        return False
+    if method == "zstd":
+        return zstandard is not None
+    return True
+
+
+def compress_block(method, level, block):
+    """
+    Compress a block into a complete, independent gzip member, bzip2 or xz
+    stream or zstd frame.  The stock decompressors read a concatenation of
+    these as one file.
+    """
+    compressor = ENGINES[method][0](level)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _timed_compress_block(method, level, block):
+    """
+    compress_block() that also returns the cpu seconds it took
+    """
+    started = time.thread_time()
+    data = compress_block(method, level, block)
+    return data, time.thread_time() - started
+
+
+def open_input(path, method):
+    """
+    Open a file compressed with ``method`` for reading
+    """
+    return ENGINES[method][1](path)
+
+
+class BlockCompressor(threading.Thread):
+    """
+    Compress blocks queued by an InProcessOutput into its output file
+
+    With a pool of threads, each block is compressed independently on the
+    pool and this thread writes the results in order.  The compressor holds
+    no reference to its InProcessOutput, which can then be closed when it
+    is garbage collected.
+    """
+
+    def __init__(self, path, fileobj, method, level=None, threads=1):
+        threading.Thread.__init__(self, name="holland-compress %s" % os.path.basename(path))
+        self.daemon = True
+        self.fileobj = fileobj
+        self.method = method
+        self.level = level
+        #: uncompressed bytes queued, compressed bytes written, and the
+        #: cpu seconds used to compress them
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+        #: exception raised while compressing, if any
+        self.error = None
+        self._compressor = ENGINES[method][0](level)
+        self._pool = None
+        if threads > 1:
+            self._pool = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix="holland-compress"
+            )
+        self._submitted = False
+        self._buffer = bytearray()
+        self._blocks = queue.Queue(maxsize=max(QUEUE_DEPTH, threads * 2))
+
+    def run(self):
+        compressor = self._compressor
+        while True:
+            block = self._blocks.get()
+            if self.error is not None:
+                # keep draining the queue so writers are not blocked
+                if block is None:
+                    return
+                continue
+            try:
+                if self._pool is not None:
+                    # blocks are futures of already compressed members
+                    data = None
+                    if block is not None:
+                        data, cpu_time = block.result()
+                        self.cpu_time += cpu_time
+                else:
+                    started = time.thread_time()
+                    if block is None:
+                        data = compressor.flush()
+                    else:
+                        data = compressor.compress(block)
+                    self.cpu_time += time.thread_time() - started
+                if data:
+                    self.fileobj.write(data)
+                    self.bytes_out += len(data)
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.debug("In-process %s compression failed", self.method, exc_info=True)
+                self.error = exc
+            if block is None:
+                return
+
+    def _queue_block(self, block):
+        self._submitted = True
+        if self._pool is not None:
+            block = self._pool.submit(_timed_compress_block, self.method, self.level, block)
+        self._blocks.put(block)
+
+    def submit(self, data):
+        """
+        Queue data to be compressed, in blocks of BLOCK_SIZE
+        """
+        self.bytes_in += len(data)
+        if self._buffer:
+            self._buffer += data
+            data = self._buffer
+        view = memoryview(data)
+        offset = 0
+        while len(data) - offset >= BLOCK_SIZE:
+            self._queue_block(bytes(view[offset : offset + BLOCK_SIZE]))
+            offset += BLOCK_SIZE
+        view.release()
+        self._buffer = bytearray(data[offset:])
+
+    def drain(self, pipe):
+        """
+        Queue data read from a pipe until it is closed
+        """
+        while True:
+            data = os.read(pipe, BLOCK_SIZE)
+            if not data:
+                break
+            self.submit(data)
+        os.close(pipe)
+
+    def finish(self):
+        """
+        Compress what is left and wait for it to be written
+        """
+        if self._buffer or (self._pool is not None and not self._submitted):
+            # an empty file still needs a valid header
+            self._queue_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._blocks.put(None)
+        self.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+class InProcessOutput(object):
+    """
+    File compressed in-process for writing.  Functions like the
+    CompressionOutput returned by open_stream(), including a fileno() that
+    may be passed as the stdout of a child process.
+
+    With more than one thread, each block is compressed independently on a
+    pool of threads and the results are written in order, like pigz does.
+
+    With a split_size, the compressed data is split into chunk files of
+    that size (see holland.lib.common.split.SplitFile).
+
+    A stream that is never closed is finished when it is garbage collected.
+    """
+
+    def __init__(self, path, method, level=None, threads=1, split_size=None):
+        self.name = path
+        self.method = method
+        self.level = level
+        self.threads = threads
+        #: seconds the stream was open
+        self.wall_time = None
+        self._started = time.time()
+        self.split = bool(split_size)
+        if split_size:
+            self.fileobj = SplitFile(path, split_size)
+        else:
+            self.fileobj = DigestFile(path)
+        self._pump = None
+        self._write_fd = None
+        self._compressor = BlockCompressor(path, self.fileobj, method, level, threads)
+        self._compressor.start()
+        self.closed = False
+
+    @property
+    def bytes_in(self):
+        """
+        Uncompressed bytes written to this stream
+        """
+        return self._compressor.bytes_in
+
+    @property
+    def bytes_out(self):
+        """
+        Compressed bytes written to the file
+        """
+        return self._compressor.bytes_out
+
+    @property
+    def cpu_time(self):
+        """
+        Cpu seconds used to compress this stream
+        """
+        return self._compressor.cpu_time
+
+    def fileno(self):
+        """
+        Return a file descriptor that data to be compressed may be written to
+        """
+        if self._pump is None:
+            pipe, self._write_fd = os.pipe()
+            self._pump = threading.Thread(
+                target=self._compressor.drain,
+                args=(pipe,),
+                name="holland-pipe %s" % os.path.basename(self.name),
+            )
+            self._pump.daemon = True
+            self._pump.start()
+        return self._write_fd
+
+    def write(self, data):
+        """
+        Compress data into the output file
+        """
+        if self._compressor.error is not None:
+            raise IOError(
+                "In-process %s compression failed: %s" % (self.method, self._compressor.error)
+            )
+        self._compressor.submit(data)
+        return len(data)
+
+    def close(self):
+        """
+        Finish compressing and close the output file
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._pump is not None:
+            os.close(self._write_fd)
+            self._pump.join()
+        self._compressor.finish()
+        self.fileobj.close()
+        if self._compressor.error is not None:
+            raise IOError(
+                "In-process %s compression failed: %s" % (self.method, self._compressor.error)
+            )
+        self.wall_time = time.time() - self._started
+        if not self.split:
+            # split chunks are recorded as each one is finished
+            record_output(self.name, self.bytes_out, self.bytes_in, self.fileobj.hexdigest())
+        record_stream(self.name, self.bytes_in, self.bytes_out, self.wall_time, self.cpu_time)
+
+    def __del__(self):
+        # a stream that is never closed must still finish its file
+        if not getattr(self, "closed", True):
+            try:
+                self.close()
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.error("Failed to close %s: %s", self.name, exc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,174 @@
+"""
+Split a stream into fixed size chunk files
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from holland.core.backup.ledger import record_output
+from holland.lib.common.checksum import DIGEST, file_digest
+from holland.lib.common.util import parse_size
+
+LOG = logging.getLogger(__name__)
+
+#: Length of the alphabetic suffix of chunk files, as with ``split -a5``
+SUFFIX_LENGTH = 5
+
+#: Suffix of the manifest written next to the chunks of a split file.  This
+#: does not match the ``<name>.*`` glob used to concatenate the chunks.
+MANIFEST_SUFFIX = "-split.json"
+
+
+def parse_splitsize(value):
+    """
+    Parse the splitsize compression option into bytes
+
+    A plain number is a number of gigabytes, as it was passed to ``split``.
+    Otherwise a K, M, G or T suffix gives the unit, e.g. '256M'.
+    """
+    size = parse_size(value, "G")
+    if size < 1:
+        raise ValueError("Invalid split size %r" % value)
+    return size
+
+
+def chunk_suffix(index):
+    """
+    Return the suffix of the chunk file at ``index``: aaaaa, aaaab, ...
+    """
+    letters = []
+    for _ in range(SUFFIX_LENGTH):
+        index, offset = divmod(index, 26)
+        letters.append(chr(ord("a") + offset))
+    if index:
+        raise ValueError("Too many chunks for a %d letter suffix" % SUFFIX_LENGTH)
+    return "".join(reversed(letters))
+
+
+class SplitFile(object):
+    """
+    File object that writes its data to ``<path>.aaaaa``, ``<path>.aaaab``,
+    ... chunks of exactly ``chunk_size`` bytes, except for the last one.
+    Closing it writes a manifest of the size and digest of each chunk to
+    ``<path>-split.json``.
+
+    The chunks are named as ``split -a5`` would, so they may still be
+    restored with ``cat <path>.* | ...``.
+    """
+
+    def __init__(self, path, chunk_size):
+        self.name = path
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.closed = False
+        self._fileobj = None
+        self._digest = None
+        self._size = 0
+
+    @property
+    def manifest(self):
+        """
+        Path to the manifest of this file's chunks
+        """
+        return self.name + MANIFEST_SUFFIX
+
+    def _open_chunk(self):
+        path = "%s.%s" % (self.name, chunk_suffix(len(self.chunks)))
+        self._fileobj = io.open(path, "wb")
+        self._digest = hashlib.new(DIGEST)
+        self._size = 0
+
+    def _close_chunk(self):
+        self._fileobj.close()
+        self.chunks.append(
+            {
+                "name": os.path.basename(self._fileobj.name),
+                "size": self._size,
+                DIGEST: self._digest.hexdigest(),
+            }
+        )
+        record_output(self._fileobj.name, self._size, digest=self._digest.hexdigest())
+        self._fileobj = None
+        self._size = 0
+
+    def write(self, data):
+        """
+        Write data, starting new chunks as each one fills up
+        """
+        view = memoryview(data)
+        while view:
+            if self._fileobj is None:
+                self._open_chunk()
+            block = view[: self.chunk_size - self._size]
+            self._fileobj.write(block)
+            self._digest.update(block)
+            self._size += len(block)
+            view = view[len(block) :]
+            if self._size == self.chunk_size:
+                self._close_chunk()
+        return len(data)
+
+    def flush(self):
+        """
+        Flush the current chunk
+        """
+        if self._fileobj is not None:
+            self._fileobj.flush()
+
+    @property
+    def size(self):
+        """
+        Total number of bytes written
+        """
+        return sum(chunk["size"] for chunk in self.chunks) + self._size
+
+    def close(self):
+        """
+        Close the last chunk and write the manifest
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._fileobj is not None or not self.chunks:
+            if self._fileobj is None:
+                self._open_chunk()
+            self._close_chunk()
+        with io.open(self.manifest, "w") as fileobj:
+            json.dump(
+                {
+                    "name": os.path.basename(self.name),
+                    "chunk-size": self.chunk_size,
+                    "size": self.size,
+                    "chunks": self.chunks,
+                },
+                fileobj,
+                indent=2,
+            )
+        LOG.debug("Split %s into %d chunks", self.name, len(self.chunks))
+
+
+def verify_split(manifest, workers=None):
+    """
+    Check the chunks listed in a split manifest, reading them in parallel
+
+    :param manifest: path to the ``<path>-split.json`` manifest
+    :param workers: number of chunks to read at once
+    :returns: list of the names of missing or damaged chunks
+    """
+    with io.open(manifest, "r") as fileobj:
+        info = json.load(fileobj)
+    directory = os.path.dirname(manifest)
+
+    def check(chunk):
+        path = os.path.join(directory, chunk["name"])
+        if not os.path.exists(path) or os.path.getsize(path) != chunk["size"]:
+            return False
+        return file_digest(path) == chunk[DIGEST]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        results = list(pool.map(check, info["chunks"]))
+    return [chunk["name"] for chunk, valid in zip(info["chunks"], results) if not valid]
@@ -3,6 +3,7 @@ Helpful functions
 """
 
 import os
+import re
 import shutil
 from string import Template
 
@@ -20,6 +21,28 @@ def parse_arguments(arguments, **kwargs):
     return ret
 
 
+def parse_size(value, default_unit=""):
+    """Parse a size such as '256M' into bytes.
+
+    Args:
+        value (str): A number with an optional K, M, G or T suffix.
+        default_unit (str, optional): Unit of a number without a suffix.
+            Defaults to bytes.
+
+    Returns:
+        int: The number of bytes.
+
+    Raises:
+        ValueError: If the value is not a valid size.
+    """
+    match = re.match(r"^\s*(\d+(?:[.]\d+)?)\s*([kKmMgGtT]?)[bB]?\s*$", str(value))
+    if not match:
+        raise ValueError("Invalid size %r" % value)
+    number, unit = match.groups()
+    exponent = "KMGT".find((unit or default_unit or "B").upper()) + 1
+    return int(float(number) * 1024**exponent)
+
+
 def get_cmd_path(cmd, mode=os.F_OK | os.X_OK, path=None, raise_when_not_found=True):
     """Find the full path to an executable command.
 
@@ -1,10 +1,19 @@
 """ Test Compression"""
+import bz2
+import errno
+import gc
+import gzip
+import hashlib
+import io
+import json
 import os
 import shutil
 import unittest
 from tempfile import mkdtemp
+from unittest import mock
 
-from holland.lib.common import compression
+from holland.core.backup.ledger import close_ledger, open_ledger
+from holland.lib.common import checksum, compression, compressors, split
 
 
 class TestCompression(unittest.TestCase):
@@ -84,3 +93,328 @@ class TestCompression(unittest.TestCase):
         filep = compression.open_stream(os.path.join(self.__class__.tmpdir, "foo"), "w", "gzip")
         filep.write(bytes("foo", "ascii"))
         filep.close()
+
+    def test_output_accounting(self):
+        """Test streams report their size to the backup ledger"""
+        ledger = open_ledger(self.__class__.tmpdir)
+        try:
+            filep = compression.open_stream(
+                os.path.join(self.__class__.tmpdir, "gzip_foo"), "w", "gzip"
+            )
+            filep.write(bytes("foo" * 1024, "ascii"))
+            filep.close()
+
+            filep = compression.open_stream(os.path.join(self.__class__.tmpdir, "plain_foo"), "w")
+            filep.write("foo")
+            filep.close()
+        finally:
+            close_ledger(ledger)
+
+        gzip_path = os.path.join(self.__class__.tmpdir, "gzip_foo.gz")
+        plain_path = os.path.join(self.__class__.tmpdir, "plain_foo")
+        self.assertEqual(ledger.files[gzip_path], os.path.getsize(gzip_path))
+        self.assertEqual(ledger.files[plain_path], 3)
+        self.assertEqual(ledger.bytes_in, 3 * 1024 + 3)
+        with open(os.path.join(self.__class__.tmpdir, "unrecorded"), "w") as fileobj:
+            fileobj.write("foobar")
+        self.assertEqual(ledger.disk_usage(), os.path.getsize(gzip_path) + 3 + 6)
+
+    def test_internal_engine(self):
+        """Test in-process compression is readable by the compression program"""
+        data = bytes("foo\n", "ascii") * 512 * 1024
+        for method in ("gzip", "bzip2", "lzma"):
+            path = os.path.join(self.__class__.tmpdir, "%s_internal" % method)
+            filep = compression.open_stream(path, "w", method, level=1, engine="internal")
+            self.assertTrue(isinstance(filep, compressors.InProcessOutput))
+            filep.write(data[:1024])
+            with open(filep.fileno(), "wb", closefd=False) as pipe:
+                pipe.write(data[1024:])
+            filep.close()
+            self.assertEqual(filep.bytes_in, len(data))
+            self.assertEqual(filep.bytes_out, os.path.getsize(filep.name))
+
+            filep = compression.open_stream(path, "r", method)
+            chunks = []
+            chunk = filep.read(65536)
+            while chunk:
+                chunks.append(chunk)
+                chunk = filep.read(65536)
+            filep.close()
+            self.assertEqual(bytes().join(chunks), data)
+
+    def test_internal_unclosed(self):
+        """Test in-process streams that are never closed still finish their file"""
+        data = os.urandom(1024) * 3 * 1024
+        for threads in (1, 4):
+            dropped = os.path.join(self.__class__.tmpdir, "dropped_%d" % threads)
+            filep = compression.open_stream(
+                dropped, "w", "gzip", level=1, engine="internal", threads=threads
+            )
+            with open(filep.fileno(), "wb", closefd=False) as pipe:
+                pipe.write(data)
+            del filep
+            gc.collect()
+
+            # still referenced when the interpreter exits
+            leaked = os.path.join(self.__class__.tmpdir, "leaked_%d" % threads)
+            filep = compression.open_stream(
+                leaked, "w", "gzip", level=1, engine="internal", threads=threads
+            )
+            filep.write(data)
+            compression._close_open_outputs()  # pylint: disable=protected-access
+            self.assertTrue(filep.closed)
+
+            for path in (dropped, leaked):
+                with gzip.open(path + ".gz", "rb") as fileobj:
+                    self.assertEqual(fileobj.read(), data)
+
+    def test_parallel_compression(self):
+        """Test block compression on several threads is readable by the compression program"""
+        data = os.urandom(1024) * 5 * 1024
+        for method in ("gzip", "bzip2", "lzma"):
+            for size in (0, len(data)):
+                path = os.path.join(self.__class__.tmpdir, "%s_parallel_%d" % (method, size))
+                filep = compression.open_stream(
+                    path, "w", method, level=1, engine="internal", threads=4
+                )
+                self.assertEqual(filep.threads, 4)
+                filep.write(data[:size])
+                filep.close()
+
+                filep = compression.open_stream(path, "r", method)
+                chunks = []
+                chunk = filep.read(65536)
+                while chunk:
+                    chunks.append(chunk)
+                    chunk = filep.read(65536)
+                filep.close()
+                self.assertEqual(bytes().join(chunks), data[:size])
+
+    def test_segmented_compression(self):
+        """Test compressing segments in the background when inline is disabled"""
+        data = os.urandom(1024) * 300
+        for size in (0, len(data)):
+            path = os.path.join(self.__class__.tmpdir, "segmented_%d" % size)
+            filep = compression.open_stream(path, "w", "gzip", level=1, inline=False, threads=2)
+            filep.segment_size = 64 * 1024
+            filep.write(data[: size // 2])
+            with open(filep.fileno(), "wb", closefd=False) as pipe:
+                pipe.write(data[size // 2 : size])
+            filep.close()
+            self.assertEqual(os.listdir(self.__class__.tmpdir), [os.path.basename(filep.name)])
+            self.assertEqual(filep.bytes_in, size)
+
+            filep = compression.open_stream(path, "r", "gzip")
+            chunks = []
+            chunk = filep.read(65536)
+            while chunk:
+                chunks.append(chunk)
+                chunk = filep.read(65536)
+            filep.close()
+            os.unlink(filep.name)
+            self.assertEqual(bytes().join(chunks), data[:size])
+
+    def test_split(self):
+        """Test splitting compressed output into chunks with a manifest"""
+        data = os.urandom(1024) * 200 + os.urandom(200 * 1024)
+        for name, kwargs in (
+            ("external", {}),
+            ("internal", {"engine": "internal"}),
+            ("segmented", {"inline": False}),
+        ):
+            path = os.path.join(self.__class__.tmpdir, name)
+            filep = compression.open_stream(
+                path, "w", "gzip", level=1, split=True, splitsize="64K", **kwargs
+            )
+            filep.write(data)
+            filep.close()
+
+            with open(filep.name + split.MANIFEST_SUFFIX) as fileobj:
+                manifest = json.load(fileobj)
+            sizes = [chunk["size"] for chunk in manifest["chunks"]]
+            self.assertTrue(len(sizes) > 1)
+            self.assertEqual(set(sizes[:-1]), set([64 * 1024]))
+            self.assertEqual(sum(sizes), filep.bytes_out)
+            self.assertEqual(manifest["size"], filep.bytes_out)
+            self.assertEqual(split.verify_split(filep.name + split.MANIFEST_SUFFIX), [])
+
+            joined = bytes()
+            for chunk in manifest["chunks"]:
+                with open(os.path.join(self.__class__.tmpdir, chunk["name"]), "rb") as fileobj:
+                    joined += fileobj.read()
+            self.assertEqual(gzip.decompress(joined), data)
+
+        self.assertEqual(split.parse_splitsize("2"), 2 * 1024**3)
+        self.assertEqual(split.parse_splitsize("256M"), 256 * 1024**2)
+        self.assertRaises(ValueError, split.parse_splitsize, "256X")
+
+    def test_checksums(self):
+        """Test streams record the checksum of what they write"""
+        ledger = open_ledger(self.__class__.tmpdir)
+        try:
+            paths = []
+            for name, kwargs in (
+                ("external", {"method": "gzip"}),
+                ("internal", {"method": "gzip", "engine": "internal"}),
+                ("segmented", {"method": "gzip", "inline": False}),
+                ("split", {"method": "gzip", "split": True, "splitsize": "1K"}),
+                ("plain", {}),
+            ):
+                filep = compression.open_stream(
+                    os.path.join(self.__class__.tmpdir, name), "w", **kwargs
+                )
+                with open(filep.fileno(), "wb", closefd=False) as pipe:
+                    pipe.write(os.urandom(4096))
+                filep.close()
+                paths.append(filep.name)
+        finally:
+            close_ledger(ledger)
+
+        checksums = ledger.write_checksums()
+        self.assertEqual(os.path.basename(checksums), "BLAKE2SUMS")
+        with open(checksums) as fileobj:
+            recorded = dict(reversed(line.rstrip("\n").split("  ", 1)) for line in fileobj)
+        self.assertEqual(len(recorded), len(paths) - 1 + 5)
+        for name, digest in recorded.items():
+            with open(os.path.join(self.__class__.tmpdir, name), "rb") as fileobj:
+                self.assertEqual(hashlib.blake2b(fileobj.read()).hexdigest(), digest)
+
+    def test_stream_telemetry(self):
+        """Test streams report their throughput and compression cpu time"""
+        data = os.urandom(1024) * 4096
+        ledger = open_ledger(self.__class__.tmpdir)
+        try:
+            for name, kwargs in (
+                ("external", {"method": "gzip", "level": 6}),
+                ("internal", {"method": "gzip", "level": 6, "engine": "internal"}),
+                ("segmented", {"method": "gzip", "level": 6, "inline": False}),
+            ):
+                filep = compression.open_stream(
+                    os.path.join(self.__class__.tmpdir, name), "w", **kwargs
+                )
+                with open(filep.fileno(), "wb", closefd=False) as pipe:
+                    pipe.write(data)
+                filep.close()
+                self.assertTrue(filep.cpu_time > 0)
+                self.assertTrue(filep.wall_time >= 0)
+                self.assertTrue(filep.bytes_in >= len(data))
+        finally:
+            close_ledger(ledger)
+
+        self.assertEqual(len(ledger.streams), 3)
+        summary = ledger.stream_summary()
+        self.assertEqual(summary["files"], 3)
+        self.assertEqual(summary["bytes-out"], sum(ledger.files.values()))
+        with open(ledger.write_streams()) as fileobj:
+            streams = json.load(fileobj)
+        self.assertEqual(sorted(streams), ["external.gz", "internal.gz", "segmented.gz"])
+
+    def test_auto_compression(self):
+        """Test the auto method picks a setting from a sample and records it"""
+        data = bytes().join(bytes("row %d\n" % (num % 1000), "ascii") for num in range(200000))
+        ledger = open_ledger(self.__class__.tmpdir)
+        try:
+            filep = compression.open_stream(
+                os.path.join(self.__class__.tmpdir, "auto"),
+                "w",
+                method="auto",
+                level=1,
+                **{
+                    "auto-candidates": ["gzip:1", "bzip2:9"],
+                    "auto-sample-size": "64K",
+                    "auto-min-throughput": "0",
+                }
+            )
+            filep.write(data)
+            filep.close()
+        finally:
+            close_ledger(ledger)
+
+        # with no throughput floor the best ratio wins
+        self.assertEqual(str(filep.chosen), "bzip2:9")
+        self.assertEqual(filep.chosen.bytes_in, 64 * 1024)
+        self.assertEqual(filep.name, os.path.join(self.__class__.tmpdir, "auto.bz2"))
+        self.assertEqual(ledger.streams[filep.name]["compression"], "bzip2:9")
+        self.assertEqual(ledger.streams[filep.name]["bytes-in"], len(data))
+
+        filep = compression.open_stream(os.path.join(self.__class__.tmpdir, "auto"), "r", "auto")
+        self.assertEqual(filep.read(6), data[:6])
+        filep.close()
+
+        # only threads the stream will compress on count towards throughput
+        sample = data[: 64 * 1024]
+        single = compression.measure_compression(sample, "gzip", 1, threads=4)
+        parallel = compression.measure_compression(sample, "gzip", 1, threads=4, engine="internal")
+        self.assertEqual((single.threads, parallel.threads), (1, 4))
+        self.assertEqual(single.throughput, single.bytes_in / max(single.cpu_time, 1e-6))
+        self.assertEqual(compression.stream_threads("pigz", "external", 4), 4)
+
+    def test_compression_input(self):
+        """Test reading compressed files with the raw decompression reader"""
+        data = bytes().join(bytes("line %d\n" % num, "ascii") for num in range(100000))
+        path = os.path.join(self.__class__.tmpdir, "input")
+        with gzip.open(path + ".gz", "wb") as fileobj:
+            fileobj.write(data)
+
+        with compression.open_stream(path, "r", "gzip") as filep:
+            self.assertTrue(isinstance(filep, io.RawIOBase))
+            buf = memoryview(bytearray(64 * 1024))
+            chunks = []
+            count = filep.readinto(buf)
+            while count:
+                chunks.append(bytes(buf[:count]))
+                count = filep.readinto(buf)
+            self.assertEqual(bytes().join(chunks), data)
+            self.assertEqual(filep.returncode, 0)
+
+            filep.seek(0)
+            self.assertEqual(filep.readline(), bytes("line 0\n", "ascii"))
+            self.assertEqual(len(list(filep)), 99999)
+        self.assertTrue(filep.closed)
+
+        # stopping early is not an error
+        filep = compression.open_stream(path, "r", "gzip")
+        self.assertEqual(filep.read(4), data[:4])
+        filep.close()
+
+        with open(path + ".gz", "r+b") as fileobj:
+            fileobj.truncate(os.path.getsize(path + ".gz") // 2)
+        with compression.open_stream(path, "r", "gzip") as filep:
+            self.assertRaises(IOError, filep.read)
+
+    def test_stages(self):
+        """Test piping compressed output through further programs"""
+        data = os.urandom(64 * 1024) * 16
+        path = os.path.join(self.__class__.tmpdir, "staged")
+        filep = compression.open_stream(
+            path, "w", "gzip", level=1, stages=["bzip2 -1"], **{"rate-limit": "1M"}
+        )
+        filep.write(data)
+        filep.close()
+        self.assertEqual(filep.name, path + ".gz.bz2")
+        self.assertEqual([stage["command"] for stage in filep.stages], ["gzip", "bzip2"])
+        self.assertEqual(filep.stages[0]["bytes-in"], len(data))
+        self.assertEqual(filep.stages[0]["bytes-out"], filep.stages[1]["bytes-in"])
+        self.assertEqual(filep.stages[1]["bytes-out"], os.path.getsize(filep.name))
+        with bz2.open(filep.name, "rb") as fileobj:
+            self.assertEqual(gzip.decompress(fileobj.read()), data)
+
+        filep = compression.open_stream(path, "w", "gzip", level=1, stages=["false"])
+        filep.write(data)
+        self.assertRaises(IOError, filep.close)
+
+    def test_output_errors(self):
+        """Test a failed write of the compressed output is raised, not hung on"""
+        path = os.path.join(self.__class__.tmpdir, "full")
+
+        def _write(fileobj, data):  # pylint: disable=unused-argument
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        with mock.patch.object(checksum.DigestFile, "write", _write):
+            filep = compression.open_stream(path, "w", "gzip", level=1)
+            with self.assertRaises(OSError):
+                for _ in range(64):
+                    filep.write(os.urandom(1024 * 1024))
+            with self.assertRaises(OSError) as context:
+                filep.close()
+        self.assertEqual(context.exception.errno, errno.ENOSPC)
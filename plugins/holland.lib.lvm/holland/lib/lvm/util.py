@@ -3,6 +3,7 @@
 import os
 import re
 import signal
+import threading
 from math import log
 
 __all__ = ["getmount", "getdevice", "relpath", "format_bytes", "parse_bytes", "SignalManager"]
@@ -129,7 +130,14 @@ class SignalManager(object):
         self._handlers = {}
 
     def trap(self, *signals):
-        """Request the set of signals to be trapped """
+        """Request the set of signals to be trapped
+
+        Signal handlers can only be installed from the main thread.  When a
+        backupset is run on a worker thread (holland backup --jobs N) the
+        signals are left to the main thread instead.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
         for sig in signals:
             prev = signal.signal(sig, self._trap_signal)
             self._handlers[sig] = prev
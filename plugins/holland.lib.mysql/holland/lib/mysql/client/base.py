@@ -9,6 +9,7 @@ from importlib.metadata import version as get_version
 
 import pymysql
 import pymysql.connections
+import pymysql.cursors
 from pymysql import MySQLError, OperationalError, ProgrammingError
 
 LOG = logging.getLogger(__name__)
@@ -225,6 +226,52 @@ class MySQLClient(object):
             exc.args = (exc.args[0], exc.args[1].decode("utf8"))
             raise
 
+    def show_all_table_metadata(self, databases=None, excluded=None, sizes=True):
+        """Iterate over the table metadata of many databases in one query
+
+        Requires MySQL 5.1+.  Rows are streamed from the server rather than
+        buffered, so each one should be consumed before running other
+        queries on this connection.
+
+        :param databases: only read tables in these databases
+        :param excluded: do not read tables in these databases
+        :param sizes: whether to read the data and index sizes, which may
+                      be expensive with many tables
+        :returns: iterator of (database, name, data_size, index_size, engine)
+                  tuples
+        """
+        if databases is not None and not databases:
+            return
+        if sizes:
+            size_columns = "COALESCE(DATA_LENGTH, 0), COALESCE(INDEX_LENGTH, 0)"
+        else:
+            size_columns = "0, 0"
+        sql = (
+            "SELECT TABLE_SCHEMA, TABLE_NAME, %s, LOWER(COALESCE(ENGINE, 'view')) "
+            "FROM INFORMATION_SCHEMA.TABLES" % size_columns
+        )
+        conditions = []
+        args = []
+        if databases is not None:
+            conditions.append("TABLE_SCHEMA IN (%s)" % ", ".join(["%s"] * len(databases)))
+            args.extend(databases)
+        if excluded:
+            conditions.append("TABLE_SCHEMA NOT IN (%s)" % ", ".join(["%s"] * len(excluded)))
+            args.extend(excluded)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        cursor = self.cursor(pymysql.cursors.SSCursor)
+        try:
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     def show_tables(self, database, full=False):
         """List tables in the given database
 
@@ -125,35 +125,60 @@ class MySQLSchema(object):
                              useful filters - include pattern = *,
                              exclude pattern = ''
         """
-        for database in db_iter():
+        databases = list(db_iter())
+        included = []
+        for database in databases:
             self.databases.append(database)
             if self.is_db_filtered(database.name):
                 database.excluded = True
-                continue
-
-            # skip iterating over tables when:
-            # 1) we are matching all tables (using default pattern)
-            # 2) we are matching all engines (using default pattern)
-            # 3) caller does not require table iteration
-            # pylint: disable=too-many-boolean-expressions
-            if (
-                fast_iterate
-                and (
-                    len(self._table_filters) == 2
-                    and self._table_filters[0].patterns == [".*\\..*$"]
-                    and self._table_filters[1].patterns == []
-                )
-                and (
-                    len(self._engine_filters) == 2
-                    and self._engine_filters[0].patterns == [".*$"]
-                    and self._engine_filters[1].patterns == []
+            else:
+                included.append(database)
+
+        # skip iterating over tables when:
+        # 1) we are matching all tables (using default pattern)
+        # 2) we are matching all engines (using default pattern)
+        # 3) caller does not require table iteration
+        # pylint: disable=too-many-boolean-expressions
+        if (
+            fast_iterate
+            and (
+                len(self._table_filters) == 2
+                and self._table_filters[0].patterns == [".*\\..*$"]
+                and self._table_filters[1].patterns == []
+            )
+            and (
+                len(self._engine_filters) == 2
+                and self._engine_filters[0].patterns == [".*$"]
+                and self._engine_filters[1].patterns == []
+            )
+        ):
+            # optimize case where we have no table level filters
+            self.timestamp = time.time()
+            return
+
+        # read every database's tables at once where the iterator supports it
+        all_tables = None
+        if included and hasattr(tbl_iter, "all_tables"):
+            try:
+                all_tables = tbl_iter.all_tables(
+                    [database.name for database in included],
+                    [database.name for database in databases if database.excluded],
                 )
-            ):
-                # optimize case where we have no table level filters
-                continue
-
+            except MySQLError as exc:
+                # as below, but the database that could not be read is not
+                # known, so read them one at a time to skip only that one
+                if exc.args[0] != 1018:
+                    raise
+                LOG.warning("Unable to read all tables at once (%s). Reading each database.", exc)
+                all_tables = None
+
+        for database in included:
             try:
-                for table in tbl_iter(database.name):
+                if all_tables is not None:
+                    tables = all_tables.get(database.name, [])
+                else:
+                    tables = tbl_iter(database.name)
+                for table in tables:
                     if self.is_table_filtered(table.database + "." + table.name):
                         table.excluded = True
                     if self.is_engine_filtered(table.engine):
@@ -312,6 +337,33 @@ class TableIterator(object):
     def __call__(self, database):
         raise NotImplementedError()
 
+    def all_tables(self, databases, excluded=()):
+        """Read the tables of many databases at once
+
+        :param databases: names of the databases to read tables from
+        :param excluded: names of the databases that are not read, so the
+                         shorter of the two lists may be sent to the server
+        :returns: dict of database name to a list of `Table` instances, or
+                  None if tables can only be read one database at a time
+        """
+        return None
+
+    def _group_tables(self, databases, excluded, sizes):
+        """Group the rows of a single metadata query by database"""
+        if len(excluded) < len(databases):
+            # e.g. every database but a few, without sending 20k names
+            rows = self.client.show_all_table_metadata(
+                excluded=list(excluded) + list(DatabaseIterator.STD_EXCLUSIONS), sizes=sizes
+            )
+        else:
+            rows = self.client.show_all_table_metadata(databases=databases, sizes=sizes)
+        wanted = set(databases)
+        result = dict((name, []) for name in databases)
+        for row in rows:
+            if row[0] in wanted:
+                result[row[0]].append(Table(*row))
+        return result
+
 
 class MetadataTableIterator(TableIterator):
     """Iterate over SHOW TABLE STATUS in the requested database
@@ -322,6 +374,11 @@ class MetadataTableIterator(TableIterator):
         for metadata in self.client.show_table_metadata(database):
             yield Table(**metadata)
 
+    def all_tables(self, databases, excluded=()):
+        if self.client.server_version() < (5, 1):
+            return None
+        return self._group_tables(databases, excluded, sizes=True)
+
 
 class SimpleTableIterator(MetadataTableIterator):
     """Iterator over tables returns by the client instance
@@ -362,6 +419,11 @@ class SimpleTableIterator(MetadataTableIterator):
         finally:
             cursor.close()
 
+    def all_tables(self, databases, excluded=()):
+        if self.client.server_version() < (5, 1):
+            return None
+        return self._group_tables(databases, excluded, sizes=False)
+
     def _lookup_engine(self, database, table):
         ddl = self.client.show_create_table(database, table)
         match = self.ENGINE_PCRE.search(ddl)
@@ -3,15 +3,158 @@
 import fnmatch
 import re
 
+# the body of a fnmatch.translate() pattern
+GLOB_REGEX = re.compile(r"^\(\?s:(?P<body>.*)\)\\Z$", re.S)
+
+# characters re.escape() escapes, which are regex syntax when not escaped
+SPECIAL_CHARS = frozenset("()[]{}?*+-|^$\\.&~# \t\n\r\v\f")
+
+
+def _glob_tokens(body):
+    """Split a translated glob into (is_literal, char) pairs"""
+    index = 0
+    while index < len(body):
+        char = body[index]
+        if char == "\\" and index + 1 < len(body):
+            yield True, body[index + 1]
+            index += 2
+        else:
+            yield char not in SPECIAL_CHARS, char
+            index += 1
+
+
+def parse_glob(pattern):
+    """Find the literal text every match of a glob pattern starts and ends with
+
+    Any characters of a [...] set are never part of the prefix or suffix,
+    as the set starts and ends with syntax.
+
+    :param pattern: regular expression, as produced by `fnmatch.translate()`
+    :returns: (prefix, suffix, exact) where exact is True if the pattern
+              matches only the name prefix, or None if the pattern was not
+              produced by `fnmatch.translate()`
+    """
+    match = GLOB_REGEX.match(pattern)
+    if match is None:
+        return None
+    tokens = list(_glob_tokens(match.group("body")))
+    prefix = []
+    for is_literal, char in tokens:
+        if not is_literal:
+            break
+        prefix.append(char)
+    if len(prefix) == len(tokens):
+        return "".join(prefix), "".join(prefix), True
+    suffix = []
+    for is_literal, char in reversed(tokens):
+        if not is_literal:
+            break
+        suffix.append(char)
+    return "".join(prefix), "".join(reversed(suffix)), False
+
+
+class PatternMatcher(object):
+    """Match a name against many patterns at once
+
+    Names matched exactly by a glob are looked up in a set.  Other globs are
+    grouped by their literal prefix, or failing that their literal suffix,
+    and each group is compiled into one regular expression that is only
+    tried on names with that prefix or suffix.  Everything else is compiled
+    into a single regular expression.
+
+    Names that are not ascii are matched against every pattern, as
+    str.lower() does not always fold them the way re.I does.
+    """
+
+    def __init__(self, patterns, flags):
+        self.fold = bool(flags & re.I)
+        self.literals = set()
+        by_prefix = {}
+        by_suffix = {}
+        others = []
+        for pattern in patterns:
+            parsed = parse_glob(pattern)
+            if parsed is None or not (parsed[0] + parsed[1]).isascii():
+                # str.lower() only agrees with re.I for ascii
+                others.append(pattern)
+                continue
+            prefix, suffix, exact = parsed
+            if self.fold:
+                prefix, suffix = prefix.lower(), suffix.lower()
+            if exact:
+                self.literals.add(prefix)
+            elif prefix:
+                by_prefix.setdefault(prefix, []).append(pattern)
+            elif suffix:
+                by_suffix.setdefault(suffix, []).append(pattern)
+            else:
+                others.append(pattern)
+        self.prefixes = dict(
+            (prefix, _compile_any(group, flags)) for prefix, group in by_prefix.items()
+        )
+        self.prefix_lengths = sorted(set(len(prefix) for prefix in by_prefix))
+        self.suffixes = dict(
+            (suffix, _compile_any(group, flags)) for suffix, group in by_suffix.items()
+        )
+        self.suffix_lengths = sorted(set(len(suffix) for suffix in by_suffix))
+        self.regex = _compile_any(others, flags) if others else None
+        self.all_regex = _compile_any(patterns, flags) if patterns else None
+
+    def match(self, item):
+        """Check if item matches any of the patterns"""
+        if not item.isascii():
+            return self.all_regex is not None and self.all_regex.match(item) is not None
+        key = item.lower() if self.fold else item
+        if key in self.literals:
+            return True
+        for length in self.prefix_lengths:
+            regex = self.prefixes.get(key[:length])
+            if regex is not None and regex.match(item) is not None:
+                return True
+        for length in self.suffix_lengths:
+            regex = self.suffixes.get(key[-length:])
+            if regex is not None and regex.match(item) is not None:
+                return True
+        return self.regex is not None and self.regex.match(item) is not None
+
+
+def _compile_any(patterns, flags):
+    """Compile patterns into one regular expression matching any of them"""
+    try:
+        return re.compile("|".join(["(?:%s)" % pattern for pattern in patterns]), flags)
+    except re.error:
+        # e.g. a regex with global inline flags, which must come first
+        return _AnyRegex([re.compile(pattern, flags) for pattern in patterns])
+
+
+class _AnyRegex(object):
+    """Match any of several compiled regular expressions"""
+
+    __slots__ = ("regexes",)
+
+    def __init__(self, regexes):
+        self.regexes = regexes
+
+    def match(self, item):
+        """Return the first match of item, or None"""
+        for regex in self.regexes:
+            match = regex.match(item)
+            if match is not None:
+                return match
+        return None
+
 
 class BaseFilter(object):
     """Filter a string based on a list of regular expression or glob patterns.
 
     This should be inherited and the __call__ overriden with a real
     implementation
+
+    The patterns are compiled on first use into a `PatternMatcher`, so the
+    cost of a filter hardly grows with the number of patterns.
     """
 
-    __slots__ = ("patterns", "_re_options")
+    __slots__ = ("patterns", "_re_options", "_matcher")
 
     def __init__(self, patterns, case_insensitive=True):
         self.patterns = list(patterns)
@@ -19,6 +162,7 @@ class BaseFilter(object):
             self._re_options = re.M | re.U | re.I
         else:
             self._re_options = re.M | re.U
+        self._matcher = None
 
     def add_glob(self, glob):
         """Add a glob pattern to this filter
@@ -29,7 +173,7 @@ class BaseFilter(object):
         :param glob: glob pattern to add
         :type glob: str
         """
-        self.patterns.append(fnmatch.translate(glob))
+        self.add_regex(fnmatch.translate(glob))
 
     def add_regex(self, regex):
         """Add a regular expression pattern to this filter
@@ -38,6 +182,17 @@ class BaseFilter(object):
         :type regex: str
         """
         self.patterns.append(regex)
+        self._matcher = None
+
+    def matches(self, item):
+        """Check if item matches any of this filter's patterns
+
+        :param item: item to check against this filter
+        :type item: str
+        """
+        if self._matcher is None:
+            self._matcher = PatternMatcher(self.patterns, self._re_options)
+        return self._matcher.match(item)
 
     def __call__(self, item):
         """Run this filter - return True if filtered and False otherwise.
@@ -55,20 +210,14 @@ class IncludeFilter(BaseFilter):
     """Include only objects that match *all* assigned filters"""
 
     def __call__(self, item):
-        for _pattern in self.patterns:
-            if re.match(_pattern, item, self._re_options) is not None:
-                return False
-        return True
+        return not self.matches(item)
 
 
 class ExcludeFilter(BaseFilter):
     """Exclude objects that match any filter"""
 
     def __call__(self, item):
-        for _pattern in self.patterns:
-            if re.match(_pattern, item, self._re_options) is not None:
-                return True
-        return False
+        return self.matches(item)
 
 
 def exclude_glob(*pattern):
@@ -0,0 +1,111 @@
+"""Test matching names against many schema filter patterns"""
+
+import fnmatch
+import re
+import unittest
+
+from holland.lib.mysql.schema.filter import PatternMatcher, parse_glob
+
+GLOBS = [
+    "employees.salaries",
+    "Employees.Titles",
+    "sakila.*",
+    "sakila.film_*",
+    "log_*.archive",
+    "*.tmp_*",
+    "*_backup",
+    "*.bak",
+    "test?.t[0-9]",
+    "[ab]*.users",
+    "*",
+    "café.*",
+    "data.x+y(1)",
+]
+
+NAMES = [
+    "employees.salaries",
+    "EMPLOYEES.SALARIES",
+    "employees.titles",
+    "employees.salaries2",
+    "sakila.film",
+    "sakila.film_text",
+    "SAKILA.FILM_TEXT",
+    "sakila",
+    "log_2020.archive",
+    "log_.archive",
+    "log_2020.archives",
+    "db.tmp_1",
+    "db.tmp",
+    "orders_backup",
+    "orders_backup.x",
+    "db.bak",
+    "db.BAK",
+    "test1.t5",
+    "test12.t5",
+    "test1.tx",
+    "alpha.users",
+    "beta.users",
+    "gamma.users",
+    "café.t",
+    "CAFÉ.t",
+    "data.x+y(1)",
+    "data.xxy1",
+    "a\nb",
+    "",
+]
+
+
+class TestPatternMatcher(unittest.TestCase):
+    """Test PatternMatcher against matching each pattern on its own"""
+
+    def test_parse_glob(self):
+        """Test the literal prefix and suffix of translated globs"""
+        self.assertEqual(parse_glob(fnmatch.translate("db.t1")), ("db.t1", "db.t1", True))
+        self.assertEqual(parse_glob(fnmatch.translate("db.*")), ("db.", "", False))
+        self.assertEqual(parse_glob(fnmatch.translate("*.bak")), ("", ".bak", False))
+        self.assertEqual(parse_glob(fnmatch.translate("[ab]*.x")), ("", ".x", False))
+        self.assertEqual(parse_glob(r"^db\..*$"), None)
+
+    def test_groups(self):
+        """Test globs are split into literals, prefix and suffix groups"""
+        patterns = [fnmatch.translate(glob) for glob in GLOBS]
+        matcher = PatternMatcher(patterns, re.M | re.U | re.I)
+        self.assertEqual(
+            matcher.literals, set(["employees.salaries", "employees.titles", "data.x+y(1)"])
+        )
+        self.assertEqual(sorted(matcher.prefixes), ["log_", "sakila.", "sakila.film_", "test"])
+        self.assertEqual(sorted(matcher.suffixes), [".bak", ".users", "_backup"])
+        self.assertNotEqual(matcher.regex, None)
+
+    def test_equivalence(self):
+        """Test the grouped matcher agrees with fnmatch for every pattern"""
+        for case_insensitive in (True, False):
+            flags = re.M | re.U | (re.I if case_insensitive else 0)
+            for glob in GLOBS:
+                # each pattern alone, then with every other pattern but "*"
+                for globs in ([glob], [other for other in GLOBS if other != "*"]):
+                    matcher = PatternMatcher([fnmatch.translate(other) for other in globs], flags)
+                    for name in NAMES:
+                        if case_insensitive:
+                            expected = any(
+                                re.match(fnmatch.translate(other), name, flags) for other in globs
+                            )
+                        else:
+                            expected = any(fnmatch.fnmatchcase(name, other) for other in globs)
+                        self.assertEqual(
+                            matcher.match(name),
+                            expected,
+                            "%r against %r (case_insensitive=%s)" % (name, globs, case_insensitive),
+                        )
+
+    def test_regex(self):
+        """Test patterns that are not globs still match as regular expressions"""
+        patterns = [r"^sakila\.film.*$", r"(?i)^log_\d+\..*", fnmatch.translate("db.*")]
+        matcher = PatternMatcher(patterns, re.M | re.U)
+        for name in ("sakila.film_text", "LOG_1.x", "db.t", "sakila.actor", "log_x.y"):
+            expected = any(re.match(pattern, name, re.M | re.U) for pattern in patterns)
+            self.assertEqual(matcher.match(name), expected, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Test reading the schema of a MySQL server"""
+
+import unittest
+
+from pymysql.err import InternalError
+
+from holland.lib.mysql.schema.base import (
+    DatabaseIterator,
+    MetadataTableIterator,
+    MySQLSchema,
+    SimpleTableIterator,
+)
+from holland.lib.mysql.schema.filter import exclude_glob, include_glob
+
+ROWS = [
+    ("db1", "t1", 10, 5, "innodb"),
+    ("db2", "t2", 20, 0, "myisam"),
+    ("db1", "v1", 0, 0, "view"),
+    ("skipped", "t3", 30, 0, "innodb"),
+]
+
+
+class MockClient(object):
+    """Mock MySQLClient over a fixed list of table metadata rows"""
+
+    def __init__(self, rows, error=None):
+        self.rows = rows
+        self.error = error
+        self.bulk_queries = []
+
+    def server_version(self):
+        """Report a server with INFORMATION_SCHEMA"""
+        return (8, 0, 0)
+
+    def show_databases(self):
+        """Return every database with a table, in order"""
+        names = []
+        for row in self.rows:
+            if row[0] not in names:
+                names.append(row[0])
+        return names
+
+    def show_all_table_metadata(self, databases=None, excluded=None, sizes=True):
+        """Return the rows, only filtered the way the real query is"""
+        self.bulk_queries.append((databases, excluded, sizes))
+        if self.error is not None:
+            raise self.error
+        for row in self.rows:
+            if databases is not None and row[0] not in databases:
+                continue
+            if excluded and row[0] in excluded:
+                continue
+            yield row
+
+    def show_table_metadata(self, database):
+        """Return the rows of one database"""
+        if self.error is not None and database == "db2":
+            raise self.error
+        for row in self.rows:
+            if row[0] == database:
+                yield dict(zip(("database", "name", "data_size", "index_size", "engine"), row))
+
+
+def _schema():
+    schema = MySQLSchema()
+    schema.add_database_filter(include_glob("*"))
+    schema.add_database_filter(exclude_glob("skipped"))
+    return schema
+
+
+def _tables(schema):
+    return dict(
+        (database.name, [(table.name, table.size) for table in database.tables])
+        for database in schema.databases
+        if not database.excluded
+    )
+
+
+class TestSchema(unittest.TestCase):
+    """Test MySQLSchema.refresh() and the table iterators"""
+
+    def test_group_tables(self):
+        """Test one query's rows are grouped by the databases asked for"""
+        client = MockClient(ROWS + [("db3", "t4", 1, 1, "innodb")])
+        tables = MetadataTableIterator(client).all_tables(["db1", "db2", "db3"], ["skipped"])
+        self.assertEqual(
+            dict((name, [table.name for table in group]) for name, group in tables.items()),
+            {"db1": ["t1", "v1"], "db2": ["t2"], "db3": ["t4"]},
+        )
+        # the excluded databases were the shorter list to send
+        self.assertEqual(
+            client.bulk_queries,
+            [(None, ["skipped"] + list(DatabaseIterator.STD_EXCLUSIONS), True)],
+        )
+
+        client = MockClient(ROWS)
+        tables = SimpleTableIterator(client).all_tables(["db1"], ["db2", "skipped"])
+        self.assertEqual([table.name for table in tables["db1"]], ["t1", "v1"])
+        self.assertEqual(client.bulk_queries, [(["db1"], None, False)])
+
+    def test_bulk_refresh(self):
+        """Test refreshing from one query matches reading each database"""
+        client = MockClient(ROWS)
+        schema = _schema()
+        schema.refresh(DatabaseIterator(client), MetadataTableIterator(client))
+        self.assertEqual(len(client.bulk_queries), 1)
+        self.assertEqual(_tables(schema), {"db1": [("t1", 15), ("v1", 0)], "db2": [("t2", 20)]})
+        self.assertEqual([db.name for db in schema.excluded_databases], ["skipped"])
+
+        per_database = _schema()
+        iterator = MetadataTableIterator(client)
+        per_database.refresh(DatabaseIterator(client), iterator.__call__)
+        self.assertEqual(_tables(per_database), _tables(schema))
+
+    def test_unreadable_database(self):
+        """Test a database that cannot be read is skipped, as mysqldump does"""
+        client = MockClient(ROWS, error=InternalError(1018, "Can't read dir of './db2/'"))
+        schema = _schema()
+        schema.refresh(DatabaseIterator(client), MetadataTableIterator(client))
+        self.assertEqual(len(client.bulk_queries), 1)
+        self.assertEqual(_tables(schema), {"db1": [("t1", 15), ("v1", 0)], "db2": []})
+
+        client = MockClient(ROWS, error=InternalError(1045, "Access denied"))
+        with self.assertRaises(InternalError):
+            _schema().refresh(DatabaseIterator(client), MetadataTableIterator(client))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Benchmark the schema filters against a generated catalog
+
+Run with holland.lib.mysql installed::
+
+    python scripts/bench_schema_filter.py --tables 1000000 --patterns 300
+
+The patterns are a mix of literal table names, prefix globs and suffix
+globs, as a long exclude-tables list tends to be.  The per-pattern
+re.match() loop the filters used before they were compiled is timed on a
+sample of the names and scaled up to the full catalog.
+"""
+
+import argparse
+import re
+import time
+
+from holland.lib.mysql.schema.filter import exclude_glob_qualified, include_glob_qualified
+
+
+def generate_names(tables, databases):
+    """Return qualified names of tables spread over databases"""
+    per_database = max(1, tables // databases)
+    return [
+        "db%05d.table_%d" % (index // per_database, index % per_database) for index in range(tables)
+    ]
+
+
+def generate_patterns(count, databases):
+    """Return exclude-tables globs: literal names, prefixes and suffixes"""
+    patterns = []
+    for index in range(count):
+        database = "db%05d" % (index * 7919 % databases)
+        kind = index % 3
+        if kind == 0:
+            patterns.append("%s.table_%d" % (database, index))
+        elif kind == 1:
+            patterns.append("%s.tmp_*" % database)
+        else:
+            patterns.append("*.table_%d_old" % index)
+    return patterns
+
+
+def reference_filter(patterns):
+    """The filter as it was: one re.match() per pattern and name"""
+    options = re.M | re.U | re.I
+    regexes = exclude_glob_qualified(*patterns).patterns
+
+    def _filter(item):
+        for pattern in regexes:
+            if re.match(pattern, item, options) is not None:
+                return True
+        return False
+
+    return _filter
+
+
+def _time(filters, names):
+    started = time.perf_counter()
+    excluded = 0
+    for name in names:
+        for _filter in filters:
+            if _filter(name):
+                excluded += 1
+                break
+    return time.perf_counter() - started, excluded
+
+
+def main(argv=None):
+    """Print the cost of filtering each name"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tables", type=int, default=1000000)
+    parser.add_argument("--databases", type=int, default=20000)
+    parser.add_argument("--patterns", type=int, default=300)
+    parser.add_argument(
+        "--sample", type=int, default=10000, help="names the old filter is timed on"
+    )
+    opts = parser.parse_args(argv)
+
+    names = generate_names(opts.tables, opts.databases)
+    patterns = generate_patterns(opts.patterns, opts.databases)
+    print("%d tables, %d exclude-tables patterns" % (len(names), len(patterns)))
+
+    filters = [include_glob_qualified("*"), exclude_glob_qualified(*patterns)]
+    seconds, excluded = _time(filters, names)
+    print(
+        "%-20s %8.2f s %8.0f ns/table  %d excluded"
+        % ("compiled", seconds, seconds * 1e9 / len(names), excluded)
+    )
+
+    sample = names[: opts.sample]
+    filters = [include_glob_qualified("*"), reference_filter(patterns)]
+    seconds, excluded = _time(filters, sample)
+    print(
+        "%-20s %8.2f s %8.0f ns/table  (%d tables timed)"
+        % (
+            "per-pattern re.match",
+            seconds * len(names) / len(sample),
+            seconds * 1e9 / len(sample),
+            len(sample),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,7 @@ setup(
             "backup = holland.commands.backup:Backup",
             "mk-config = holland.commands.mk_config:MkConfig",
             "purge = holland.commands.purge:Purge",
+            "bench-compression = holland.commands.bench_compression:BenchCompression",
         ],
     },
 )
@@ -0,0 +1,90 @@
+"""Test the SQLite catalog of the backups in a spool"""
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from holland.core.catalog import SpoolCatalog
+from holland.core.spool import Backup, Spool
+
+
+def add_backup(spool, backupset, name, stop_time=0.0, on_disk_size=0.0, failed=False):
+    """Create a backup directory with a backup.conf"""
+    path = os.path.join(spool.path, backupset, name)
+    os.makedirs(path)
+    backup = Backup(path, backupset, name)
+    config = backup.config["holland:backup"]
+    config["plugin"] = "mysqldump"
+    config["stop-time"] = stop_time
+    config["on-disk-size"] = on_disk_size
+    config["failed"] = failed
+    backup.flush()
+    return backup
+
+
+class TestCatalog(unittest.TestCase):
+    """Test SpoolCatalog"""
+
+    tmpdir = None
+
+    def setUp(self):
+        self.__class__.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.__class__.tmpdir)
+
+    def test_records(self):
+        """Test finished backups missing from the catalog are added"""
+        spool = Spool(self.tmpdir)
+        add_backup(spool, "db", "20200101_000000", stop_time=1.0)
+        newer = add_backup(spool, "db", "20200102_000000", stop_time=2.0, on_disk_size=10.0)
+        add_backup(spool, "db", "20200103_000000")
+        backupset = spool.find_backupset("db")
+        catalog = SpoolCatalog(self.tmpdir)
+
+        # listing does not create or write the catalog
+        records = catalog.records(backupset, readonly=True)
+        self.assertEqual(
+            [record.name for record in records],
+            ["db/20200101_000000", "db/20200102_000000", "db/20200103_000000"],
+        )
+        self.assertEqual(records[1].on_disk_size, 10.0)
+        self.assertFalse(catalog.exists())
+
+        # the backup still running is left out until it has finished
+        catalog.records(backupset)
+        self.assertEqual(sorted(catalog.lookup("db")), ["db/20200101_000000", "db/20200102_000000"])
+
+        # cataloged backups are not read from their backup.conf again
+        newer.config["holland:backup"]["on-disk-size"] = 20.0
+        newer.flush()
+        records = catalog.records(backupset, readonly=True)
+        self.assertEqual(records[1].on_disk_size, 10.0)
+        catalog.update(newer)
+        records = catalog.records(backupset, readonly=True)
+        self.assertEqual(records[1].on_disk_size, 20.0)
+
+    def test_rebuild(self):
+        """Test rebuilding the catalog from every backup.conf in the spool"""
+        spool = Spool(self.tmpdir)
+        add_backup(spool, "a", "20200101_000000", stop_time=1.0, failed=True)
+        add_backup(spool, "b", "20200101_000000", stop_time=1.0, on_disk_size=5.0)
+        catalog = spool.catalog
+        catalog.records(spool.find_backupset("b"))
+        shutil.rmtree(os.path.join(self.tmpdir, "b"))
+
+        self.assertEqual(catalog.rebuild(spool), 1)
+        records = catalog.lookup()
+        self.assertEqual(sorted(records), ["a/20200101_000000"])
+        self.assertTrue(records["a/20200101_000000"].failed)
+
+        # a catalog that cannot be read is treated as empty
+        with open(catalog.path, "wb") as fileobj:
+            fileobj.write(b"not a database" * 100)
+        self.assertEqual(catalog.lookup(), {})
+        self.assertEqual(len(catalog.records(spool.find_backupset("a"), readonly=True)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Test predicting backup sizes from previous backups"""
+
+import math
+import unittest
+
+from holland.core.backup.history import SizeModel, SizeSample
+from holland.core.catalog import CatalogRecord
+
+DAY = 86400.0
+
+
+class TestSizeModel(unittest.TestCase):
+    """Test SizeModel"""
+
+    def test_from_records(self):
+        """Test only successful backups with sizes are sampled, newest first"""
+        records = [
+            CatalogRecord(start_time=4 * DAY, estimated_size=100, on_disk_size=50),
+            CatalogRecord(start_time=3 * DAY, estimated_size=100, on_disk_size=50, failed=1),
+            CatalogRecord(start_time=2 * DAY, estimated_size=100, on_disk_size=0),
+            CatalogRecord(start_time=1 * DAY, estimated_size=100, on_disk_size=40),
+            CatalogRecord(start_time=0, estimated_size=100, on_disk_size=30),
+        ]
+        model = SizeModel.from_records(records, 2)
+        self.assertEqual(len(model), 2)
+        self.assertEqual([sample.on_disk_size for sample in model.samples], [50.0, 40.0])
+        self.assertEqual(len(SizeModel.from_records([], 5)), 0)
+
+    def test_no_samples(self):
+        """Test an empty model has no growth or confidence"""
+        model = SizeModel([])
+        self.assertEqual(model.growth(), 0.0)
+        self.assertEqual(model.confidence(), 0.0)
+
+    def test_one_sample(self):
+        """Test one backup predicts by its ratio, with half confidence"""
+        model = SizeModel([SizeSample(DAY, 200.0, 50.0)])
+        self.assertEqual(model.growth(), 0.0)
+        self.assertAlmostEqual(model.confidence(), 0.5)
+        # the new estimate by the ratio, or the last size when that is larger
+        self.assertAlmostEqual(model.predict(400.0, 1.1, now=2 * DAY), 100.0)
+        self.assertAlmostEqual(model.predict(100.0, 1.1, now=2 * DAY), 50.0)
+
+    def test_two_samples(self):
+        """Test the ratio, growth and confidence of two backups"""
+        model = SizeModel([SizeSample(DAY, 100.0, 60.0), SizeSample(0, 100.0, 40.0)])
+        # the newer backup weighs twice as much
+        mean = (2 * 0.6 + 0.4) / 3
+        stdev = math.sqrt((2 * (0.6 - mean) ** 2 + (0.4 - mean) ** 2) / 3)
+        self.assertAlmostEqual(model.growth() * DAY, 20.0)
+        self.assertAlmostEqual(model.confidence(), (1 - stdev / mean) * 2 / 3)
+
+        # a day later the trend predicts 80 bytes, more than the ratio
+        margin = 1 + 2 * stdev / mean
+        self.assertAlmostEqual(model.predict(100.0, 2.0, now=2 * DAY), 80.0 * margin)
+        self.assertAlmostEqual(model.predict(300.0, 2.0, now=2 * DAY), 300.0 * mean * margin)
+        # the margin is capped by max_factor
+        self.assertAlmostEqual(model.predict(100.0, 1.1, now=2 * DAY), 80.0 * 1.1)
+
+    def test_consistent_samples(self):
+        """Test confidence grows with the number of consistent backups"""
+        confidence = []
+        for count in range(1, 5):
+            model = SizeModel([SizeSample(DAY, 100.0, 50.0)] * count)
+            # backups taken at the same time show no growth
+            self.assertEqual(model.growth(), 0.0)
+            confidence.append(model.confidence())
+        for value, count in zip(confidence, range(1, 5)):
+            self.assertAlmostEqual(value, 1 - 1.0 / (count + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+"""Test planning the disk space of a backup run"""
+
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+
+from holland.core.backup import planner
+from holland.core.backup.base import BackupError, BackupRunner
+from holland.core.backup.scheduler import BackupJob
+
+
+class MockPlugin(object):
+    """Plugin that estimates a fixed size, or fails to"""
+
+    def __init__(self, config, size):
+        self.config = config
+        self.size = size
+        self.estimates = 0
+
+    def estimate_backup_size(self):
+        """Return the configured size"""
+        self.estimates += 1
+        if isinstance(self.size, Exception):
+            raise self.size
+        return self.size
+
+
+class MockSpool(object):
+    """Spool with no existing backups"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def find_backupset(self, name):  # pylint: disable=unused-argument
+        """No backupset has been backed up yet"""
+        return None
+
+
+class MockRunner(object):
+    """BackupRunner that requires exactly the estimated size"""
+
+    def __init__(self, path):
+        self.spool = MockSpool(path)
+
+    def required_space(self, plugin, backupset, estimated_bytes):  # pylint: disable=unused-argument
+        """Require the estimate unchanged"""
+        return estimated_bytes
+
+
+class TestPlanner(unittest.TestCase):
+    """Test plan_disk_space()"""
+
+    tmpdir = None
+
+    def setUp(self):
+        self.__class__.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.__class__.tmpdir)
+
+    def _plan(self, sizes, free, **kwargs):
+        """Plan jobs estimated at sizes against free bytes"""
+        jobs = [BackupJob(name, {"holland:backup": {"plugin": "mock"}}) for name in sizes]
+
+        def load_plugin(name, config, path, dry_run):  # pylint: disable=unused-argument
+            return MockPlugin(config, sizes[name])
+
+        with mock.patch.object(planner, "load_plugin", load_plugin), mock.patch.object(
+            planner, "disk_free", lambda path: free
+        ):
+            refused = planner.plan_disk_space(MockRunner(self.tmpdir), jobs, **kwargs)
+        return jobs, refused
+
+    def test_refused(self):
+        """Test backupsets that cannot fit are moved to the end and refused"""
+        jobs, refused = self._plan({"a": 60, "b": 50, "c": 30}, 100, purge=False)
+        self.assertEqual([job.name for job in jobs], ["a", "c", "b"])
+        self.assertEqual(refused, [jobs[2]])
+        self.assertEqual(
+            [job.status for job in jobs],
+            [BackupJob.PENDING, BackupJob.PENDING, BackupJob.REFUSED],
+        )
+        self.assertTrue(jobs[2].failed)
+        self.assertTrue(isinstance(jobs[2].error, BackupError))
+
+        # backupsets that fit keep their order ahead of the refused one
+        jobs, refused = self._plan({"a": 60, "b": 30, "c": 50}, 100, purge=False)
+        self.assertEqual([job.name for job in jobs], ["a", "b", "c"])
+
+        # a dry run only reports the backupsets it would refuse
+        jobs, refused = self._plan({"a": 60, "b": 50}, 100, purge=False, dry_run=True)
+        self.assertEqual(refused, [])
+        self.assertEqual([job.status for job in jobs], [BackupJob.PENDING] * 2)
+
+    def test_unplanned(self):
+        """Test failed estimates are logged, and hooked backupsets are left out"""
+        with self.assertLogs(planner.LOG, "WARNING") as logs:
+            jobs, refused = self._plan({"a": IOError("no server"), "b": 200}, 100, purge=False)
+        self.assertIn("Not planning space for 'a': no server", logs.output[0])
+        self.assertEqual(jobs[0].estimate, None)
+        self.assertEqual(refused, [jobs[1]])
+
+        job = BackupJob("hooked", {"holland:backup": {"before-backup-command": "mount /srv"}})
+        with mock.patch.object(planner, "load_plugin") as load_plugin:
+            self.assertEqual(planner.estimate_job(MockRunner(self.tmpdir), job), None)
+        self.assertFalse(load_plugin.called)
+        self.assertEqual(job.estimate, None)
+
+    def test_estimate_reused(self):
+        """Test the backup reuses the estimate made while planning"""
+        jobs, _ = self._plan({"a": 60}, 100, purge=False)
+        self.assertEqual(jobs[0].estimate, 60.0)
+
+        runner = BackupRunner(MockSpool(self.tmpdir))
+        plugin = MockPlugin({"holland:backup": {"purge-on-demand": False}}, 1)
+        entry = mock.Mock(path=self.tmpdir, backupset="a", config={"holland:backup": {}})
+        with mock.patch.object(runner, "required_space", lambda plugin, name, size: size):
+            estimate = runner.check_available_space(plugin, entry, estimated_bytes=jobs[0].estimate)
+            self.assertEqual(estimate, 60.0)
+            self.assertEqual(plugin.estimates, 0)
+            self.assertEqual(runner.check_available_space(plugin, entry), 1.0)
+            self.assertEqual(plugin.estimates, 1)
+        self.assertEqual(entry.config["holland:backup"]["estimated-size"], 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+"""Test scheduling backupsets onto workers"""
+
+import _thread
+import logging
+import threading
+import time
+import unittest
+
+from holland.core.backup.scheduler import (
+    BackupJob,
+    BackupScheduler,
+    ResourceLimits,
+    resource_keys,
+)
+from holland.core.util.path import getmount
+
+
+class RecordingWorker(object):
+    """Worker that records how many jobs ran at once, and on which resources"""
+
+    def __init__(self, failures=(), delay=0.05):
+        self.failures = failures
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = []
+        self.started = []
+        self.peak = 0
+        self.peak_per_resource = {}
+        self.threads = []
+
+    def __call__(self, job):
+        with self.lock:
+            self.running.append(job)
+            self.started.append(job.name)
+            self.threads.append(threading.current_thread().name)
+            self.peak = max(self.peak, len(self.running))
+            for key in job.resources:
+                count = len([other for other in self.running if key in other.resources])
+                self.peak_per_resource[key] = max(self.peak_per_resource.get(key, 0), count)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running.remove(job)
+        return job.name not in self.failures
+
+
+class TestScheduler(unittest.TestCase):
+    """Test BackupScheduler"""
+
+    def test_resource_keys(self):
+        """Test deriving resource keys from a backupset config"""
+        mount = "mount:%s" % getmount("/tmp")
+        self.assertEqual(
+            resource_keys({"mysql:client": {"host": "db1", "port": 3307}}, "/tmp"),
+            ["mysql:db1:3307", mount],
+        )
+        self.assertEqual(
+            resource_keys({"mysql:client": {"socket": "/run/mysqld.sock"}}, "/tmp"),
+            ["mysql:/run/mysqld.sock", mount],
+        )
+        self.assertEqual(resource_keys({"pgauth": {}}, "/tmp"), ["pgsql:localhost:5432", mount])
+        self.assertEqual(resource_keys({}, "/tmp"), [mount])
+
+    def test_resource_limits(self):
+        """Test jobs sharing a limited resource never run at once"""
+        jobs = [
+            BackupJob("a", resources=["mysql:db1", "mount:/"]),
+            BackupJob("b", resources=["mysql:db1", "mount:/"]),
+            BackupJob("c", resources=["mysql:db2", "mount:/"]),
+            BackupJob("d", resources=["mysql:db2", "mount:/"]),
+        ]
+        worker = RecordingWorker()
+        scheduler = BackupScheduler(worker, max_workers=4, limits=ResourceLimits({"mysql": 1}))
+        scheduler.run(jobs)
+        self.assertEqual([job.status for job in jobs], [BackupJob.COMPLETED] * 4)
+        self.assertEqual(worker.peak_per_resource["mysql:db1"], 1)
+        self.assertEqual(worker.peak_per_resource["mysql:db2"], 1)
+        self.assertEqual(worker.peak, 2)
+        self.assertEqual(ResourceLimits({"mysql:db1": 2, "mysql": 1}).limit("mysql:db1"), 2)
+        self.assertEqual(ResourceLimits({"mysql": 1}).limit("mount:/"), 0)
+
+    def test_max_workers(self):
+        """Test no more than max_workers jobs run at once"""
+        jobs = [BackupJob(str(index)) for index in range(6)]
+        worker = RecordingWorker()
+        BackupScheduler(worker, max_workers=2).run(jobs)
+        self.assertEqual([job.status for job in jobs], [BackupJob.COMPLETED] * 6)
+        self.assertEqual(worker.peak, 2)
+        self.assertEqual(
+            sorted(worker.threads), sorted("holland-backup %s" % job.name for job in jobs)
+        )
+        with self.assertRaises(ValueError):
+            BackupScheduler(worker, max_workers=0)
+
+    def test_serial(self):
+        """Test a single worker runs jobs in order on the calling thread"""
+        jobs = [BackupJob("a"), BackupJob("b", error=IOError("bad config")), BackupJob("c")]
+        worker = RecordingWorker(delay=0)
+        BackupScheduler(worker, max_workers=1).run(jobs)
+        self.assertEqual(worker.started, ["a", "c"])
+        self.assertEqual(worker.threads, [threading.current_thread().name] * 2)
+        self.assertEqual(
+            [job.status for job in jobs],
+            [BackupJob.COMPLETED, BackupJob.FAILED, BackupJob.COMPLETED],
+        )
+
+    def test_abort_on_failure(self):
+        """Test no job is started after the first failure"""
+        # with two workers, a and c start together and d waits for a slot
+        for max_workers, started, status_c in (
+            (1, ["a"], BackupJob.SKIPPED),
+            (2, ["a", "c"], BackupJob.COMPLETED),
+        ):
+            jobs = [BackupJob(name) for name in "abcd"]
+            jobs[1].status = BackupJob.REFUSED
+            worker = RecordingWorker(failures=("a",))
+            scheduler = BackupScheduler(worker, max_workers=max_workers, abort_on_failure=True)
+            scheduler.run(jobs)
+            self.assertTrue(scheduler.aborted)
+            self.assertEqual(sorted(worker.started), started)
+            self.assertEqual(
+                [job.status for job in jobs],
+                [BackupJob.FAILED, BackupJob.REFUSED, status_c, BackupJob.SKIPPED],
+            )
+
+    def test_interrupt(self):
+        """Test an interrupt skips pending jobs and waits for running ones"""
+
+        def interrupt(job):  # pylint: disable=unused-argument
+            raise KeyboardInterrupt()
+
+        jobs = [BackupJob(name) for name in "abc"]
+        with self.assertRaises(KeyboardInterrupt):
+            BackupScheduler(interrupt).run(jobs)
+        self.assertEqual(
+            [job.status for job in jobs],
+            [BackupJob.FAILED, BackupJob.SKIPPED, BackupJob.SKIPPED],
+        )
+
+        worker = RecordingWorker(delay=0.2)
+        jobs = [BackupJob(name) for name in "abcd"]
+        scheduler = BackupScheduler(worker, max_workers=2)
+        timer = threading.Timer(0.05, _thread.interrupt_main)
+        timer.start()
+        with self.assertRaises(KeyboardInterrupt):
+            scheduler.run(jobs)
+        timer.join()
+        self.assertEqual(worker.running, [])
+        self.assertEqual(
+            [job.status for job in jobs],
+            [BackupJob.COMPLETED] * 2 + [BackupJob.SKIPPED] * 2,
+        )
+
+    def test_log_backupset(self):
+        """Test records logged by a concurrent job name its backupset"""
+        messages = []
+
+        class Handler(logging.Handler):
+            """Collect formatted messages"""
+
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        def worker(job):  # pylint: disable=unused-argument
+            logging.getLogger("holland.test").warning("dumping %s", "tables")
+            return True
+
+        logger = logging.getLogger("holland.test")
+        handler = Handler()
+        logger.addHandler(handler)
+        try:
+            BackupScheduler(worker, max_workers=2).run([BackupJob("a"), BackupJob("b")])
+            logger.warning("done")
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(sorted(messages), ["[a] dumping tables", "[b] dumping tables", "done"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+"""Test purging backups from a spool"""
+
+import errno
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+
+from holland.core import spool as spool_module
+from holland.core.spool import TRASH_DIR, Spool, discard, wait_for_purges
+
+
+def add_backup(spool, backupset, name):
+    """Create a finished backup with a data file"""
+    backup = spool.find_backupset(backupset) or spool.add_backupset(backupset)
+    path = os.path.join(backup.path, name)
+    os.makedirs(os.path.join(path, "data"))
+    with open(os.path.join(path, "data", "backup.sql"), "wb") as fileobj:
+        fileobj.write(b"x" * 8192)
+    return backup.find_backup(name)
+
+
+class TestPurge(unittest.TestCase):
+    """Test purging backups through the trash directory"""
+
+    tmpdir = None
+
+    def setUp(self):
+        self.__class__.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        wait_for_purges()
+        shutil.rmtree(self.__class__.tmpdir)
+
+    def test_purge(self):
+        """Test purged backups leave the spool at once and are deleted"""
+        spool = Spool(self.tmpdir)
+        for name in ("20200101_000000", "20200102_000000", "20200103_000000"):
+            add_backup(spool, "db", name)
+        backupset = spool.find_backupset("db")
+        spool.catalog.rebuild(spool)
+
+        purged = list(backupset.purge(retention_count=1))
+        self.assertEqual(
+            [backup.name for backup in purged], ["db/20200102_000000", "db/20200101_000000"]
+        )
+        self.assertEqual(
+            [backup.name for backup in backupset.list_backups()], ["db/20200103_000000"]
+        )
+        self.assertEqual(sorted(spool.catalog.lookup()), ["db/20200103_000000"])
+
+        wait_for_purges()
+        self.assertEqual(os.listdir(os.path.join(backupset.path, TRASH_DIR)), [])
+
+    def test_interrupted(self):
+        """Test backups left in the trash by an earlier run are deleted"""
+        spool = Spool(self.tmpdir)
+        backup = add_backup(spool, "db", "20200101_000000")
+        trash = os.path.join(os.path.dirname(backup.path), TRASH_DIR)
+        # an earlier run renamed a backup into the trash and then exited
+        os.makedirs(trash)
+        os.rename(
+            add_backup(spool, "db", "20191231_000000").path,
+            os.path.join(trash, "20191231_000000.1.2"),
+        )
+
+        backup.purge()
+        wait_for_purges()
+        self.assertEqual(os.listdir(trash), [])
+        self.assertEqual(spool.find_backupset("db").list_backups(), [])
+
+    def test_rename_failed(self):
+        """Test a backup that cannot be moved to the trash is deleted inline"""
+        backup = add_backup(Spool(self.tmpdir), "db", "20200101_000000")
+
+        def rename(src, dst):  # pylint: disable=unused-argument
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        with mock.patch.object(spool_module.os, "rename", rename):
+            discard(backup.path)
+        self.assertFalse(os.path.exists(backup.path))
+        self.assertEqual(os.listdir(os.path.join(os.path.dirname(backup.path), TRASH_DIR)), [])
+
+        # a backup that is already gone is nothing to purge
+        discard(backup.path)
+        self.assertFalse(os.path.exists(backup.path))
+
+
+if __name__ == "__main__":
+    unittest.main()